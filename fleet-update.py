@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Update many instances of a host to their latest release:
+#
+#   1.) Fetch all instance repos and group the instances by their target core
+#   2.) Provision every core change only once (clone or copy, checkout and compile)
+#   3.) Run "start.py --instance-dir ... --update" for the instances concurrently
+#       HINT: The heavy steps inside start.py (backup, restore, migration) wait for host wide slots (flock files in
+#             /var/lock/online_tools) so the limits are also respected by updates started by cron or by hand
+#   4.) Print (and write) a summary with the duration of every instance update
+#
+# Example: fleet-update.py --max-updates 4 --max-migrations 2 dadi care
+import os
+import sys
+import time
+import json
+import signal
+import argparse
+import threading
+import ConfigParser
+import subprocess32
+from collections import OrderedDict
+
+pj = os.path.join
+
+# start.py is the update script of one instance (and has no side effects on import)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import start
+
+
+def _last_duration(instance_dir):
+    # Duration of the last dry-run of this instance from status.ini (or 0.0)
+    status = ConfigParser.SafeConfigParser()
+    status.read(pj(instance_dir, 'status.ini'))
+    try:
+        return float(status.get('config', 'dry_run_duration'))
+    except Exception:
+        return 0.0
+
+
+def _update_failed(instance_dir):
+    status = ConfigParser.SafeConfigParser()
+    status.read(pj(instance_dir, 'status.ini'))
+    try:
+        return status.get('options', 'update_failed') != 'False'
+    except Exception:
+        return True
+
+
+def provision(args, instance_dirs):
+    # Fetch all instances and provision every core change only once
+    results = OrderedDict()
+    cores = OrderedDict()
+    for instance_dir in instance_dirs:
+        instance = os.path.basename(instance_dir)
+        results[instance] = {'instance_dir': instance_dir, 'state': 'pending', 'core': '', 'latest_core': '',
+                             'provision': 0.0, 'duration': 0.0}
+        try:
+            start_time = time.time()
+            cnf = start._prefetch_instance(args.root_dir, instance_dir)
+            if cnf is None:
+                print "WARNING: Update is already running for %s! Skipped!" % instance
+                results[instance]['state'] = 'skipped'
+                continue
+            results[instance].update({'core': cnf['core'], 'latest_core': cnf['latest_core'],
+                                      'provision': round(time.time() - start_time, 1)})
+            cores.setdefault((cnf['core'], cnf['latest_core']), []).append(cnf)
+        except Exception as e:
+            print "ERROR: Could not fetch instance %s!%s" % (instance, start.pp(e))
+            results[instance]['state'] = 'provision_failed'
+
+    for (core, latest_core), cnfs in cores.iteritems():
+        print "\n---- PROVISION core %s -> %s for %s" % (core, latest_core, [c['instance'] for c in cnfs])
+        start_time = time.time()
+        try:
+            start._get_cores(cnfs[0])
+        except Exception as e:
+            print "ERROR: Could not provision core %s!%s" % (latest_core, start.pp(e))
+            for cnf in cnfs:
+                results[cnf['instance']]['state'] = 'provision_failed'
+        for cnf in cnfs:
+            results[cnf['instance']]['provision'] += round(time.time() - start_time, 1)
+            # Cold start import time of the new core before and after its compilation (see start._prepare_core())
+            for key in ('latest_core_import_before', 'latest_core_import_after'):
+                results[cnf['instance']][key] = cnfs[0].get(key)
+    return results
+
+
+def update_instance(args, instance, result):
+    # Run the update of one instance in its own start.py process
+    env = os.environ.copy()
+    env.update({
+        'ONLINE_TOOLS_MAX_UPDATE': str(args.max_updates),
+        'ONLINE_TOOLS_MAX_BACKUP': str(args.max_backups),
+        'ONLINE_TOOLS_MAX_MIGRATION': str(args.max_migrations),
+        'ONLINE_TOOLS_MAX_POSTGRES': str(args.max_postgres),
+    })
+    cmd = [sys.executable, pj(os.path.dirname(os.path.abspath(__file__)), 'start.py'),
+           '--instance-dir', result['instance_dir'], '--update']
+    if args.promote:
+        cmd.append('--promote')
+    log_file = pj(result['instance_dir'], 'update', 'fleet-update.log')
+    print "Start update of %s (log: %s)" % (instance, log_file)
+    result['state'] = 'running'
+    start_time = time.time()
+    try:
+        with open(log_file, 'a+') as log:
+            proc = subprocess32.Popen(cmd, stdout=log, stderr=subprocess32.STDOUT, env=env, preexec_fn=os.setsid)
+            try:
+                returncode = proc.wait(timeout=args.timeout)
+            except subprocess32.TimeoutExpired:
+                # HINT: Never kill an update while the production instance is stopped for its update or restore
+                marker = pj(result['instance_dir'], 'update', 'production.running')
+                if proc.poll() is None and os.path.isfile(marker):
+                    print "WARNING: Timeout for %s but the production update is running! Waiting." % instance
+                    while proc.poll() is None and os.path.isfile(marker):
+                        time.sleep(5)
+                    # Time to start the instance and to write status.ini after the production update
+                    try:
+                        proc.wait(timeout=600)
+                    except subprocess32.TimeoutExpired:
+                        pass
+                if proc.poll() is None:
+                    # HINT: start.py finishes the update with an error on SIGTERM (and removes its update.lock). The
+                    #       whole process group is signaled so the odoo, pg_dump and pg_restore children stop too.
+                    print "WARNING: Timeout for %s! Terminate the update." % instance
+                    os.killpg(proc.pid, signal.SIGTERM)
+                    try:
+                        proc.wait(timeout=args.kill_grace)
+                    except subprocess32.TimeoutExpired:
+                        print "WARNING: Update of %s still running! Kill it." % instance
+                        os.killpg(proc.pid, signal.SIGKILL)
+                        proc.wait()
+                        lock_file = pj(result['instance_dir'], 'update.lock')
+                        if os.path.isfile(lock_file):
+                            print "WARNING: Remove the update lock file %s of the killed update." % lock_file
+                            os.remove(lock_file)
+                    returncode = 'timeout'
+                else:
+                    returncode = proc.returncode
+    except Exception as e:
+        print "ERROR: Could not start update of %s!%s" % (instance, start.pp(e))
+        returncode = 'exception'
+    result['duration'] = round(time.time() - start_time, 1)
+    result['returncode'] = returncode
+    result['state'] = 'failed' if returncode != 0 or _update_failed(result['instance_dir']) else 'done'
+    print "Update of %s %s in %ss" % (instance, result['state'], result['duration'])
+
+
+def update(args, results):
+    # Longest updates first (by the duration of the last dry-run) so the fleet update finishes as early as possible
+    queue = [i for i in results if results[i]['state'] == 'pending']
+    queue.sort(key=lambda i: (results[i]['latest_core'], -_last_duration(results[i]['instance_dir'])))
+    print "\n---- UPDATE %s instances (max %s concurrent updates): %s" % (len(queue), args.max_updates, queue)
+
+    threads = []
+    while queue or threads:
+        threads = [t for t in threads if t.is_alive()]
+        while queue and len(threads) < args.max_updates:
+            instance = queue.pop(0)
+            thread = threading.Thread(target=update_instance, args=(args, instance, results[instance]),
+                                      name=instance)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        time.sleep(1)
+    return results
+
+
+def summary(args, results, duration):
+    print "\n---- FLEET UPDATE SUMMARY (%.1fs)" % duration
+    print "%-24s %-18s %-18s %10s %10s" % ('instance', 'core', 'state', 'provision', 'update')
+    for instance, r in results.iteritems():
+        print "%-24s %-18s %-18s %9.1fs %9.1fs" % (instance, '%s>%s' % (r['core'], r['latest_core']), r['state'],
+                                                   r['provision'], r['duration'])
+    summary_file = args.summary_file or pj(args.root_dir, 'fleet-update-%s.json' % time.strftime('%Y-%m-%d_%H-%M-%S'))
+    try:
+        with open(summary_file, 'w') as f:
+            json.dump({'duration': round(duration, 1), 'instances': results}, f, indent=2)
+        print "Summary written to %s" % summary_file
+    except Exception as e:
+        print "WARNING: Could not write summary file %s!%s" % (summary_file, start.pp(e))
+
+
+def fleet_update(args):
+    start_time = time.time()
+    assert os.path.isdir(args.root_dir), "CRITICAL: root directory not found: %s" % args.root_dir
+    if args.instances:
+        instance_dirs = [pj(args.root_dir, i) for i in args.instances]
+        missing = [d for d in instance_dirs if d not in start._find_instances(args.root_dir)]
+        assert not missing, "CRITICAL: Instances not found in %s: %s" % (args.root_dir, missing)
+    else:
+        instance_dirs = start._find_instances(args.root_dir)
+    print "\n---------- FLEET UPDATE of %s instances in %s ----------" % (len(instance_dirs), args.root_dir)
+
+    results = provision(args, instance_dirs)
+    update(args, results)
+    summary(args, results, time.time() - start_time)
+    sys.exit(0 if all(r['state'] in ('done', 'skipped') for r in results.itervalues()) else 1)
+
+
+# ----------------------------
+# Create the command parser
+# ----------------------------
+parser = argparse.ArgumentParser(description='Update many instances of this host to their latest release.')
+parser.add_argument('instances', nargs='*', help='Instances to update (Default: all instances in --root-dir)')
+parser.add_argument('-r', '--root-dir', default='/opt/online', help='Directory of instances and cores')
+parser.add_argument('--max-updates', type=int, default=4, help='Concurrent instance updates (Default: 4)')
+parser.add_argument('--max-backups', type=int, default=2, help='Concurrent backups and restores (Default: 2)')
+parser.add_argument('--max-migrations', type=int, default=2, help='Concurrent odoo migrations (Default: 2)')
+parser.add_argument('--max-postgres', type=int, default=3,
+                    help='Concurrent database heavy steps of all kinds (Default: 3)')
+parser.add_argument('--timeout', type=int, default=6 * 3600, help='Timeout per instance update in seconds')
+parser.add_argument('--kill-grace', type=int, default=300,
+                    help='Seconds to wait for a terminated update before it is killed (Default: 300)')
+parser.add_argument('--promote', action='store_true', help='Run the updates with --promote')
+parser.add_argument('--summary-file', help='Summary json file (Default: <root-dir>/fleet-update-<time>.json)')
+parser.set_defaults(func=fleet_update)
+
+# --------------------
+# START
+# --------------------
+if __name__ == "__main__":
+    args = parser.parse_args()
+    args.func(args)
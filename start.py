@@ -7,17 +7,39 @@ import ConfigParser
 import time
 import shutil
 import subprocess32
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import threading
 import pwd
 from time import sleep
 import urllib2
-import difflib
+import xmlrpclib
 from functools import wraps
 import datetime
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import json
+import hashlib
+import imp
+import stat
+import ast
+import compileall
+import fcntl
+import socket
+import errno
+import signal
+import struct
+from distutils.spawn import find_executable
+from contextlib import contextmanager
+import re
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+# Resource usage counters of the update phases (shared with the fs-online tools in work-in-progress)
+# HINT: Appended so the modules of work-in-progress never shadow other modules
+sys.path.append(pj(os.path.dirname(os.path.abspath(__file__)), 'work-in-progress'))
+from shell_tools import usage, usage_delta
+
 # ATTENTION: Import certs will cause a segmentation fault in ubuntu14.04 out of nowhere ?!? Therefore deactivated!
 # requests ca-cert bundle
 # By default it is taken from /usr/local/lib/python2.7/dist-packages/requests/cacert.pem
@@ -96,13 +118,13 @@ def pp(e):
 
 def _change_user(user_uid, user_gid):
     def inner():
+        # HINT: No output here on success! This runs in the child after the redirection of stdout so it would become
+        #       part of the output of the command (e.g. the SHA1s of git rev-parse)
         try:
-            print "Before shell command user_id %s group_id %s" % (os.getuid(), os.getgid())
             # os.setegid(user_gid)
             # os.seteuid(user_uid)
             os.setresgid(user_gid, user_gid, user_gid)
             os.setresuid(user_uid, user_gid, user_gid)
-            print "Changed to user_id %s group_id %s" % (os.getuid(), os.getgid())
         except Exception as e:
             print 'WARNING: Could not change user_id and group_id!%s' % pp(e)
             return True
@@ -111,7 +133,77 @@ def _change_user(user_uid, user_gid):
     return inner
 
 
-def shell(*args, **kwargs):
+# Resource profiles for the shell commands of the update steps so maintenance does not slow down the other instances
+# HINT: nice: cpu priority (19 = lowest), ionice: (io scheduling class, priority) class 2 = best-effort, 3 = idle
+# HINT: cpu_quota (e.g. '50%') and memory_max (e.g. '4G') run the command in a cgroup by 'systemd-run --scope' (root)
+# HINT: All values can be set by ONLINE_TOOLS_PROFILE_<PROFILE>_<KEY> e.g. ONLINE_TOOLS_PROFILE_MIGRATION_MEMORY_MAX=4G
+# ATTENTION: For pg_dump, pg_restore and psql only the client process is throttled. The work done by the postgres
+#            server backend is not (use the host slots of _host_slot() to limit it).
+# HINT: Steps that run while the production instance is stopped (production update and restore) use no profile
+_resource_profiles = {
+    'backup': {'nice': 10, 'ionice': (2, 7), 'cpu_quota': None, 'memory_max': None},
+    'files': {'nice': 15, 'ionice': (3, 0), 'cpu_quota': None, 'memory_max': None},
+    'migration': {'nice': 5, 'ionice': (2, 4), 'cpu_quota': None, 'memory_max': None},
+}
+
+
+def _resource_profile(name):
+    profile = dict(_resource_profiles[name])
+    for key in profile:
+        value = os.environ.get('ONLINE_TOOLS_PROFILE_%s_%s' % (name.upper(), key.upper()))
+        if value is None:
+            continue
+        if key == 'nice':
+            profile[key] = int(value)
+        elif key == 'ionice':
+            profile[key] = tuple(int(v) for v in value.split(','))
+        else:
+            profile[key] = value or None
+    return profile
+
+
+def _resource_prefix(name, user=None):
+    # Command prefix to run a command with the resource profile 'name' (tools that are not installed are skipped)
+    profile = _resource_profile(name)
+    prefix = []
+    if (profile.get('cpu_quota') or profile.get('memory_max')) and find_executable('systemd-run') \
+            and os.getuid() == 0:
+        prefix += ['systemd-run', '--scope', '--quiet', '--collect']
+        if profile.get('cpu_quota'):
+            prefix += ['-p', 'CPUQuota=' + profile['cpu_quota']]
+        if profile.get('memory_max'):
+            prefix += ['-p', 'MemoryMax=' + profile['memory_max']]
+        if user:
+            prefix += ['--uid=' + str(user.pw_uid), '--gid=' + str(user.pw_gid)]
+    if profile.get('nice') and find_executable('nice'):
+        prefix += ['nice', '-n', str(profile['nice'])]
+    if profile.get('ionice') and find_executable('ionice'):
+        prefix += ['ionice', '-c', str(profile['ionice'][0])]
+        if profile['ionice'][0] != 3:
+            prefix += ['-n', str(profile['ionice'][1])]
+    return prefix
+
+
+def _resource_accounting(profile, before):
+    # Add the resources used by a command to the totals of its resource profile (see _phase_report())
+    delta = usage_delta(before, usage())
+    total = _resource_accounting.totals.setdefault(profile, OrderedDict([
+        ('commands', 0), ('wall', 0.0), ('cpu_children', 0.0), ('children_maxrss_kb', 0),
+        ('read_bytes', 0), ('write_bytes', 0)]))
+    total['commands'] += 1
+    total['wall'] = round(total['wall'] + delta['wall'], 3)
+    total['cpu_children'] = round(total['cpu_children'] + delta['cpu_children'], 3)
+    total['children_maxrss_kb'] = max(total['children_maxrss_kb'], delta['children_maxrss_kb'])
+    total['read_bytes'] += delta['read_bytes']
+    total['write_bytes'] += delta['write_bytes']
+_resource_accounting.totals = OrderedDict()
+
+
+def _shell_kwargs(*args, **kwargs):
+    # Returns the args and kwargs for subprocess32 (user switch and resource profile)
+    args = list(args)
+    profile = kwargs.pop('profile', None)
+
     # Remove None of False user names
     if not kwargs.get('user_name', True):
         kwargs.pop('user_name')
@@ -138,9 +230,76 @@ def shell(*args, **kwargs):
             print "WARNING: User %s not found on this machine! " \
                   "Will run as %s.\n%s\n" % (kwargs.get('user_name'), pwd.getpwuid(os.getuid())[0], pp(e))
             kwargs.pop('user_name')
+            user = None
         print "Shell Command: %s" % args[0]
         print "Shell CWD: %s" % kwargs.get('cwd', os.getcwd())
-    return subprocess32.check_output(*args, **kwargs)
+    else:
+        user = None
+
+    # Run the command with the resource profile
+    if profile:
+        prefix = _resource_prefix(profile, user=user)
+        # HINT: systemd-run --scope switches the user itself (a non root user can not create the scope)
+        if user and prefix and prefix[0] == 'systemd-run':
+            kwargs.pop('preexec_fn', None)
+        args[0] = prefix + list(args[0])
+        print "Shell resource profile %s: %s" % (profile, ' '.join(prefix))
+    return args, kwargs
+
+
+def shell(*args, **kwargs):
+    profile = kwargs.get('profile')
+    args, kwargs = _shell_kwargs(*args, **kwargs)
+    before = usage()
+    try:
+        return subprocess32.check_output(*args, **kwargs)
+    finally:
+        if profile:
+            _resource_accounting(profile, before)
+
+
+def shell_stream(cmd, timeout=None, tail=200, on_line=None, **kwargs):
+    # Run a command and print its output (stdout and stderr) line by line while it runs
+    # HINT: Unlike shell() only the last 'tail' lines are kept in memory. They are returned and are the output of
+    #       the CalledProcessError or TimeoutExpired exception.
+    # HINT: on_line(line) is called for every line e.g. to show the progress (see _odoo_progress())
+    profile = kwargs.get('profile')
+    (cmd, ), kwargs = _shell_kwargs(cmd, **kwargs)
+    before = usage()
+    lines = deque(maxlen=tail)
+    proc = subprocess32.Popen(cmd, stdout=subprocess32.PIPE, stderr=subprocess32.STDOUT, close_fds=True, **kwargs)
+
+    def reader():
+        for line in iter(proc.stdout.readline, ''):
+            line = line.rstrip('\n')
+            lines.append(line)
+            print line
+            if on_line:
+                try:
+                    on_line(line)
+                except Exception as e:
+                    print "WARNING: Could not process output line!%s" % pp(e)
+        proc.stdout.close()
+
+    thread = threading.Thread(target=reader, name='shell_stream')
+    thread.daemon = True
+    thread.start()
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except subprocess32.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        # HINT: Do not wait forever for the reader if a grandchild process keeps the pipe open
+        thread.join(10)
+        raise subprocess32.TimeoutExpired(cmd, timeout, output='\n'.join(lines))
+    finally:
+        if profile:
+            _resource_accounting(profile, before)
+    thread.join()
+    output = '\n'.join(lines)
+    if returncode:
+        raise subprocess32.CalledProcessError(returncode, cmd, output=output)
+    return output
 
 
 @retry(Exception, tries=3)
@@ -163,7 +322,7 @@ def _git_submodule(path, user_name=None):
         shell(['git', 'submodule', 'sync'],
               cwd=path, timeout=120, user_name=user_name)
         print "Update and init submodules"
-        shell(['git', 'submodule', 'update', '--init', '--recursive'],
+        shell(['git', 'submodule', 'update', '--init', '--recursive'] + _git_submodule_jobs(),
               cwd=path, timeout=1200, user_name=user_name)
     except Exception as e:
         raise Exception('CRITICAL: Git submodule update %s failed! Exception: %s' % (path, pp(e)))
@@ -188,15 +347,16 @@ def _git_clone(repo, branch='o8', cwd='', target='', user_name=None):
 
 
 @retry(Exception, tries=3)
-def _git_checkout(path, commit='o8', user_name=None):
+def _git_checkout(path, commit='o8', user_name=None, fetch=True, timeout=120):
     print "Git checkout %s in %s." % (commit, path)
     assert os.path.exists(path), 'CRITICAL: Path not found: %s' % path
-    try:
-        print "Git fetch before checkout %s" % path
-        shell(['git', 'fetch'], cwd=path, timeout=120, user_name=user_name)
-        shell(['git', 'fetch', '--tags'], cwd=path, timeout=120, user_name=user_name)
-    except Exception as e:
-        print 'ERROR: git fetch failed before checkout!%s' % pp(e)
+    if fetch:
+        try:
+            print "Git fetch before checkout %s" % path
+            shell(['git', 'fetch'], cwd=path, timeout=timeout, user_name=user_name)
+            shell(['git', 'fetch', '--tags'], cwd=path, timeout=timeout, user_name=user_name)
+        except Exception as e:
+            print 'ERROR: git fetch failed before checkout!%s' % pp(e)
     try:
         print "Git checkout %s" % path
         shell(['git', 'checkout', commit], cwd=path, timeout=60, user_name=user_name)
@@ -206,52 +366,127 @@ def _git_checkout(path, commit='o8', user_name=None):
     return True
 
 
+def _git_version():
+    # Returns the version of the git client as a tuple e.g.: (2, 39, 5)
+    if not hasattr(_git_version, 'version'):
+        try:
+            version = shell(['git', '--version']).strip().split()[2]
+            _git_version.version = tuple(int(v) for v in version.split('.')[:3] if v.isdigit())
+        except Exception as e:
+            print "WARNING: Could not get the git version!%s" % pp(e)
+            _git_version.version = (0, )
+    return _git_version.version
+
+
+def _git_submodule_jobs():
+    # HINT: 'git submodule update --jobs' is available since git 2.9
+    if _git_version() >= (2, 9):
+        return ['--jobs', str(max(2, min(8, multiprocessing.cpu_count())))]
+    return []
+
+
+def _git_state(path, commit, pull=False, user_name=None, timeout=120):
+    # Returns a dict with the state of the repository compared to the wanted commit (branch, tag or SHA1)
+    # HINT: Only fetch from the remote if the commit is a branch (pull) or if it is unknown in the local repo
+    state = {'head': '', 'target': '', 'at_target': False, 'clean': False, 'submodules_ok': False}
+    # HINT: All git commands run as the owner of the repo: git status may rewrite .git/index and git >= 2.35.2
+    #       refuses to work in repos of other users ("dubious ownership")
+    devnull = open(os.devnull, 'w')
+
+    def git_call(cmd):
+        (cmd, ), kwargs = _shell_kwargs(cmd, cwd=path, stdout=devnull, stderr=devnull, user_name=user_name)
+        return subprocess32.call(cmd, **kwargs)
+
+    try:
+        is_branch = git_call(['git', 'show-ref', '--verify', '--quiet', 'refs/remotes/origin/' + commit]) == 0
+        target_ref = 'origin/' + commit if is_branch and pull else commit
+        if is_branch and pull or git_call(['git', 'rev-parse', '--verify', '--quiet', commit + '^{commit}']) != 0:
+            print "Fetch latest data and tags %s, " % path
+            shell(['git', 'fetch', '--tags', 'origin', '+refs/heads/*:refs/remotes/origin/*'],
+                  cwd=path, timeout=timeout, stderr=devnull, user_name=user_name)
+            state['fetched'] = True
+
+        # HEAD, target commit and current branch name in one call
+        # HINT: a branch is only at its target if HEAD is on the local branch and matches the remote branch
+        revs = shell(['git', 'rev-parse', 'HEAD', target_ref + '^{commit}', '--abbrev-ref', 'HEAD'],
+                     cwd=path, stderr=devnull, user_name=user_name).split()
+        state['head'], state['target'], branch = revs[0], revs[1], revs[2]
+        state['at_target'] = state['head'] == state['target'] and (not is_branch or branch == commit)
+
+        # Index, worktree and untracked files (incl. modified or dirty submodules) in one call
+        # HINT: Files excluded by .gitignore are ignored (same as 'git clean -fdf' without -x)
+        status = shell(['git', 'status', '--porcelain', '--ignore-submodules=none'], cwd=path, stderr=devnull,
+                       user_name=user_name)
+        state['clean'] = not status.strip()
+
+        # Submodule SHA1s (missing '-', wrong commit '+' or merge conflict 'U')
+        state['submodules_ok'] = True
+        if os.path.isfile(pj(path, '.gitmodules')):
+            submodules = shell(['git', 'submodule', 'status', '--recursive'], cwd=path, stderr=devnull,
+                               user_name=user_name)
+            state['submodules_ok'] = not [line for line in submodules.splitlines() if line[:1] in ('-', '+', 'U')]
+    except Exception as e:
+        print "WARNING: Could not get the state of the git repo %s!%s" % (path, pp(e))
+    devnull.close()
+    print "Git repo state of %s: %s" % (path, state)
+    return state
+
+
 @retry(Exception, tries=3)
-def _git_latest(target_path, repo, commit='o8', user_name=None, pull=False):
+def _git_latest(target_path, repo, commit='o8', user_name=None, pull=False, timeout=120):
     print "Reset and clean git repository then fetch latest data from github in %s -b %s in %s." % (repo, commit, target_path)
     # HINT: 'target_path' is the full path where the repo should be cloned to
     if os.path.exists(target_path):
         # Git repo exists already
         devnull = open(os.devnull, 'w')
+        # HINT: timeout is used for the git commands that need the network (fetch and pull)
+        state = _git_state(target_path, commit, pull=pull, user_name=user_name, timeout=timeout)
+
+        # Fast path: nothing to do if the repo is clean and already at the target commit
+        if state['at_target'] and state['clean'] and state['submodules_ok']:
+            print "Git repo %s is clean and at commit %s. Skipping clean, reset and checkout!" % (target_path,
+                                                                                                 state['target'])
+            devnull.close()
+            return True
+
         try:
-            print "Fetch latest data and tags %s, " % target_path
-            shell(['git', 'fetch', '--tags'],
-                  cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
-            # ATTENTION: originally it was -xfdf but i remove the x to not delete the files excluded by .gitignore
-            #            so the copy core lock file will not be removed any more
-            print "Force-Clean git repo in %s, " % target_path
-            shell(['git', 'clean', '-fdf'],
-                  cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
-            # ATTENTION: originally it was -xfdf but i remove the x to not delete the files excluded by .gitignore
-            print "Force-Clean git repo submodules in %s, " % target_path
-            shell(['git', 'submodule', 'foreach', '--recursive', 'git', 'clean', '-fdf'],
-                  cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
-            print "Hard-Reset git repo in %s, " % target_path
-            shell(['git', 'reset', '--hard'],
-                  cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
-            print "Sync submodules from .gitmodules to .git/config for git repo in %s, " % target_path
-            shell(['git', 'submodule', 'sync'],
-                  cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
-            print "Hard-Reset git repo submodules in %s, " % target_path
-            shell(['git', 'submodule', 'foreach', '--recursive', 'git', 'reset', '--hard'],
-                  cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
-            print "Update and init git repo submodules in %s, " % target_path
-            shell(['git', 'submodule', 'update', '--init', '--recursive'],
-                  cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
-            print "Update git repo submodules with -f in %s, " % target_path
-            shell(['git', 'submodule', 'update', '-f'],
-                  cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
+            if not state['clean'] or not state['submodules_ok']:
+                # ATTENTION: originally it was -xfdf but i remove the x to not delete the files excluded by
+                #            .gitignore so the copy core lock file will not be removed any more
+                print "Force-Clean git repo in %s, " % target_path
+                shell(['git', 'clean', '-fdf'],
+                      cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
+                # ATTENTION: originally it was -xfdf but i remove the x to not delete the files excluded by .gitignore
+                print "Force-Clean git repo submodules in %s, " % target_path
+                shell(['git', 'submodule', 'foreach', '--recursive', 'git', 'clean', '-fdf'],
+                      cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
+                print "Hard-Reset git repo in %s, " % target_path
+                shell(['git', 'reset', '--hard'],
+                      cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
+                print "Sync submodules from .gitmodules to .git/config for git repo in %s, " % target_path
+                shell(['git', 'submodule', 'sync', '--recursive'],
+                      cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
+                print "Hard-Reset git repo submodules in %s, " % target_path
+                shell(['git', 'submodule', 'foreach', '--recursive', 'git', 'reset', '--hard'],
+                      cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
+                if state['at_target']:
+                    print "Update and init git repo submodules in %s, " % target_path
+                    shell(['git', 'submodule', 'update', '--init', '--recursive', '-f'] + _git_submodule_jobs(),
+                          cwd=target_path, timeout=1200, stderr=devnull, user_name=user_name)
         except Exception as e:
             print 'ERROR: Reset and clean git repo and submodules failed! %s' % pp(e)
-        try:
-            _git_checkout(target_path, commit=commit, user_name=user_name)
-        except Exception as e:
-            raise Exception('CRITICAL: git checkout failed!%s' % pp(e))
-        try:
-            if pull:
-                shell(['git', 'pull'], cwd=target_path, timeout=120, stderr=devnull, user_name=user_name)
-        except Exception as e:
-            raise Exception('CRITICAL: git pull failed!%s' % pp(e))
+        if not state['at_target']:
+            try:
+                # HINT: _git_state() did already fetch if needed
+                _git_checkout(target_path, commit=commit, user_name=user_name, fetch=not state.get('target'),
+                              timeout=timeout)
+            except Exception as e:
+                raise Exception('CRITICAL: git checkout failed!%s' % pp(e))
+            try:
+                if pull:
+                    shell(['git', 'pull'], cwd=target_path, timeout=timeout, stderr=devnull, user_name=user_name)
+            except Exception as e:
+                raise Exception('CRITICAL: git pull failed!%s' % pp(e))
         devnull.close()
     else:
         # Git repo does not exist
@@ -261,6 +496,72 @@ def _git_latest(target_path, repo, commit='o8', user_name=None, pull=False):
     return True
 
 
+def _git_dir(gitrepo_path):
+    # Returns the git directory of a repository
+    # HINT: For submodules '.git' is a file that points to the git directory e.g.: "gitdir: ../.git/modules/sub"
+    git_dir = pj(gitrepo_path, '.git')
+    if os.path.isfile(git_dir):
+        with open(git_dir, 'r') as f:
+            git_dir = os.path.normpath(pj(gitrepo_path, f.read().split('gitdir:', 1)[1].strip()))
+    return git_dir
+
+
+def _git_cache_file(gitrepo_path, file_name):
+    # Returns the path to a cache file of online_tools for this git repository or False
+    # HINT: The cache files are stored inside the git directory so 'git clean' or 'git reset' will never touch them
+    try:
+        cache_dir = pj(_git_dir(gitrepo_path), 'online_tools')
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return pj(cache_dir, file_name)
+    except Exception as e:
+        print "WARNING: Could not create the online_tools cache directory for %s!%s" % (gitrepo_path, pp(e))
+        return False
+
+
+def _git_head(gitrepo_path):
+    # Returns the commit of HEAD by reading the files in the git directory (no git process) or False
+    try:
+        git_dir = _git_dir(gitrepo_path)
+        with open(pj(git_dir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+        if not head.startswith('ref:'):
+            return head
+        ref = head.split(':', 1)[1].strip()
+        # HINT: Worktrees and submodules may keep the refs in the common git directory
+        common_dir = git_dir
+        if os.path.isfile(pj(git_dir, 'commondir')):
+            with open(pj(git_dir, 'commondir'), 'r') as f:
+                common_dir = os.path.normpath(pj(git_dir, f.read().strip()))
+        for base in (git_dir, common_dir):
+            if os.path.isfile(pj(base, ref)):
+                with open(pj(base, ref), 'r') as f:
+                    return f.read().strip()
+        with open(pj(common_dir, 'packed-refs'), 'r') as f:
+            for line in f:
+                if line.rstrip('\n').endswith(' ' + ref):
+                    return line.split()[0]
+    except (IOError, OSError, IndexError):
+        pass
+    return False
+
+
+def _write_file_atomic(file_path, content, mode=0o666):
+    # Write to a temporary file first and rename it so readers will never see a partially written file
+    # HINT: mode (e.g. 0o600 for files with passwords) is set before any content is written (the umask still applies)
+    try:
+        tmp_file = file_path + '.tmp' + str(os.getpid())
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode), 'w') as f:
+            f.write(content)
+        os.rename(tmp_file, file_path)
+        return True
+    except Exception as e:
+        print "WARNING: Could not write file %s!%s" % (file_path, pp(e))
+        return False
+
+
 def _service_exists(service_name):
     service_file = pj('/etc/init.d', service_name)
     print "Check if service exists at %s" % service_file
@@ -269,23 +570,70 @@ def _service_exists(service_name):
     return False
 
 
-def _service_running(service_name):
+def _service_running(service_name, quiet=False):
     pidfile = pj('/var/run', service_name + '.pid')
-    print "Check if service %s ist running with pidfile %s" % (service_name, pidfile)
+    if not quiet:
+        print "Check if service %s ist running with pidfile %s" % (service_name, pidfile)
     if os.path.isfile(pidfile):
         with open(pidfile, 'r') as pidfile:
             pid = str(pidfile.readline()).rstrip('\n')
             proc_dir = pj('/proc', pid)
-            print "Service pidfile contents %s. proc_dir %s" % (pid, proc_dir)
-            if os.path.exists(proc_dir):
-                print "Service is running!"
+            if not quiet:
+                print "Service pidfile contents %s. proc_dir %s" % (pid, proc_dir)
+            if pid and os.path.exists(proc_dir):
+                if not quiet:
+                    print "Service is running!"
                 return True
     return False
 
 
-def _service_control(service_name, running, wait=10):
+def _wait_for(check, timeout=120, delay=0.2, backoff=2, max_delay=5):
+    # Call check() with an exponential backoff until it returns True
+    # Returns the seconds it took or False if the timeout was reached
+    start = time.time()
+    while True:
+        if check():
+            return time.time() - start
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            return False
+        sleep(min(delay, max_delay, remaining))
+        delay *= backoff
+
+
+def _instance_port(conf, offset=0):
+    # Returns the xmlrpc port of the instance (for the health probe) or None if xmlrpc is disabled or unknown
+    if str(conf.get('xmlrpc', 'True')).lower() in ('false', '0') or not conf.get('xmlrpc_port'):
+        return None
+    return int(conf['xmlrpc_port']) + offset
+
+
+def _instance_ready(port, host='127.0.0.1', timeout=5):
+    # Health probe: odoo answers the xmlrpc call common.version() as soon as the http server is up
+    try:
+        request = urllib2.Request('http://%s:%s/xmlrpc/common' % (host, port),
+                                  data=xmlrpclib.dumps((), 'version'), headers={'Content-Type': 'text/xml'})
+        return urllib2.urlopen(request, timeout=timeout).getcode() == 200
+    except Exception:
+        return False
+
+
+def _service_timeout(conf, running):
+    # Timeout for a service start or stop: ONLINE_TOOLS_SERVICE_TIMEOUT (default 120s) or, for a start with the
+    # health probe, derived from the recorded durations of earlier starts (large instances need longer to load)
+    try:
+        default = max(1, int(os.environ.get('ONLINE_TOOLS_SERVICE_TIMEOUT', 120)))
+    except ValueError:
+        default = 120
+    if not running or not conf:
+        return default
+    return _step_timeout(conf, 'service_start', default, minimum=default)
+
+
+def _service_control(service_name, running, timeout=None, port=None, conf=None):
     print "Set service %s to state running %s" % (service_name, str(running))
     assert running in [True, False], 'CRITICAL: Running can only be True or False %s!' % running
+    timeout = timeout or _service_timeout(conf, running)
 
     if not _service_exists(service_name):
         print 'WARNING: No init script found for service %s. Maybe on development server?' % service_name
@@ -293,17 +641,180 @@ def _service_control(service_name, running, wait=10):
 
     status = 'start' if running else 'stop'
     try:
-        shell(['service', service_name, status])
-        sleep(wait)
-        print "Running %s and _service_running(service_name) %s " % (running, _service_running(service_name))
-        if running != _service_running(service_name):
-            print 'ERROR: Could not set service %s to %s' % (service_name, status)
-            raise Exception('ERROR: Could not set service %s to %s' % (service_name, status))
+        with _phase('service_%s %s' % (status, service_name)):
+            shell(['service', service_name, status])
+
+            # Wait until the pidfile and the process (and the http health probe for start) reached the wanted state
+            if running:
+                check = lambda: _service_running(service_name, quiet=True) and (port is None or _instance_ready(port))
+            else:
+                check = lambda: not _service_running(service_name, quiet=True)
+            transition_time = _wait_for(check, timeout=timeout)
+            if transition_time is False:
+                print 'ERROR: Could not set service %s to %s within %ss' % (service_name, status, timeout)
+                raise Exception('ERROR: Could not set service %s to %s' % (service_name, status))
+        print "Service %s %s done in %.1fs%s" % (service_name, status, transition_time,
+                                                  ' (http ready on port %s)' % port if running and port else '')
+        if running and port and conf:
+            _step_record(conf, 'service_start', transition_time)
         return True
     except:
         return False
 
 
+# Default number of host wide slots for heavy update steps (can be overwritten by ONLINE_TOOLS_MAX_<KIND> e.g. by
+# fleet-update.py). Every step that hits the database takes a 'postgres' slot after its own slot.
+_host_slot_limits = {
+    'update': 4,
+    'backup': 2,
+    'migration': 2,
+    'postgres': 3,
+}
+
+
+def _host_slot_limit(kind):
+    try:
+        return max(1, int(os.environ.get('ONLINE_TOOLS_MAX_' + kind.upper(), _host_slot_limits[kind])))
+    except ValueError:
+        return _host_slot_limits[kind]
+
+
+# Slots held by this process: a nested _host_slot() of the same kind does not wait for a second slot
+_host_slots_held = dict()
+
+
+@contextmanager
+def _host_slot(kind, timeout=10800, wait=True):
+    # Wait for one of the host wide slots of this kind: a slot is a flock()ed file in /var/lock/online_tools
+    # HINT: flock() locks are released by the kernel if the process dies so there are no stale slots
+    # HINT: With wait=False the step runs without a slot if all are in use (e.g. to restore a stopped production)
+    if _host_slots_held.get(kind):
+        _host_slots_held[kind] += 1
+        try:
+            yield
+        finally:
+            _host_slots_held[kind] -= 1
+        return
+    lock_dir = '/var/lock/online_tools' if os.access('/var/lock', os.W_OK) else pj('/tmp', 'online_tools_locks')
+    if not os.path.isdir(lock_dir):
+        try:
+            os.makedirs(lock_dir)
+        except OSError:
+            pass
+    limit = _host_slot_limit(kind)
+    start = time.time()
+    slot_file = None
+    while slot_file is None:
+        for slot in range(limit):
+            f = open(pj(lock_dir, '%s-%s.lock' % (kind, slot)), 'a+')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                slot_file = f
+                break
+            except IOError:
+                f.close()
+        if slot_file is None:
+            if not wait:
+                print "WARNING: All %s %s slots are in use. Running without a slot." % (limit, kind)
+                break
+            assert time.time() - start < timeout, "CRITICAL: No free %s slot after %ss!" % (kind, timeout)
+            if int(time.time() - start) % 60 == 0:
+                print "All %s %s slots are in use. Waiting for a free slot." % (limit, kind)
+            sleep(1)
+    if time.time() - start > 1:
+        print "Got %s slot after waiting %.1fs" % (kind, time.time() - start)
+    _host_slots_held[kind] = 1 if slot_file else 0
+    try:
+        yield
+    finally:
+        _host_slots_held[kind] = 0
+        if slot_file:
+            fcntl.flock(slot_file, fcntl.LOCK_UN)
+            slot_file.close()
+
+
+@contextmanager
+def _production_marker(conf):
+    # Marker file that exists while the production instance is stopped for its update (or restore)
+    # HINT: fleet-update.py does not kill an update on its timeout while this file exists
+    marker = pj(conf['backup_dir'], 'production.running')
+    with open(marker, 'w+') as f:
+        f.write(str(os.getpid()))
+    try:
+        yield
+    finally:
+        if os.path.isfile(marker):
+            os.remove(marker)
+
+
+@contextmanager
+def _update_lock(instance_dir):
+    # Take the update.lock of an instance for a maintenance step (e.g. prefetch or standby setup)
+    # Yields False if an update (or another maintenance step) holds the lock
+    lock_file = pj(instance_dir, 'update.lock')
+    try:
+        os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0660))
+    except OSError:
+        print 'WARNING: Update running (%s found)!' % lock_file
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        if os.path.isfile(lock_file):
+            os.remove(lock_file)
+
+
+@contextmanager
+def _phase(name):
+    # Measure wall-clock time, cpu time, peak memory of child processes and disk io of a phase of the update
+    # HINT: The report of all phases of this run is written by _phase_report()
+    before = usage()
+    result = 'failed'
+    try:
+        yield
+        result = 'done'
+    finally:
+        phase = OrderedDict([
+            ('name', name),
+            ('result', result),
+            ('start', datetime.datetime.fromtimestamp(before['wall']).isoformat()),
+        ])
+        phase.update(usage_delta(before, usage()))
+        _phase.report.append(phase)
+        print "Phase %s %s in %.1fs (cpu %.1fs, children cpu %.1fs, read %sMB, written %sMB)" % (
+            name, result, phase['wall'], phase['cpu_self'], phase['cpu_children'],
+            phase['read_bytes'] / 1048576, phase['write_bytes'] / 1048576)
+_phase.report = []
+
+
+def _phase_report(conf, success):
+    # Write the json report of all phases of this run (one file per run so runs can be diffed)
+    try:
+        report = OrderedDict([
+            ('instance', conf.get('instance', '')),
+            ('start_time', conf.get('start_time', '')),
+            ('success', bool(success)),
+            ('commit', conf.get('commit', '')),
+            ('latest_commit', conf.get('latest_commit', '')),
+            ('core', conf.get('core', '')),
+            ('latest_core', conf.get('latest_core', '')),
+            ('db_mb', conf.get('db_mb', '')),
+            ('filestore_mb', conf.get('filestore_mb', '')),
+            ('latest_core_import_before', conf.get('latest_core_import_before')),
+            ('latest_core_import_after', conf.get('latest_core_import_after')),
+            ('wall', round(sum(p['wall'] for p in _phase.report), 3)),
+            ('phases', _phase.report),
+            ('profiles', _resource_accounting.totals),
+        ])
+        report_file = pj(conf['backup_dir'], 'update_report-%s.json' % conf['start_time'])
+        if _write_file_atomic(report_file, json.dumps(report, indent=2)):
+            conf['update_report'] = report_file
+            print "Update report written to %s" % report_file
+    except Exception as e:
+        print "WARNING: Could not write the update report!%s" % pp(e)
+
+
 def _find_root_dir(path, tools_folder_name='online_tools', stop='/'):
     while path not in ['/', stop, ]:
         if tools_folder_name in os.listdir(path):
@@ -355,6 +866,7 @@ def _odoo_config(instance_path):
         config.read(configfile)
         cnf.update(dict(config.items('options')))
         cnf['config_file'] = configfile
+        cnf['config_options'] = config.options('options')
     else:
         cnf['config_file'] = False
         print 'WARNING: No config file found at: %s Using development defaults instead!' % instance_path
@@ -374,6 +886,9 @@ def _odoo_config(instance_path):
     cnf['restore_failed'] = status_file.get('restore_failed', 'False')
     cnf['update_failed'] = status_file.get('update_failed', 'False')
     cnf['no_update'] = status_file.get('no_update', 'False')
+    # Host facts for the recommended odoo options (written by the update, see _odoo_tuning_host())
+    cnf['tuning_instances'] = status_file.get('tuning_instances', '')
+    cnf['tuning_max_connections'] = status_file.get('tuning_max_connections', '')
     assert cnf['restore_failed'] == 'False', 'CRITICAL: Restore failed set in status.ini!'
 
     # instance.ini
@@ -382,6 +897,13 @@ def _odoo_config(instance_path):
     core.read(pj(instance_path, 'instance.ini'))
     core = dict(core.items('options'))
     cnf['core'] = core.get('core')
+    # Pages requested after a start to build the caches and asset bundles (see _warmup()) '' or 'False' to disable
+    cnf['warmup_urls'] = core.get('warmup_urls', '/web/login,/,/web/webclient/qweb')
+    # Pages compared between production and the dry-run with per page thresholds (see _compare_pages())
+    # HINT: With compare_gate = True (default) the update stops if the pages are different
+    cnf['compare_urls'] = core.get('compare_urls', '')
+    cnf['compare_threshold'] = core.get('compare_threshold', '0.9')
+    cnf['compare_gate'] = core.get('compare_gate', 'True')
 
     # ----- REGULAR START -----
     if cnf['production_server']:
@@ -447,7 +969,8 @@ def _odoo_config(instance_path):
     cnf['workers'] = cnf.get('workers', '0')
 
     # Commit Hash
-    cnf['commit'] = _git_get_hash(cnf['instance_dir'])
+    # HINT: Read HEAD from the git directory first to avoid a git process on every start
+    cnf['commit'] = _git_head(cnf['instance_dir']) or _git_get_hash(cnf['instance_dir'])
 
     # Startup Args
     cnf['startup_args'] = ['--addons-path=' + cnf['addons_path_csv'], ]
@@ -468,6 +991,546 @@ def _odoo_config(instance_path):
     return cnf
 
 
+def _preload_socket_dir(uid):
+    # Unix socket directory of the preloaders (see --preload) of a user: root uses /var/run, other users a private
+    # directory in /tmp (only usable by the same user)
+    return '/var/run/online_tools' if uid == 0 else '/tmp/online_tools_preload-%s' % uid
+
+
+def _preload_socket_trusted(socket_file, owner_uid):
+    # True if the socket and its directory belong to owner_uid and the directory is not writable by anyone else
+    # HINT: Otherwise any user could place a socket there and get the command line and environment of the client
+    try:
+        dir_stat = os.lstat(os.path.dirname(socket_file))
+        socket_stat = os.lstat(socket_file)
+    except OSError:
+        return False
+    return stat.S_ISDIR(dir_stat.st_mode) and dir_stat.st_uid == owner_uid and not dir_stat.st_mode & 0o022 \
+        and stat.S_ISSOCK(socket_stat.st_mode) and socket_stat.st_uid == owner_uid
+
+
+def _preload_socket(core, create=False):
+    # Returns the path of the unix socket of the preloader of a core and the user id of the preloader
+    # HINT: The client uses the socket of the root preloader or of a preloader of its own user
+    name = 'preload-%s.sock' % core
+    if not create:
+        for owner_uid in sorted(set([0, os.getuid()])):
+            socket_file = pj(_preload_socket_dir(owner_uid), name)
+            if os.path.exists(socket_file):
+                if _preload_socket_trusted(socket_file, owner_uid):
+                    return socket_file, owner_uid
+                print "WARNING: Preloader socket %s not trusted! It or its directory does not belong to user id " \
+                      "%s or the directory is writable by others." % (socket_file, owner_uid)
+        return False, None
+    socket_dir = _preload_socket_dir(os.getuid())
+    if not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir, 0o755 if os.getuid() == 0 else 0o700)
+    dir_stat = os.lstat(socket_dir)
+    assert stat.S_ISDIR(dir_stat.st_mode) and dir_stat.st_uid == os.getuid() and not dir_stat.st_mode & 0o022, \
+        'CRITICAL: Preloader socket directory %s is not owned by user id %s or is writable by others!' \
+        '' % (socket_dir, os.getuid())
+    return pj(socket_dir, name), os.getuid()
+
+
+def _preload_child(conn, uid, gid):
+    # Forked odoo instance: run odoo.main() as the user of the client with its command line, environment and cwd
+    # HINT: stdout and stderr are the socket so the client gets the output. The registry is not preloaded because it
+    #       needs database connections that can not be shared between processes.
+    code = 1
+    try:
+        os.setsid()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        request = _json_str(json.loads(conn.makefile('r').readline()))
+        if os.getuid() != uid:
+            os.initgroups(pwd.getpwuid(uid).pw_name, gid)
+            os.setresgid(gid, gid, gid)
+            os.setresuid(uid, uid, uid)
+        conn.sendall('pid %s\n' % os.getpid())
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        sys.stdout = os.fdopen(1, 'w', 0)
+        sys.stderr = os.fdopen(2, 'w', 0)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.chdir(request['cwd'])
+        sys.argv = request['argv']
+
+        # HINT: This process is a child of the preloader and not of the client: stop odoo if the client is gone
+        #       (EOF on the socket) like an odoo started by the client itself
+        def watch_client():
+            try:
+                while conn.recv(4096):
+                    pass
+            except socket.error:
+                pass
+            os.kill(os.getpid(), signal.SIGTERM)
+            sleep(60)
+            os.kill(os.getpid(), signal.SIGKILL)
+        watcher = threading.Thread(target=watch_client, name='preload_client')
+        watcher.daemon = True
+        watcher.start()
+
+        import odoo
+        odoo.main()
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+    except Exception as e:
+        print "CRITICAL: Preloaded odoo failed!%s" % pp(e)
+    finally:
+        os._exit(code)
+
+
+def _preload_serve(core_dir):
+    # Preloader of a core: import odoo once and fork a new odoo instance for every client (see _preload_start())
+    # HINT: Run it as root so it can start instances for all instance users. A client can only get a process that
+    #       runs with its own user id (SO_PEERCRED).
+    core = os.path.basename(core_dir.rstrip('/')).replace('online_', '', 1)
+    odoo_dir = pj(core_dir, 'odoo')
+    assert os.path.isdir(odoo_dir), 'CRITICAL: Odoo directory of core not found at %s' % odoo_dir
+    print "\n---------- PRELOADER for core %s ----------" % core
+    sys.path[0] = sys.argv[0] = odoo_dir
+    os.chdir(odoo_dir)
+    start = time.time()
+    import odoo
+    import openerp.addons.base
+    print "Imported odoo and the base addon in %.1fs" % (time.time() - start)
+
+    socket_file = _preload_socket(core, create=True)[0]
+    if os.path.exists(socket_file):
+        os.remove(socket_file)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_file)
+    os.chmod(socket_file, 0666)
+    server.listen(16)
+    print "Preloader of core %s is listening on %s" % (core, socket_file)
+
+    # HINT: The connection to the client is kept until the forked odoo exits to send its exit code to the client
+    clients = dict()
+    exited = dict()
+
+    def finish(child):
+        if child in clients and child in exited:
+            conn = clients.pop(child)
+            try:
+                conn.sendall(_preload_exit_marker + '%s\n' % exited.pop(child))
+            except socket.error:
+                pass
+            conn.close()
+
+    def reap(signum, frame):
+        try:
+            while True:
+                child, status = os.waitpid(-1, os.WNOHANG)
+                if not child:
+                    break
+                exited[child] = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+                finish(child)
+        except OSError:
+            pass
+    signal.signal(signal.SIGCHLD, reap)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    peercred = struct.Struct('3i')
+    try:
+        while True:
+            try:
+                conn, address = server.accept()
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            pid, uid, gid = peercred.unpack(conn.getsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', 17),
+                                                            peercred.size))
+            if os.getuid() != 0 and uid != os.getuid():
+                print "WARNING: Client pid %s with user id %s refused! The preloader can only start instances for " \
+                      "its own user id %s" % (pid, uid, os.getuid())
+                conn.close()
+                continue
+            child = os.fork()
+            if child == 0:
+                server.close()
+                # HINT: The connections of the other clients must only be open in the preloader (EOF for them)
+                for other in clients.values():
+                    other.close()
+                _preload_child(conn, uid, gid)
+            print "Forked odoo pid %s for client pid %s (user id %s)" % (child, pid, uid)
+            clients[child] = conn
+            finish(child)
+    finally:
+        server.close()
+        if os.path.exists(socket_file):
+            os.remove(socket_file)
+
+
+# Last line the preloader sends to the client: the exit code of the forked odoo
+_preload_exit_marker = '\0online_tools_exit '
+
+
+def _preload_start(conf):
+    # Start odoo from the preloader of the core of this instance and proxy its output and our signals
+    # Returns the exit code of odoo or False if there is no preloader so odoo must be started in this process
+    socket_file, owner_uid = _preload_socket(conf['core'])
+    if not socket_file:
+        return False
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_file)
+        # HINT: The preloader must still be the process of the owner of the socket (not one that replaced it)
+        peercred = struct.Struct('3i')
+        server_pid, server_uid, server_gid = peercred.unpack(
+            client.getsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', 17), peercred.size))
+        assert server_uid == owner_uid, 'Preloader pid %s runs as user id %s and not as %s' % (server_pid, server_uid,
+                                                                                                owner_uid)
+        client.sendall(json.dumps({'argv': sys.argv, 'env': dict(os.environ), 'cwd': os.getcwd()}) + '\n')
+        reply = client.makefile('r', 0).readline()
+        assert reply.startswith('pid '), 'No pid from preloader: %s' % reply
+        child = int(reply.split()[1])
+    except Exception as e:
+        print "WARNING: Could not start odoo from the preloader %s! Starting odoo in this process.%s" \
+              "" % (socket_file, pp(e))
+        return False
+    print "Odoo started by the preloader %s with pid %s" % (socket_file, child)
+
+    # HINT: Our pid is the one in the pid file of the service so we forward the signals to the forked odoo
+    def forward(signum, frame):
+        try:
+            os.kill(child, signum)
+        except OSError:
+            pass
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT, signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, forward)
+
+    # Copy the output of odoo until it exits
+    # HINT: Everything after the last NUL byte is held back until the end because it may be the exit marker
+    held = ''
+    while True:
+        try:
+            data = client.recv(65536)
+        except socket.error as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if not data:
+            break
+        held += data
+        if '\0' in held:
+            sys.stdout.write(held[:held.rindex('\0')])
+            held = held[held.rindex('\0'):]
+        else:
+            sys.stdout.write(held)
+            held = ''
+    client.close()
+    exit_code = re.match(re.escape(_preload_exit_marker) + r'(\d+)\n$', held)
+    if not exit_code:
+        sys.stdout.write(held)
+        print "ERROR: No exit code from the preloader %s for odoo pid %s!" % (socket_file, child)
+        return 1
+    print "Odoo pid %s started by the preloader exited with %s" % (child, exit_code.group(1))
+    return int(exit_code.group(1))
+
+
+def _fetch_url(url, headers, timeout=120):
+    # Returns url, http status (or the error), size, seconds and the body of a GET request (see _warmup())
+    start = time.time()
+    try:
+        response = urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=timeout)
+        body = response.read()
+        status = response.getcode()
+    except urllib2.HTTPError as e:
+        body, status = '', e.code
+    except Exception as e:
+        body, status = '', repr(e)
+    return url, status, len(body), time.time() - start, body
+
+
+def _warmup(conf, workers=4):
+    # Request the warmup_urls of instance.ini and the asset bundles linked by them concurrently so the registry caches,
+    # the qweb templates and the asset bundles are built before the first user arrives
+    port = _instance_port(conf)
+    urls = [u.strip() for u in conf.get('warmup_urls', '').split(',') if u.strip() and u.strip() != 'False']
+    if not port or not urls:
+        return False
+    print "\nWarm-up of %s" % ', '.join(urls)
+    base_url = 'http://127.0.0.1:%s' % port
+    # HINT: The header is used by dbfilter_from_header to select the database of the instance
+    headers = {'X-Odoo-dbfilter': '^%s$' % conf['db_name']}
+    start = time.time()
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(lambda u: _fetch_url(base_url + u, headers), urls)
+        assets = sorted(set(a for r in results
+                            for a in re.findall(r'(?:href|src)="(/web/(?:css|js|content)/[^"]+)"', r[4])))
+        results += pool.map(lambda a: _fetch_url(base_url + a, headers), assets)
+    finally:
+        pool.close()
+        pool.join()
+    conf['warmup_duration'] = '%.1f' % (time.time() - start)
+    for url, status, size, duration, body in results:
+        print "Warm-up %-6s %8.2fs %10s bytes %s" % (status, duration, size, url)
+    failed = [r[0] for r in results if r[1] != 200]
+    if failed:
+        print "WARNING: Warm-up requests failed: %s" % ', '.join(failed)
+    print "Warm-up of %s urls and %s asset bundles done in %ss" % (len(urls), len(assets), conf['warmup_duration'])
+    return not failed
+
+
+def _first_request_timer(conf, start_time):
+    # Print the time from the start of start.py until odoo answers the first request and run the warm-up
+    # HINT: Runs in a background thread
+    port = _instance_port(conf)
+    if not port:
+        return False
+
+    def timer():
+        if _wait_for(lambda: _instance_ready(port, timeout=2), timeout=1800) is not False:
+            conf['time_to_first_request'] = '%.1f' % (time.time() - start_time)
+            print "Time to first request: %ss" % conf['time_to_first_request']
+            try:
+                _warmup(conf)
+            except Exception as e:
+                print "WARNING: Warm-up failed!%s" % pp(e)
+    thread = threading.Thread(target=timer, name='first_request_timer')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _host_memory_mb():
+    # Total memory of the host in MB from /proc/meminfo or False
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return False
+
+
+def _odoo_option_set(cnf, key, option):
+    # True if the odoo option is set in server.conf or on the command line
+    return key in cnf.get('config_options', []) or any(a == option or a.startswith(option + '=') for a in sys.argv)
+
+
+def _odoo_longpolling_ready(cnf):
+    # With workers > 0 odoo serves /longpolling in a separate gevent process (openerp-gevent) on longpolling_port
+    # (default 8072 for all instances of the host). Returns the reason why workers can not be used or ''
+    if not _odoo_option_set(cnf, 'longpolling_port', '--longpolling-port'):
+        return 'no longpolling_port in server.conf (the default 8072 is the same for all instances)'
+    for module in ('gevent', 'psycogreen'):
+        try:
+            imp.find_module(module)
+        except ImportError:
+            return 'python module %s for the longpolling process not found' % module
+    return ''
+
+
+def _odoo_tuning_host(cnf):
+    # Number of instances of the host and max_connections of postgres for _odoo_tuning()
+    # HINT: Both need a directory listing or a subprocess: they are computed by the update and stored in status.ini
+    try:
+        instances = [i for i in _find_instances(cnf['root_dir'])
+                     if not cnf['production_server'] or _service_exists(os.path.basename(i))]
+        instances = max(1, len(instances))
+    except Exception as e:
+        print "WARNING: Could not count the instances of this host!%s" % pp(e)
+        instances = 1
+    try:
+        max_connections = int(_psql(cnf['db_url'], 'SHOW max_connections;', timeout=10))
+    except Exception as e:
+        max_connections = 100
+        print "WARNING: Could not read max_connections from postgres! Using %s%s" % (max_connections, pp(e))
+    return OrderedDict([('tuning_instances', instances), ('tuning_max_connections', max_connections)])
+
+
+def _odoo_tuning(cnf, heavy_share=0.2, light_mb=150, heavy_mb=1024, memory_share=0.75, reserved_connections=10):
+    # Returns the recommended odoo options {option: value} for this instance and prints the reasoning
+    # HINT: Based on the odoo deployment guide: 2 * cpus + 1 workers per host, ~150MB for a light and ~1GB for a heavy
+    #       worker where ~20% of the requests are heavy. The host resources are shared equally by all instances.
+    # HINT: memory_share is the part of the memory for odoo (the rest is for postgres and the os) and
+    #       reserved_connections are the postgres connections kept free for superusers, backups and psql
+    print "\nCompute workers, memory limits and db_maxconn for this host:"
+    cpus = multiprocessing.cpu_count()
+    memory_mb = _host_memory_mb()
+    if not memory_mb:
+        memory_mb = 2048
+        print "WARNING: Could not read the memory of the host! Using %sMB" % memory_mb
+    instances = int(cnf['tuning_instances'])
+    max_connections = int(cnf['tuning_max_connections'])
+    print "Host: %s cpus, %sMB memory, %s instances, postgres max_connections %s" \
+          "" % (cpus, memory_mb, instances, max_connections)
+
+    # Workers: limited by the cpus and by the memory share of this instance
+    cpu_workers = max(1, (2 * cpus + 1) // instances)
+    worker_mb = int(heavy_share * heavy_mb + (1 - heavy_share) * light_mb)
+    instance_mb = int(memory_mb * memory_share / instances)
+    memory_workers = max(1, instance_mb // worker_mb)
+    workers = min(cpu_workers, memory_workers)
+    print "workers = %s: min(%s by cpu = (2 * %s cpus + 1) / %s instances, %s by memory = %sMB per instance / %sMB " \
+          "per worker)" % (workers, cpu_workers, cpus, instances, memory_workers, instance_mb, worker_mb)
+
+    # The workers of server.conf (or of the command line) are used if set there
+    if _odoo_option_set(cnf, 'workers', '--workers'):
+        configured = [a.split('=', 1)[1] for a in sys.argv if a.startswith('--workers=')] or \
+                     [sys.argv[i + 1] for i, a in enumerate(sys.argv[:-1]) if a == '--workers']
+        workers = int(configured[-1] if configured else cnf['workers'])
+        print "workers = %s: set in server.conf or on the command line" % workers
+    else:
+        not_ready = _odoo_longpolling_ready(cnf)
+        if not_ready:
+            print "workers = 0: %s" % not_ready
+            workers = 0
+
+    # Memory limits: the memory share of this instance for all odoo processes (workers, cron and longpolling)
+    # HINT: Never below the memory of a heavy worker or every heavy request would kill its worker
+    processes = workers + int(cnf.get('max_cron_threads', 2)) + 1 if workers else 1
+    limit_memory_hard = max(heavy_mb, min(2560, instance_mb // processes))
+    limit_memory_soft = limit_memory_hard * 4 // 5
+    print "limit_memory_hard = %sMB: %sMB per instance / %s processes (workers + cron + longpolling) between %sMB " \
+          "and 2560MB, limit_memory_soft = %sMB (80%%)" % (limit_memory_hard, instance_mb, processes, heavy_mb,
+                                                          limit_memory_soft)
+
+    # Database connections: every odoo process has its own connection pool of db_maxconn connections
+    # HINT: With workers = 0 all threads (http and cron) of the only odoo process share one pool
+    instance_connections = max(0, max_connections - reserved_connections) // instances
+    db_maxconn = max(2, min(64, instance_connections // processes) if workers else instance_connections)
+    print "db_maxconn = %s: (%s max_connections - %s reserved) / %s instances / %s processes%s" \
+          "" % (db_maxconn, max_connections, reserved_connections, instances, processes,
+                ' between 2 and 64' if workers else '')
+
+    return OrderedDict([('workers', workers),
+                        ('limit_memory_soft', limit_memory_soft * 1024 * 1024),
+                        ('limit_memory_hard', limit_memory_hard * 1024 * 1024),
+                        ('db_maxconn', db_maxconn)])
+
+
+def _odoo_tuning_args(cnf):
+    # Startup args for the recommended options that are not set in server.conf or on the command line
+    # HINT: Only applied on production servers. Development starts keep workers = 0 for debugging.
+    # HINT: The number of instances and max_connections are read from status.ini (they are stored by every update).
+    #       Only if they are missing they are computed once and stored in status.ini.
+    if not cnf['production_server']:
+        print "Development server found! Recommended odoo options skipped."
+        return []
+    if not (cnf.get('tuning_instances') and cnf.get('tuning_max_connections')):
+        cnf.update(_odoo_tuning_host(cnf))
+        try:
+            status_ini = ConfigParser.SafeConfigParser()
+            status_ini.read(cnf['status_file'])
+            if not status_ini.has_section('options'):
+                status_ini.add_section('options')
+            for key in ('tuning_instances', 'tuning_max_connections'):
+                status_ini.set('options', key, str(cnf[key]))
+            with open(cnf['status_file'], 'w+') as writefile:
+                status_ini.write(writefile)
+        except Exception as e:
+            print "WARNING: Could not write the host facts to %s!%s" % (cnf['status_file'], pp(e))
+    tuning = _odoo_tuning(cnf)
+    options = {'workers': '--workers', 'limit_memory_soft': '--limit-memory-soft',
+               'limit_memory_hard': '--limit-memory-hard', 'db_maxconn': '--db_maxconn'}
+    args = []
+    for key, value in tuning.iteritems():
+        option = options[key]
+        if _odoo_option_set(cnf, key, option):
+            print "%s = %s skipped: set in server.conf or on the command line" % (key, value)
+            continue
+        args += [option, str(value)]
+    print "Recommended options applied: %s" % ' '.join(args)
+    return args
+
+
+def _json_str(data):
+    # json.load() returns unicode strings but sys.argv and the rest of the config use (byte) strings
+    if isinstance(data, dict):
+        return dict((_json_str(k), _json_str(v)) for k, v in data.iteritems())
+    if isinstance(data, list):
+        return [_json_str(i) for i in data]
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
+
+
+def _launch_plan_key(instance_path):
+    # Everything the config of a regular start depends on: the config files, the init script (= production server),
+    # the commit of the instance repo, the user (= root rights), the working directory and the command line
+    # HINT: Only stat() calls and the git HEAD files are used - no subprocess and no directory listing
+    configfile = sys.argv[sys.argv.index('-c') + 1] if '-c' in sys.argv else pj(instance_path, 'server.conf')
+    files = []
+    # HINT: start.py itself is part of the key so a new version of online_tools computes a new launch plan
+    for path in (configfile, pj(instance_path, 'instance.ini'), pj(instance_path, 'status.ini'),
+                 pj('/etc/init.d', os.path.basename(instance_path)), os.path.abspath(__file__)):
+        try:
+            files.append([path, os.stat(path).st_mtime])
+        except OSError:
+            files.append([path, None])
+    return {'files': files,
+            'head': _git_head(instance_path),
+            'uid': os.getuid(),
+            'cwd': os.getcwd(),
+            'argv': sys.argv[1:]}
+
+
+def _launch_plan_file(instance_path):
+    return pj(_git_dir(instance_path), 'online_tools', 'launch_plan.json')
+
+
+def _launch_plan(instance_path, key):
+    # Returns the config of the last regular start if nothing it depends on has changed or False
+    plan_file = _launch_plan_file(instance_path)
+    if not key['head'] or not os.path.isfile(plan_file):
+        return False
+    # HINT: A plan readable by others (written by an older version) is computed and written again with mode 0600
+    if os.stat(plan_file).st_mode & 0o077:
+        return False
+    try:
+        with open(plan_file, 'r') as f:
+            plan = json.load(f)
+    except Exception as e:
+        print "WARNING: Could not read the launch plan %s!%s" % (plan_file, pp(e))
+        return False
+    # HINT: json turns tuples into lists and str into unicode but both compare equal to the fresh key
+    if plan.get('key') != key:
+        return False
+    return _json_str(plan)
+
+
+def _launch_plan_write(instance_path, key, argv_added, cnf):
+    # Store the config of a regular start together with the key it is valid for
+    if not key['head'] or not _git_cache_file(instance_path, 'launch_plan.json'):
+        return False
+    # ATTENTION: The config contains the database password (db_password, db_url): only the user of this start (the
+    #            uid of the key) can read the plan
+    plan = {'key': key, 'argv_added': argv_added, 'config': cnf}
+    return _write_file_atomic(_launch_plan_file(instance_path), json.dumps(plan, indent=2), mode=0o600)
+
+
+def _launch_plan_apply(plan):
+    # Replay the side effects of _odoo_config() for the cached config
+    cnf = plan['config']
+    cnf['start_time'] = str(time.strftime('%Y-%m-%d_%H-%M-%S'))
+    if cnf['production_server']:
+        sys.stdout = open(cnf['update_log_file'], 'a+', buffering=0)
+        sys.stderr = open(cnf['update_log_file'], 'a+', buffering=0)
+    sys.argv += plan['argv_added']
+    return cnf
+
+
+def _odoo_latest_db_config(cnf):
+    # Database and directories of the dry-run (and standby) instance
+    latest = dict()
+    latest['latest_instance'] = cnf['instance'] + '_update'
+    latest['latest_db_name'] = cnf['db_name'] + '_update'
+    latest['latest_db_url'] = 'postgresql://' + cnf['db_user'] + ':' + cnf['db_password'] + \
+                              '@' + cnf['db_host'] + ':' + cnf['db_port'] + '/' + latest['latest_db_name']
+    latest['latest_inst_dir'] = pj(cnf['instance_dir'], 'update/' + latest['latest_db_name'])
+    latest['latest_data_dir'] = pj(latest['latest_inst_dir'], 'data_dir')
+    return latest
+
+
 def _odoo_update_config(cnf):
     # ----- UPDATE CHECK -----
     if '--update' in sys.argv:
@@ -488,8 +1551,9 @@ def _odoo_update_config(cnf):
             assert counter <= 20, 'CRITICAL: Concurrent update still running after 20 min! Please check %s .' \
                                   '' % cnf['update_lock_file']
 
-        # Check if more than two other updates are already running on this server
-        print "Check if more than two other updates are already running on this server"
+        # Check if too many other updates are already running on this server
+        max_updates = _host_slot_limit('update')
+        print "Check if more than %s other updates are already running on this server" % (max_updates - 1)
         # Find all update.lock files in /opt/online
         delay_update = True
         delay_update_counter = 0
@@ -500,12 +1564,12 @@ def _odoo_update_config(cnf):
             for root, subFolders, files in os.walk(start_root_dir):
                 if 'update.lock' in files:
                     update_lock_file_counter = update_lock_file_counter + 1
-            if update_lock_file_counter > 3:
-                print "More than two other updates are currently running! Retry in 60 seconds!"
+            if update_lock_file_counter >= max_updates:
+                print "More than %s other updates are currently running! Retry in 60 seconds!" % (max_updates - 1)
                 delay_update_counter = delay_update_counter + 1
                 sleep(60)
             else:
-                print "Less than two other updates are currently running! Continue with this update!"
+                print "Less than %s other updates are currently running! Continue with this update!" % max_updates
                 delay_update = False
 
         # Stop update if ...
@@ -516,6 +1580,9 @@ def _odoo_update_config(cnf):
             return cnf
         cnf['run_update'] = True
 
+        # Promote the migrated dry-run database to production instead of updating production again
+        cnf['promote_dry_run'] = '--promote' in sys.argv
+
         # Create update lock file (Starting Update now)
         with open(cnf['update_lock_file'], 'a+'):
             assert os.path.isfile(cnf['update_lock_file']), 'CRITICAL: Could not create update_lock_file %s' \
@@ -528,14 +1595,13 @@ def _odoo_update_config(cnf):
                 print "Could not change rights for %s" % cnf['update_lock_file']
                 pass
 
-        # Database
-        cnf['latest_db_name'] = cnf['db_name'] + '_update'
-        cnf['latest_db_url'] = 'postgresql://' + cnf['db_user'] + ':' + cnf['db_password'] + \
-                               '@' + cnf['db_host'] + ':' + cnf['db_port'] + '/' + cnf['latest_db_name']
+        # Database and directories
+        cnf.update(_odoo_latest_db_config(cnf))
 
-        # Directories
-        cnf['latest_inst_dir'] = pj(cnf['instance_dir'], 'update/' + cnf['latest_db_name'])
-        cnf['latest_data_dir'] = pj(cnf['latest_inst_dir'], 'data_dir')
+        # Use the standby database for the dry-run if it is kept in sync by logical replication
+        if cnf['promote_dry_run'] and _standby_ready(cnf):
+            print "WARNING: --promote is not possible with a standby database! Promotion disabled!"
+            cnf['promote_dry_run'] = False
 
         # Addons paths
         cnf['latest_addons_instance_dir'] = pj(cnf['latest_inst_dir'], 'addons')
@@ -546,7 +1612,11 @@ def _odoo_update_config(cnf):
         # HINT: Must be run as the instance user because of git ssh!
         print "\n---- Get latest %s repository for update check." % cnf['instance']
         if cnf['production_server'] or not os.path.exists(cnf['latest_inst_dir']):
-            _git_latest(cnf['latest_inst_dir'], cnf['instance_repo'], user_name=cnf['instance'], pull=True)
+            with _phase('git_latest_instance'):
+                git_start = time.time()
+                _git_latest(cnf['latest_inst_dir'], cnf['instance_repo'], user_name=cnf['instance'], pull=True,
+                            timeout=_step_timeout(cnf, 'git', 120))
+                _step_record(cnf, 'git', time.time() - git_start)
         else:
             print "WARNING: Development server found! Get latest repository for update check skipped!"
         print "---- Get latest %s repository done" % cnf['instance']
@@ -577,7 +1647,8 @@ def _odoo_update_config(cnf):
 
         # Get cores before we load core.ini
         try:
-            _get_cores(cnf)
+            with _phase('cores'):
+                _get_cores(cnf)
         except Exception as e:
             _finish_update(cnf, error="CRITICAL: Could not get cores!" + pp(e))
 
@@ -642,6 +1713,8 @@ def _odoo_update_config(cnf):
                 'xmlrpc_port': str(int(cnf.get('xmlrpc_port', 8000)) + 10),
                 'xmlrpcs': 'True',
                 'xmlrpcs_port': str(int(cnf.get('xmlrpcs_port', 8001)) + 10),
+                # HINT: No cron jobs in the dry-run instance started for the compare of the webpages
+                'max_cron_threads': '0',
             }
             if cnf['production_server']:
                 values.update({'logfile': '/var/log/online/' + cnf['instance'] + '/' + cnf['latest_instance'] + '.log'})
@@ -657,6 +1730,163 @@ def _odoo_update_config(cnf):
 
 
 @retry(Exception, tries=2)
+def _rights_full_pass(path, timeout=1800):
+    # Set owner root:root and o=rX for all files and directories in path that do not have them already
+    # HINT: find only changes the entries with wrong rights (no metadata writes for correct ones) and the top level
+    #       entries of path are done in parallel
+    wrong_owner = ['(', '!', '-user', 'root', '-o', '!', '-group', 'root', ')',
+                   '-exec', 'chown', '-h', 'root:root', '{}', '+']
+    # o=rX: others can read everything, can not write and can execute directories and files executable by anyone
+    wrong_mode = ['(', '!', '-perm', '-o=r', '-o', '-perm', '/o=w',
+                  '-o', '(', '-type', 'd', '!', '-perm', '-o=x', ')',
+                  '-o', '(', '-type', 'f', '-perm', '/u=x,g=x', '!', '-perm', '-o=x', ')', ')',
+                  '!', '-type', 'l', '-exec', 'chmod', 'o=rX', '{}', '+']
+
+    def fix(entry):
+        shell(['find', entry] + wrong_owner, timeout=timeout, profile='files')
+        shell(['find', entry] + wrong_mode, timeout=timeout, profile='files')
+
+    # The directory itself and then all its entries in parallel
+    shell(['find', path, '-maxdepth', '0'] + wrong_owner, timeout=60)
+    shell(['find', path, '-maxdepth', '0'] + wrong_mode, timeout=60)
+    entries = [pj(path, e) for e in os.listdir(path)]
+    pool = ThreadPool(max(2, min(8, multiprocessing.cpu_count())))
+    try:
+        pool.map(fix, entries)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _rights_fix_paths(path, rel_paths, chunk_size=500):
+    # Set owner root:root and o=rX for the given files (and their parent directories) in chunks
+    targets = set()
+    for rel_path in rel_paths:
+        while rel_path:
+            targets.add(pj(path, rel_path))
+            rel_path = os.path.dirname(rel_path)
+    targets = sorted(t for t in targets if os.path.lexists(t))
+    for i in range(0, len(targets), chunk_size):
+        chunk = targets[i:i + chunk_size]
+        shell(['chown', '-h', 'root:root', '--'] + chunk, timeout=600, profile='files')
+        no_links = [t for t in chunk if not os.path.islink(t)]
+        if no_links:
+            shell(['chmod', 'o=rX', '--'] + no_links, timeout=600, profile='files')
+    return len(targets)
+
+
+def _set_core_rights(path):
+    # Make the core owned by root and readable (usable) by all instance users
+    # HINT: The commit of the last successful pass is stored in the git cache of the core. If it is known only the
+    #       files changed since this commit are fixed, else a (parallel) full pass is done.
+    start = time.time()
+    marker = _git_cache_file(path, 'rights_commit')
+    head = shell(['git', 'rev-parse', 'HEAD'], cwd=path).strip()
+    done_commit = ''
+    if marker and os.path.isfile(marker):
+        with open(marker, 'r') as f:
+            done_commit = f.read().strip()
+
+    if done_commit == head:
+        print "Rights for core %s already set for commit %s" % (path, head)
+        return True
+
+    try:
+        if not done_commit:
+            raise Exception("No rights marker found")
+        added_submodules = []
+        changed = _git_diff_paths(path, done_commit, head, added_submodules=added_submodules)
+        fixed = _rights_fix_paths(path, changed)
+        for submodule in added_submodules:
+            _rights_full_pass(pj(path, submodule))
+        print "Rights for core %s set for %s changed paths and %s new submodules in %.1fs" % (
+            path, fixed, len(added_submodules), time.time() - start)
+    except Exception as e:
+        print "Full pass to set the rights for core %s (%s)" % (path, str(e).strip())
+        _rights_full_pass(path)
+        print "Rights for core %s set by full pass in %.1fs" % (path, time.time() - start)
+
+    if marker:
+        _write_file_atomic(marker, head)
+    return True
+
+
+def _core_manifest(core_dir):
+    # Manifest of a provisioned core: release tag, commit, submodule commits and a checksum of the file listing
+    # HINT: The listing ('git ls-files -s' of the core and of all submodules) contains the blob SHA1 of every file
+    commit = shell(['git', 'rev-parse', 'HEAD'], cwd=core_dir).strip()
+    tag = shell(['git', 'describe', '--tags', '--exact-match', '--match=o8r*'], cwd=core_dir).strip()
+    # HINT: More than one release tag may point to the same commit
+    tags = shell(['git', 'tag', '--points-at', 'HEAD', '--list', 'o8r*'], cwd=core_dir).split()
+    submodules = OrderedDict()
+    for line in shell(['git', 'submodule', 'status', '--recursive'], cwd=core_dir).splitlines():
+        if line.strip():
+            submodules[line[1:].split()[1]] = line[1:].split()[0]
+    checksum = hashlib.sha1()
+    file_count = 0
+    for repo_path in [''] + submodules.keys():
+        listing = shell(['git', 'ls-files', '-s', '-z'], cwd=pj(core_dir, repo_path))
+        for entry in listing.split('\0'):
+            if entry and not entry.startswith('160000 '):
+                checksum.update(repo_path + '\0' + entry + '\0')
+                file_count += 1
+    return OrderedDict([('tag', tag), ('tags', tags), ('commit', commit), ('submodules', submodules),
+                        ('file_count', file_count),
+                        ('listing_sha1', checksum.hexdigest()),
+                        ('created', datetime.datetime.now().isoformat())])
+
+
+def _core_manifest_write(core_dir, **info):
+    # Write the manifest of a core at the end of its provisioning (completion marker of the core)
+    # HINT: info is added to the manifest e.g. the import benchmark of _prepare_core()
+    manifest_file = _git_cache_file(core_dir, 'core_manifest.json')
+    manifest = _core_manifest(core_dir)
+    manifest.update(sorted(info.items()))
+    if manifest_file and _write_file_atomic(manifest_file, json.dumps(manifest, indent=2)):
+        print "Core manifest written to %s (tag %s, %s files)" % (manifest_file, manifest['tag'],
+                                                                  manifest['file_count'])
+    return manifest
+
+
+def _core_manifest_tag(manifest, core_tag):
+    # True if the release tag core_tag is one of the tags of the core manifest (exact match: o8r1 is not o8r10)
+    return bool(core_tag) and core_tag in (manifest.get('tags') or [manifest.get('tag')])
+
+
+def _core_manifest_valid(core_dir, core_tag):
+    # A core can be reused if its manifest is for the wanted tag, HEAD is still the commit of the manifest and the
+    # repo and its submodules are clean (nothing was changed in the core since its provisioning)
+    # HINT: Cores provisioned before the core manifest was introduced have none. They are reused (and get a manifest)
+    #       if they are clean and at the tag so the live cores are not provisioned again.
+    try:
+        with open(pj(_git_dir(core_dir), 'online_tools', 'core_manifest.json'), 'r') as f:
+            manifest = json.load(f)
+    except (IOError, OSError) as e:
+        print "No core manifest found for %s: %s" % (core_dir, repr(e))
+        state = _git_state(core_dir, core_tag)
+        if not (state['at_target'] and state['clean'] and state['submodules_ok']):
+            print "WARNING: Core %s without manifest is not clean or not at %s!" % (core_dir, core_tag)
+            return False
+        try:
+            return _core_manifest_tag(_core_manifest_write(core_dir), core_tag)
+        except Exception as e:
+            print "WARNING: Could not write the core manifest for %s!%s" % (core_dir, pp(e))
+            return False
+    except ValueError as e:
+        print "No valid core manifest found for %s: %s" % (core_dir, repr(e))
+        return False
+    head = _git_head(core_dir)
+    print "Core manifest of %s: tag %s commit %s (HEAD %s)" % (core_dir, manifest.get('tag'),
+                                                               manifest.get('commit'), head)
+    if not _core_manifest_tag(manifest, core_tag) or manifest.get('commit') != head:
+        return False
+    state = _git_state(core_dir, core_tag)
+    if not (state['at_target'] and state['clean'] and state['submodules_ok']):
+        print "WARNING: Core %s is not clean or not at %s!" % (core_dir, core_tag)
+        return False
+    return True
+
+
 def _get_cores(conf):
 
     def _set_rights(configuration, all_paths):
@@ -666,10 +1896,8 @@ def _get_cores(conf):
                 if configuration['root_dir'] in path:
                     try:
                         print "Set correct user and rights for core in path %s" % path
-                        shell(['chown', '-R', 'root:root', path], cwd=path, timeout=60)
-                        # Make sure others can read(use) the core and its files too
                         # HINT: This should be ok already in the core in Github!
-                        shell(['chmod', '-R', 'o=rX', path], cwd=path, timeout=60)
+                        _set_core_rights(path)
                     except (Exception, subprocess32.TimeoutExpired) as e:
                         print 'ERROR: Set user and rights failed! Retcode %s !' % pp(e)
 
@@ -726,33 +1954,13 @@ def _get_cores(conf):
             print "Check if we can skipp the core update"
             if os.path.exists(conf['latest_core_dir']) and not os.path.isfile(core_copy_lock):
                 if os.path.exists(pj(conf['latest_core_dir'], '.git')):
-                    # Check if the tag is correct
-                    print "Check release tag is %s in %s" % (conf['latest_core'], conf['latest_core_dir'])
-                    try:
-                        core_tag = shell(['git', '-C', conf['latest_core_dir'],
-                                          'describe', '--tags', '--exact-match', '--match=o8r*'])
-                        print "Commit tag in latest core dir: %s" % core_tag
-                        if not core_tag:
-                            raise Exception("Core Tag not found!")
-                    except Exception as e:
-                        core_tag = 'exception_not_found'
-                        print "WARNING: Could not get core tag!: %s\n" % repr(e)
-
-                    # Check that the latest_core_dir size is at least 600 MB
-                    print "Check core size"
-                    if core_tag and conf['latest_core'] in core_tag:
-                        try:
-                            repo_size = shell(['du', '-sm', conf['latest_core_dir']])
-                            repo_size = int(repo_size.split()[0])
-                            print "Latest repository size in MB: %s" % repo_size
-                            if repo_size > 600:
-                                print "Latest core repository seems to exists! Skipping Core Update!"
-                                _set_rights(conf, paths)
-                                return True
-                        except Exception as e:
-                            print "WARNING: Could not determine size of latest repository folder %s!\n%s" \
-                                  "" % (conf['latest_core_dir'], repr(e))
-                    # Check if the commit matches
+                    # Check the manifest written at the end of the core provisioning
+                    print "Check core manifest for release tag %s in %s" % (conf['latest_core'],
+                                                                            conf['latest_core_dir'])
+                    if _core_manifest_valid(conf['latest_core_dir'], conf['latest_core']):
+                        print "Latest core repository exists! Skipping Core Update!"
+                        _set_rights(conf, paths)
+                        return True
 
             # Create the latest_core_dir folder
             print "Check directory for the latest core %s" % conf['latest_core_dir']
@@ -813,7 +2021,7 @@ def _get_cores(conf):
                 print "Copy current core %s to %s" % (conf['core_dir'], conf['latest_core_dir'])
                 # ATTENTION: "/." is necessary to copy also all hidden files and to not create the source folder
                 #            in the target directory!
-                shell(['cp', '-rpf', conf['core_dir']+'/.', conf['latest_core_dir']])
+                shell(['cp', '-rpf', conf['core_dir']+'/.', conf['latest_core_dir']], profile='files')
 
             # get latest core
             print "Checkout, clean and reset target core %s for commit %s" % (conf['latest_core_dir'],
@@ -821,12 +2029,16 @@ def _get_cores(conf):
             _git_latest(conf['latest_core_dir'], conf['core_repo'], commit=conf['latest_core'])
 
             # Check the latest core tag
-            print "Check the latest core commit tag"
-            core_tag = shell(['git', '-C', conf['latest_core_dir'],
-                              'describe', '--tags', '--exact-match', '--match=o8r*'])
-            print "Commit tag in latest core dir: %s" % core_tag
-            assert core_tag and conf['latest_core'] in core_tag, "Release tag not correct in %s!" \
-                                                                 "" % conf['latest_core_dir']
+            # Compile the core (as root) before the rights are set and the core is marked as complete
+            _prepare_core(conf, conf['latest_core_dir'])
+
+            print "Check the latest core commit tag and write the core manifest"
+            core_manifest = _core_manifest_write(conf['latest_core_dir'],
+                                                 import_before=conf.get('latest_core_import_before'),
+                                                 import_after=conf.get('latest_core_import_after'))
+            print "Commit tags in latest core dir: %s" % core_manifest['tags']
+            assert _core_manifest_tag(core_manifest, conf['latest_core']), "Release tag not correct in %s!" \
+                                                                           "" % conf['latest_core_dir']
 
             # Delete the core_copy_lock file
             print "Core successfully created! "
@@ -844,6 +2056,166 @@ def _get_cores(conf):
     return True
 
 
+def _compile_dir(directory):
+    # Compile the python files of one directory (not its subdirectories) for _compile_core()
+    # HINT: compile_dir() returns 0 if any file could not be compiled (e.g. python3 only files in libs)
+    try:
+        return compileall.compile_dir(directory, maxlevels=0, quiet=1)
+    except Exception as e:
+        print "WARNING: Could not compile %s!%s" % (directory, pp(e))
+        return False
+
+
+def _compile_core(core_dir):
+    # Compile the python files of a core so the first start after the update does not have to do it
+    # HINT: The core is owned by root and read-only for the instance users so they can not write .pyc files: without
+    #       this every start of an instance would compile all imported files again
+    # HINT: Every directory is one job so no two processes ever write the same .pyc file
+    print "Compile python bytecode for core %s" % core_dir
+    start = time.time()
+    directories = []
+    for root, dirs, files in os.walk(core_dir, followlinks=True):
+        dirs[:] = [d for d in dirs if d != '.git']
+        if any(f.endswith('.py') for f in files):
+            directories.append(root)
+    # Readable for all instance users (same as o=rX of _set_core_rights())
+    umask = os.umask(0o022)
+    pool = multiprocessing.Pool(max(2, multiprocessing.cpu_count()))
+    try:
+        pool.map(_compile_dir, directories, chunksize=16)
+    except Exception as e:
+        print "WARNING: Could not compile core %s!%s" % (core_dir, pp(e))
+    finally:
+        pool.close()
+        pool.join()
+        os.umask(umask)
+    print "Compile python bytecode for core %s done in %.1fs (%s directories)" % (core_dir, time.time() - start,
+                                                                                  len(directories))
+
+
+def _import_benchmark(core_dir, timeout=300):
+    # Time of a cold 'import openerp' (and the base addon) from the core like at the start of an instance
+    # HINT: python -B does not write .pyc files so the benchmark itself does not change the result of the next one
+    script = "import time; t = time.time(); import openerp; import openerp.addons.base; print time.time() - t"
+    try:
+        output = shell([sys.executable, '-B', '-c', script], cwd=pj(core_dir, 'odoo'), timeout=timeout)
+        return round(float(output.strip().splitlines()[-1]), 3)
+    except Exception as e:
+        print "WARNING: Import benchmark for core %s failed!%s" % (core_dir, pp(e))
+        return None
+
+
+def _remove_bytecode(core_dir):
+    # Remove all .pyc and .pyo files of a core (git clean -fdf keeps them because they are ignored)
+    # HINT: A core copied from the current core brings its .pyc files: also the ones of deleted .py files that python
+    #       would still import
+    removed = 0
+    for root, dirs, files in os.walk(core_dir, followlinks=True):
+        dirs[:] = [d for d in dirs if d != '.git']
+        for f in files:
+            if f.endswith(('.pyc', '.pyo')):
+                os.remove(pj(root, f))
+                removed += 1
+    print "Removed %s .pyc and .pyo files from core %s" % (removed, core_dir)
+    return removed
+
+
+def _prepare_core(conf, core_dir):
+    # Compile the core and measure the cold start import time before and after
+    # HINT: The times are also stored in the core manifest so they are kept if the core is provisioned by
+    #       fleet-update.py
+    _remove_bytecode(core_dir)
+    before = _import_benchmark(core_dir)
+    _compile_core(core_dir)
+    after = _import_benchmark(core_dir)
+    conf['latest_core_import_before'] = before
+    conf['latest_core_import_after'] = after
+    print "Cold start import of core %s: %ss before and %ss after compile" % (core_dir, before, after)
+    return before, after
+
+
+def _find_instances(root_dir):
+    # All instance directories (instance repos with an update folder) directly inside root_dir
+    return [pj(root_dir, d) for d in sorted(os.listdir(root_dir))
+            if not d.startswith('online_')
+            and os.path.isfile(pj(root_dir, d, 'instance.ini'))
+            and os.path.exists(pj(root_dir, d, '.git'))
+            and os.path.isdir(pj(root_dir, d, 'update'))]
+
+
+def _prefetch_instance(root_dir, instance_dir):
+    # Fetch the latest instance repo and return the config needed by _get_cores() for the latest core
+    cnf = dict()
+    cnf['instance'] = os.path.basename(instance_dir)
+    cnf['instance_dir'] = instance_dir
+    cnf['root_dir'] = root_dir
+    cnf['production_server'] = _service_exists(cnf['instance']) and '/opt/online' in instance_dir
+    user_name = cnf['instance'] if cnf['production_server'] else None
+
+    # Database name from server.conf (the latest instance directory is named after it)
+    server_conf = ConfigParser.SafeConfigParser()
+    server_conf.read(pj(instance_dir, 'server.conf'))
+    options = dict(server_conf.items('options')) if server_conf.has_section('options') else dict()
+    cnf['db_name'] = options.get('db_name', cnf['instance'])
+    latest_inst_dir = pj(instance_dir, 'update', cnf['db_name'] + '_update')
+
+    # Fetch the instance repo (so the checkout at update time is local) and get the latest instance repo
+    # HINT: Returns None if an update of the instance is running (it uses both repos)
+    with _update_lock(instance_dir) as locked:
+        if not locked:
+            return None
+        print "Fetch instance repository %s" % instance_dir
+        shell(['git', 'fetch', '--all', '--tags'], cwd=instance_dir, timeout=600, user_name=user_name)
+        print "Get latest instance repository %s" % latest_inst_dir
+        _git_latest(latest_inst_dir, 'git@github.com:OpenAT/' + cnf['instance'] + '.git', user_name=user_name,
+                    pull=True)
+
+    # Current and upcoming core
+    for key, ini in (('core', pj(instance_dir, 'instance.ini')), ('latest_core', pj(latest_inst_dir, 'instance.ini'))):
+        instance_ini = ConfigParser.SafeConfigParser()
+        instance_ini.read(ini)
+        cnf[key] = dict(instance_ini.items('options')).get('core')
+        assert cnf[key], "CRITICAL: core not set in %s!" % ini
+    cnf['core_dir'] = pj(root_dir, 'online_' + cnf['core'])
+    cnf['latest_core_dir'] = pj(root_dir, 'online_' + cnf['latest_core'])
+    cnf['core_repo'] = 'https://github.com/OpenAT/online.git'
+    return cnf
+
+
+def _prefetch(root_dir):
+    # Get all network bound data for the next update (e.g. by cron before the maintenance window):
+    # fetch the instance repos, get the upcoming cores and compile them. --update will then only checkout locally.
+    print "\n---- PREFETCH instances and cores in %s" % root_dir
+    instance_dirs = _find_instances(root_dir)
+    print "Instances found: %s" % [os.path.basename(d) for d in instance_dirs]
+
+    failed = list()
+    cores = OrderedDict()
+    for instance_dir in instance_dirs:
+        try:
+            cnf = _prefetch_instance(root_dir, instance_dir)
+            if cnf is None:
+                print "WARNING: Update is running for %s! Prefetch skipped!" % instance_dir
+                continue
+            # HINT: Every core change (current -> latest) needs to be prepared only once
+            cores.setdefault((cnf['core'], cnf['latest_core']), cnf)
+        except Exception as e:
+            print "ERROR: Prefetch of instance %s failed!%s" % (instance_dir, pp(e))
+            failed.append(os.path.basename(instance_dir))
+
+    for (core, latest_core), cnf in cores.iteritems():
+        try:
+            print "\nPrepare core %s (upcoming %s) for instance %s" % (core, latest_core, cnf['instance'])
+            # HINT: _get_cores() compiles the core (see _prepare_core())
+            _get_cores(cnf)
+        except Exception as e:
+            print "ERROR: Prefetch of core %s failed!%s" % (latest_core, pp(e))
+            failed.append('online_' + latest_core)
+
+    print "---- PREFETCH done%s\n" % (' with errors for: %s' % failed if failed else '')
+    return not failed
+
+
 def _odoo_backup(conf, backup_target=None, stop_after_backup=False):
     print "\nBACKUP"
 
@@ -867,7 +2239,10 @@ def _odoo_backup(conf, backup_target=None, stop_after_backup=False):
         print 'Backup of database at %s to %s' % (conf['db_name'], backup_target)
         cmd = ['pg_dump', '--format=c', '--no-owner',
                '--dbname=' + conf['db_url'], '--file=' + pj(backup_target, 'db.dump')]
-        shell(cmd, timeout=900)
+        with _host_slot('backup'), _host_slot('postgres'):
+            start = time.time()
+            shell_stream(cmd, timeout=_step_timeout(conf, 'backup', 900), profile='backup')
+            _step_record(conf, 'backup', time.time() - start)
     except Exception as e:
         raise Exception('CRITICAL: Backup of database failed!%s' % pp(e))
 
@@ -881,7 +2256,8 @@ def _odoo_backup(conf, backup_target=None, stop_after_backup=False):
 
 
 @retry(Exception, tries=3)
-def _odoo_restore(backup_dir, conf, data_dir_target='', database_target_url='', stop_after_restore=False):
+def _odoo_restore(backup_dir, conf, data_dir_target='', database_target_url='', stop_after_restore=False,
+                  wait_for_slots=True):
     # database
     database_source = pj(backup_dir, 'db.dump')
     database_target_url = database_target_url or conf['db_url']
@@ -947,7 +2323,11 @@ def _odoo_restore(backup_dir, conf, data_dir_target='', database_target_url='',
         raise Exception('CRITICAL: Drop (and create) database failed!%s' % pp(e))
     try:
         # Restore the database (HINT: Don't use --clean!)
-        shell(database_restore_cmd, timeout=3600)
+        with _host_slot('backup', wait=wait_for_slots), _host_slot('postgres', wait=wait_for_slots):
+            start = time.time()
+            shell_stream(database_restore_cmd, timeout=_step_timeout(conf, 'restore', 3600),
+                         profile='backup' if wait_for_slots else None)
+            _step_record(conf, 'restore', time.time() - start)
     except (Exception, subprocess32.TimeoutExpired) as e:
         raise Exception('CRITICAL: Restore database failed!%s' % pp(e))
 
@@ -960,46 +2340,632 @@ def _odoo_restore(backup_dir, conf, data_dir_target='', database_target_url='',
     return True
 
 
+def _git_diff_paths(gitrepo_path, current, target, added_submodules=None):
+    # Returns the relative paths of all added, copied, modified or renamed files between two commits including the
+    # files changed in (nested) submodules.
+    # HINT: One 'git diff --raw' per repository: submodules show up as gitlinks (mode 160000) with their old and new
+    #       commit so no 'git submodule' or 'git ls-tree' calls are needed
+    # HINT: The relative paths of submodules added in target are appended to the list added_submodules if given
+    changed_files = []
+    gitdiff = ['git', 'diff', '--raw', '-z', '--no-abbrev', '--no-renames', '--diff-filter=ACMR', current, target]
+    entries = shell(gitdiff, cwd=gitrepo_path).split('\0')
+    for meta, path in zip(entries[0::2], entries[1::2]):
+        old_mode, new_mode, old_rev, new_rev, status = meta.lstrip(':').split()
+        if new_mode != '160000':
+            changed_files.append(path)
+        # Submodule changed (old_mode is 000000 if the submodule was added in target)
+        elif old_mode == '160000' and old_rev != new_rev:
+            sub_added = [] if added_submodules is not None else None
+            for f in _git_diff_paths(pj(gitrepo_path, path), old_rev, new_rev, added_submodules=sub_added):
+                changed_files.append(pj(path, f))
+            if sub_added:
+                added_submodules.extend(pj(path, a) for a in sub_added)
+        # Submodule added in target: all of its files (and the files of its nested submodules) are new
+        else:
+            for f in _git_tree_paths(pj(gitrepo_path, path), new_rev):
+                changed_files.append(pj(path, f))
+            if added_submodules is not None:
+                added_submodules.append(path)
+    return changed_files
+
+
+def _git_tree_paths(gitrepo_path, rev):
+    # Returns the relative paths of all files of a commit including the files of (nested) submodules
+    # HINT: The submodule must be checked out (its objects are needed) else it is skipped with a warning
+    try:
+        entries = shell(['git', 'ls-tree', '-r', '-z', '--full-tree', rev], cwd=gitrepo_path).split('\0')
+    except Exception as e:
+        print "WARNING: Could not list the files of %s in %s!%s" % (rev, gitrepo_path, pp(e))
+        return []
+    paths = []
+    for entry in filter(None, entries):
+        meta, path = entry.split('\t', 1)
+        mode, object_type, object_rev = meta.split()
+        if mode == '160000':
+            paths.extend(pj(path, f) for f in _git_tree_paths(pj(gitrepo_path, path), object_rev))
+        else:
+            paths.append(path)
+    return paths
+
+
+def _psql(db_url, sql, timeout=240):
+    # Run a single sql statement and return the unaligned output without headers
+    return shell(['psql', '-q', '-t', '-A', '-c', sql, '-d', db_url], timeout=timeout).strip()
+
+
+def _db_write_counter(conf, database_name):
+    # Returns the number of rows inserted, updated or deleted in a database since its last statistics reset
+    # HINT: Unlike xact_commit these counters do not change for read only transactions
+    # HINT: The statistics reset time is part of the counter so a stats reset will never look like 'no writes'
+    sql = "SELECT tup_inserted + tup_updated + tup_deleted || '@' || coalesce(stats_reset::text, '') " \
+          "FROM pg_stat_database WHERE datname = '%s';" % database_name
+    return _psql(conf['db_url'].rsplit('/', 1)[0] + '/postgres', sql, timeout=60)
+
+
+# Input sizes a step duration mainly depends on (steps without sizes are estimated by their duration only)
+_step_size_keys = {
+    'git': (),
+    'backup': ('db_mb', 'filestore_mb'),
+    'restore': ('db_mb', 'filestore_mb'),
+    'dry_run': ('db_mb', ),
+    'production': ('db_mb', ),
+    'service_start': (),
+}
+
+# Number of addons a step mainly depends on: the estimate is scaled by it in addition to the input size
+_step_count_keys = {
+    'dry_run': 'update_addons_count',
+    'production': 'update_addons_count',
+}
+
+
+def _instance_size(conf):
+    # Size of the production database and filestore in MB
+    size = {'db_mb': 0.0, 'filestore_mb': 0.0}
+    try:
+        size['db_mb'] = round(int(_psql(conf['db_url'], "SELECT pg_database_size(current_database());",
+                                        timeout=60)) / 1048576.0, 1)
+    except Exception as e:
+        print "WARNING: Could not get the size of database %s!%s" % (conf['db_name'], pp(e))
+    filestore_bytes = 0
+    for root, dirs, files in os.walk(pj(conf['data_dir'], 'filestore', conf['db_name'])):
+        for f in files:
+            try:
+                filestore_bytes += os.path.getsize(pj(root, f))
+            except OSError:
+                pass
+    size['filestore_mb'] = round(filestore_bytes / 1048576.0, 1)
+    print "Instance size: database %sMB filestore %sMB" % (size['db_mb'], size['filestore_mb'])
+    return size
+
+
+def _step_history(conf):
+    # Durations of the update steps of earlier runs: {step: [{'duration':, 'db_mb':, 'filestore_mb':, 'time':}, ]}
+    try:
+        with open(pj(conf['backup_dir'], 'step_history.json'), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError, KeyError):
+        return dict()
+
+
+def _step_record(conf, step, duration, keep=20):
+    # Add the duration of a step to the step history of the instance
+    try:
+        history = _step_history(conf)
+        record = {'duration': round(duration, 1), 'time': conf.get('start_time', '')}
+        record.update(dict((key, conf.get(key, 0.0)) for key in ('db_mb', 'filestore_mb', 'update_addons_count')))
+        history[step] = (history.get(step, []) + [record])[-keep:]
+        _write_file_atomic(pj(conf['backup_dir'], 'step_history.json'), json.dumps(history, indent=2))
+    except Exception as e:
+        print "WARNING: Could not record the duration of step %s!%s" % (step, pp(e))
+
+
+def _step_estimate(conf, step):
+    # Estimated duration of a step in seconds from the slowest earlier run (per MB of its input size and per addon
+    # to update) or None
+    records = _step_history(conf).get(step, [])[-10:]
+    size_keys = _step_size_keys.get(step, ())
+    size = sum(float(conf.get(key) or 0.0) for key in size_keys)
+    count_key = _step_count_keys.get(step)
+    count = float(conf.get(count_key) or 0.0) if count_key else 0.0
+    estimates = []
+    for record in records:
+        estimate = record['duration']
+        record_size = sum(float(record.get(key) or 0.0) for key in size_keys)
+        if size_keys and record_size > 0 and size > 0:
+            estimate = estimate / record_size * size
+        record_count = float(record.get(count_key) or 0.0) if count_key else 0.0
+        if record_count > 0 and count > 0:
+            estimate = estimate / record_count * count
+        estimates.append(estimate)
+    return max(estimates) if estimates else None
+
+
+def _step_timeout(conf, step, default, factor=3, minimum=None, min_records=3):
+    # Timeout of a step: a multiple of its estimated duration or the default timeout if there are less than
+    # min_records earlier runs of the step
+    # HINT: Small instances fail early and big instances and big update sets get more time than the default. The
+    #       timeout is never less than minimum (default: 300s or the default timeout if it is smaller).
+    estimate = _step_estimate(conf, step)
+    if estimate is None or len(_step_history(conf).get(step, [])) < min_records:
+        return default
+    minimum = min(default, 300) if minimum is None else minimum
+    timeout = max(minimum, int(estimate * factor + 60))
+    print "Timeout for %s: %ss (estimated %.0fs, default %ss)" % (step, timeout, estimate, default)
+    return timeout
+
+
+def _update_eta(conf, steps):
+    # Log the estimated duration and time of arrival of the update and store it in status.ini
+    estimates = [_step_estimate(conf, step) for step in steps]
+    known = [e for e in estimates if e is not None]
+    if not known:
+        print "No step history found! ETA of the update unknown."
+        return False
+    duration = sum(known)
+    conf['update_eta'] = (datetime.datetime.now() + datetime.timedelta(seconds=duration)).isoformat()
+    conf['update_eta_seconds'] = '%.0f' % duration
+    print "ETA of the update: %s (%ss%s)" % (conf['update_eta'], conf['update_eta_seconds'],
+                                            '' if len(known) == len(steps) else ', without steps with no history')
+    try:
+        status_ini = ConfigParser.SafeConfigParser()
+        status_ini.read(conf['status_file'])
+        if not status_ini.has_section('options'):
+            status_ini.add_section('options')
+        status_ini.set('options', 'update_eta', conf['update_eta'])
+        with open(conf['status_file'], 'w+') as writefile:
+            status_ini.write(writefile)
+    except Exception as e:
+        print "WARNING: Could not write the ETA to %s!%s" % (conf['status_file'], pp(e))
+    return True
+
+
+def _promote_dry_run(conf):
+    # Swap the migrated dry-run database and filestore in for production by renaming them
+    # ATTENTION: The production service must be stopped already!
+    # HINT: Returns False (= run the regular production update) if production had writes since the backup, if the
+    #       dry-run database had writes after its migration (e.g. cron jobs or requests of a started dry-run instance)
+    #       or if anything is not as expected. Done renames are reverted in this case.
+    print "\n-- Check if the migrated dry-run database can be promoted to production"
+    postgres_db_url = conf['db_url'].rsplit('/', 1)[0] + '/postgres'
+    pre_update_db_name = conf['db_name'] + '_pre_update'
+    filestore = pj(conf['data_dir'], 'filestore', conf['db_name'])
+    latest_filestore = pj(conf['latest_data_dir'], 'filestore', conf['latest_db_name'])
+    pre_update_filestore = filestore + '_pre_update'
+    done = []
+    try:
+        # The dry-run instance was started for the compare of the webpages: its requests may have changed the
+        # database and the filestore (e.g. sessions and asset bundles)
+        if 'compare_urls_same' in conf:
+            print "Dry-run instance %s was started to compare the webpages! Promotion skipped!" \
+                  "" % conf['latest_instance']
+            return False
+        # Statistics of the stopped backends may need a moment to show up in pg_stat_database
+        sleep(2)
+        write_counter = _db_write_counter(conf, conf['db_name'])
+        print "Database write counter before backup: %s now: %s" % (conf.get('backup_write_counter'), write_counter)
+        if not conf.get('backup_write_counter') or write_counter != conf['backup_write_counter']:
+            print "Production database %s had writes since the backup! Promotion skipped!" % conf['db_name']
+            return False
+        latest_write_counter = _db_write_counter(conf, conf['latest_db_name'])
+        print "Dry-run database write counter after migration: %s now: %s" % (conf.get('dry_run_write_counter'),
+                                                                             latest_write_counter)
+        if not conf.get('dry_run_write_counter') or latest_write_counter != conf['dry_run_write_counter']:
+            print "Dry-run database %s had writes since its migration! Promotion skipped!" % conf['latest_db_name']
+            return False
+        assert os.path.isdir(filestore), "Production filestore not found at %s" % filestore
+        assert os.path.isdir(latest_filestore), "Dry-run filestore not found at %s" % latest_filestore
+        assert os.stat(os.path.dirname(filestore)).st_dev == os.stat(os.path.dirname(latest_filestore)).st_dev, \
+            "Production and dry-run filestore are on different file systems!"
+
+        # Remove the database and filestore of the last promotion
+        _psql(postgres_db_url, 'DROP DATABASE IF EXISTS "%s";' % pre_update_db_name)
+        if os.path.exists(pre_update_filestore):
+            shutil.rmtree(pre_update_filestore)
+
+        # Drop connections and swap the databases
+        for database_name in (conf['db_name'], conf['latest_db_name']):
+            _psql(postgres_db_url, "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                                   "WHERE datname = '%s' AND pid <> pg_backend_pid();" % database_name)
+        for old_name, new_name in ((conf['db_name'], pre_update_db_name), (conf['latest_db_name'], conf['db_name'])):
+            print "Rename database %s to %s" % (old_name, new_name)
+            _psql(postgres_db_url, 'ALTER DATABASE "%s" RENAME TO "%s";' % (old_name, new_name))
+            done.append(('db', old_name, new_name))
+
+        # Swap the filestores
+        for old_path, new_path in ((filestore, pre_update_filestore), (latest_filestore, filestore)):
+            print "Rename filestore %s to %s" % (old_path, new_path)
+            os.rename(old_path, new_path)
+            done.append(('filestore', old_path, new_path))
+    except Exception as e:
+        print "ERROR: Promotion of the dry-run database failed! Reverting renames: %s%s" % (done, pp(e))
+        for kind, old_name, new_name in reversed(done):
+            if kind == 'db':
+                _psql(postgres_db_url, 'ALTER DATABASE "%s" RENAME TO "%s";' % (new_name, old_name))
+            else:
+                os.rename(new_name, old_name)
+        return False
+
+    conf['promoted_dry_run'] = True
+    print "Dry-run database promoted! Pre-update database kept as %s" % pre_update_db_name
+    return True
+
+
+def _standby_names(conf):
+    # Names of the publication (production database) and subscription (standby database) and the replication slot
+    name = re.sub(r'[^a-z0-9_]', '_', conf['db_name'].lower()) + '_standby'
+    return name, name, name
+
+
+def _standby_ready(conf, max_lag_mb=64):
+    # True if the standby database is subscribed to production, the initial table sync is done, the apply worker is
+    # running and the replication lag is below max_lag_mb
+    publication, subscription, slot = _standby_names(conf)
+    try:
+        enabled = _psql(conf['latest_db_url'], "SELECT subenabled FROM pg_subscription "
+                                               "WHERE subname = '%s';" % subscription, timeout=60)
+        not_ready = _psql(conf['latest_db_url'], "SELECT count(*) FROM pg_subscription_rel "
+                                                 "WHERE srsubstate <> 'r';", timeout=60)
+        # HINT: The apply worker (relid is NULL) has no pid if it fails e.g. because of a conflict
+        workers = _psql(conf['latest_db_url'], "SELECT count(*) FROM pg_stat_subscription WHERE subname = '%s' "
+                                               "AND relid IS NULL AND pid IS NOT NULL;" % subscription, timeout=60)
+        lag = _psql(conf['db_url'], "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), confirmed_flush_lsn) "
+                                    "FROM pg_replication_slots WHERE slot_name = '%s';" % slot, timeout=60)
+        print "Standby database %s: enabled %s, tables not ready %s, apply workers %s, lag %s bytes" \
+              "" % (conf['latest_db_name'], enabled, not_ready, workers, lag)
+        return enabled == 't' and not_ready == '0' and workers == '1' and lag != '' \
+            and float(lag) <= max_lag_mb * 1024 * 1024
+    except Exception as e:
+        print "Standby database %s not available.%s" % (conf['latest_db_name'], pp(e))
+        return False
+
+
+def _standby_wait_lsn(conf, timeout=600):
+    # Wait until the standby database confirmed all changes of production up to now
+    # Returns False if this is not reached within timeout seconds
+    slot = _standby_names(conf)[2]
+    target_lsn = _psql(conf['db_url'], 'SELECT pg_current_wal_lsn();', timeout=60)
+    print "Wait up to %ss for the standby database to reach the production LSN %s" % (timeout, target_lsn)
+    reached = _wait_for(lambda: _psql(conf['db_url'], "SELECT pg_wal_lsn_diff(confirmed_flush_lsn, '%s') >= 0 "
+                                                      "FROM pg_replication_slots WHERE slot_name = '%s';"
+                                                      "" % (target_lsn, slot), timeout=60) == 't', timeout=timeout)
+    if reached is False:
+        print "WARNING: Standby database did not reach the production LSN %s within %ss!" % (target_lsn, timeout)
+        return False
+    print "Standby database reached the production LSN %s after %.1fs" % (target_lsn, reached)
+    return True
+
+
+def _standby_replica_identity(conf, identity='FULL', lock_timeout='2s', tries=10):
+    # UPDATE and DELETE fail on published tables without a replica identity e.g. the m2m *_rel tables of odoo have
+    # no primary key. Set REPLICA IDENTITY FULL for them (or DEFAULT again if the replication is removed).
+    # HINT: New tables are published automatically (FOR ALL TABLES) so this is repeated by every --standby run
+    # HINT: ALTER TABLE needs an ACCESS EXCLUSIVE lock on the live production table. It waits at most lock_timeout
+    #       for it (so it never blocks the requests of production for long) and is retried later if it timed out.
+    current = 'd' if identity == 'FULL' else 'f'
+    tables = _psql(conf['db_url'], "SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname) "
+                                   "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                                   "WHERE c.relkind = 'r' AND n.nspname = 'public' AND c.relreplident = '%s' "
+                                   "AND NOT EXISTS (SELECT 1 FROM pg_index i "
+                                   "                WHERE i.indrelid = c.oid AND i.indisprimary);" % current,
+                   timeout=60).split()
+    if tables:
+        print "Set REPLICA IDENTITY %s for %s tables without primary key" % (identity, len(tables))
+    pending = list(tables)
+    for attempt in range(tries):
+        if not pending:
+            break
+        if attempt:
+            print "Lock timeout for %s tables. Retry in %ss." % (len(pending), attempt * 5)
+            sleep(attempt * 5)
+        failed = []
+        for table in pending:
+            try:
+                _psql(conf['db_url'], "SET lock_timeout = '%s'; ALTER TABLE %s REPLICA IDENTITY %s;"
+                                      "" % (lock_timeout, table, identity), timeout=60)
+            except Exception:
+                failed.append(table)
+        pending = failed
+    assert not pending, "CRITICAL: Could not set REPLICA IDENTITY %s for %s!" % (identity, pending)
+    return tables
+
+
+@contextmanager
+def _standby_filestore_lock(conf):
+    # flock() for the filestore of the dry-run instance: the standby filestore sync runs without the update.lock
+    # (it may take long) so the update waits for a running sync before it uses or restores this filestore
+    # ATTENTION: Take it only once per process: a second flock() of the same file in this process would wait forever
+    with open(pj(conf['backup_dir'], 'standby_filestore.lock'), 'a+') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _standby_sync_filestore(conf):
+    # The filestore is not part of the database so it has to be synced separately
+    source = pj(conf['data_dir'], 'filestore', conf['db_name'])
+    target = pj(conf['latest_data_dir'], 'filestore', conf['latest_db_name'])
+    print "Sync filestore %s to standby filestore %s" % (source, target)
+    assert os.path.isdir(source), 'CRITICAL: Source filestore not found for database! %s' % source
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    try:
+        shell(['rsync', '-a', '--delete', source + '/', target + '/'], timeout=3600)
+    except OSError:
+        print "WARNING: rsync not found! Copy the whole filestore instead."
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        shutil.copytree(source, target)
+    return True
+
+
+def _standby_drop_replication(conf):
+    # Remove subscription, replication slot and publication (the slot would keep WAL files on production forever)
+    publication, subscription, slot = _standby_names(conf)
+    try:
+        if _psql(conf['latest_db_url'], "SELECT count(*) FROM pg_subscription WHERE subname = '%s';"
+                                        "" % subscription, timeout=60) != '0':
+            _psql(conf['latest_db_url'], 'ALTER SUBSCRIPTION "%s" DISABLE;' % subscription, timeout=60)
+            _psql(conf['latest_db_url'], 'ALTER SUBSCRIPTION "%s" SET (slot_name = NONE);' % subscription, timeout=60)
+            _psql(conf['latest_db_url'], 'DROP SUBSCRIPTION "%s";' % subscription, timeout=60)
+    except Exception as e:
+        print "WARNING: Could not drop subscription %s!%s" % (subscription, pp(e))
+    _psql(conf['db_url'], "SELECT pg_drop_replication_slot(slot_name) FROM pg_replication_slots "
+                          "WHERE slot_name = '%s';" % slot, timeout=60)
+    _psql(conf['db_url'], 'DROP PUBLICATION IF EXISTS "%s";' % publication, timeout=60)
+    # HINT: Without the publication REPLICA IDENTITY FULL only costs some WAL: the next drop retries the reset
+    try:
+        _standby_replica_identity(conf, identity='DEFAULT', tries=3)
+    except Exception as e:
+        print "WARNING: Could not reset the replica identity of the production tables!%s" % pp(e)
+    return True
+
+
+def _standby_setup(conf):
+    # Create the standby database <db>_update and keep it in sync with production by logical replication
+    # ATTENTION: Needs PostgreSQL >= 10 with wal_level = logical and a db_user with the REPLICATION attribute that
+    #            is allowed to create publications FOR ALL TABLES (superuser before PostgreSQL 15)
+    # HINT: Schema changes (DDL) are not replicated! Run this again after addons were installed or updated.
+    # HINT: The update.lock is only taken for the database steps so an update can not use or drop the standby
+    #       database while it is set up. The filestore is synced afterwards (see _standby_filestore_lock()).
+    print "\n---- Setup standby database %s for %s" % (conf['latest_db_name'], conf['db_name'])
+    with _update_lock(conf['instance_dir']) as locked:
+        if not locked:
+            print "WARNING: Standby setup skipped!"
+            return False
+        created = _standby_setup_database(conf)
+
+    # Sync the filestore (skipped if an update started in the meantime: it syncs the filestore itself)
+    with _standby_filestore_lock(conf):
+        if os.path.isfile(pj(conf['instance_dir'], 'update.lock')):
+            print "WARNING: Update running! Standby filestore sync skipped!"
+        else:
+            _standby_sync_filestore(conf)
+    if created:
+        print "---- Standby database %s created. Initial data copy is running in the background." \
+              "" % conf['latest_db_name']
+    return True
+
+
+def _standby_setup_database(conf):
+    # Create the standby database and its replication or only update the replica identities if it is in sync
+    # Returns True if the standby database was created
+    publication, subscription, slot = _standby_names(conf)
+    postgres_db_url = conf['db_url'].rsplit('/', 1)[0] + '/postgres'
+
+    # Check if the standby is already running
+    if _standby_ready(conf):
+        print "Standby database %s is in sync. Only the filestore will be synced." % conf['latest_db_name']
+        _standby_replica_identity(conf)
+        return False
+
+    assert int(_psql(conf['db_url'], 'SHOW server_version_num;', timeout=60)) >= 100000, \
+        'CRITICAL: Logical replication needs PostgreSQL 10 or newer!'
+    assert _psql(conf['db_url'], 'SHOW wal_level;', timeout=60) == 'logical', \
+        'CRITICAL: wal_level must be "logical" in postgresql.conf!'
+
+    # The standby instance must not write to the standby database
+    if conf['production_server'] and not _service_control(conf['latest_instance'], running=False):
+        raise Exception('CRITICAL: Could not stop service %s' % conf['latest_instance'])
+
+    # Remove an old or broken standby
+    _standby_drop_replication(conf)
+    _psql(postgres_db_url, "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                           "WHERE datname = '%s' AND pid <> pg_backend_pid();" % conf['latest_db_name'])
+    _psql(postgres_db_url, 'DROP DATABASE IF EXISTS "%s";' % conf['latest_db_name'])
+    _psql(postgres_db_url, """CREATE DATABASE "%s" WITH OWNER "%s" TEMPLATE template0 ENCODING 'UTF8';"""
+                           "" % (conf['latest_db_name'], conf['db_user']))
+
+    # Copy the schema (logical replication only copies the rows)
+    schema_dump = pj(conf['backup_dir'], conf['latest_db_name'] + '-standby-schema.dump')
+    shell(['pg_dump', '--format=c', '--no-owner', '--schema-only', '--dbname=' + conf['db_url'],
+           '--file=' + schema_dump], timeout=900)
+    shell(['pg_restore', '--format=c', '--no-owner', '-n', 'public', '--dbname=' + conf['latest_db_url'],
+           schema_dump], timeout=900)
+    os.remove(schema_dump)
+
+    # Publish all tables of production and subscribe the standby database
+    # HINT: The slot is created first because CREATE SUBSCRIPTION would hang if both databases are in the same
+    #       cluster and it has to create the slot itself
+    _standby_replica_identity(conf)
+    _psql(conf['db_url'], 'CREATE PUBLICATION "%s" FOR ALL TABLES;' % publication, timeout=60)
+    _psql(conf['db_url'], "SELECT pg_create_logical_replication_slot('%s', 'pgoutput');" % slot, timeout=60)
+    connection = "host=%s port=%s dbname=%s user=%s password=%s" % (conf['db_host'], conf['db_port'],
+                                                                    conf['db_name'], conf['db_user'],
+                                                                    conf['db_password'])
+    _psql(conf['latest_db_url'], """CREATE SUBSCRIPTION "%s" CONNECTION '%s' PUBLICATION "%s" """
+                                 """WITH (create_slot = false, slot_name = '%s');"""
+                                 "" % (subscription, connection, publication, slot), timeout=60)
+    return True
+
+
+def _standby_activate(conf):
+    # Stop the replication and make the standby database ready for the dry-run update (no dump or restore needed)
+    # HINT: Returns False if there is no standby database that is in sync
+    if not _standby_ready(conf):
+        return False
+    # All changes of production up to now must be applied before the replication is stopped
+    if not _standby_wait_lsn(conf):
+        return False
+    print "\n-- Use the standby database %s for the dry-run." % conf['latest_db_name']
+    subscription = _standby_names(conf)[1]
+    _psql(conf['latest_db_url'], 'ALTER SUBSCRIPTION "%s" DISABLE;' % subscription, timeout=60)
+
+    # Sequences are not replicated
+    sequences = _psql(conf['db_url'], "SELECT quote_ident(schemaname) || '.' || quote_ident(sequencename), "
+                                      "last_value FROM pg_sequences WHERE last_value IS NOT NULL;", timeout=60)
+    setval = ["SELECT setval('%s', %s);" % tuple(line.split('|')) for line in sequences.splitlines() if line]
+    if setval:
+        _psql(conf['latest_db_url'], ' '.join(setval), timeout=240)
+
+    # The migration changes the schema so the replication can not be resumed
+    _standby_drop_replication(conf)
+    _standby_sync_filestore(conf)
+    return True
+
+
 def _changed_files(gitrepo_path, current, target='Latest'):
     print "Searching for changed files in %s" % gitrepo_path
     if current == target:
         print "WARNING: Current and target commit are the same!"
         return []
-    changed_files = []
-    gitdiff = ['git', 'diff', '--name-only', '--ignore-submodules=all', '--diff-filter=ACMR']
-
-    # Find regular changed files
-    for f in shell(gitdiff + [current, target], cwd=gitrepo_path).splitlines():
-        changed_files.append(pj(gitrepo_path, f))
-
-    # Find changed files of submodules
-    for subm in shell(['git', 'submodule'], cwd=gitrepo_path).splitlines():
-        relative_path = subm.strip().split()[1]
-        absolute_path = pj(gitrepo_path, relative_path)
-        current_rev = shell(['git', 'ls-tree', current, relative_path], cwd=gitrepo_path)
-        target_rev = shell(['git', 'ls-tree', target, relative_path], cwd=gitrepo_path)
-        # Current_rev may be empty if submodule was added in target_rev
-        if len(current_rev) >= 3 and len(target_rev) >= 3 and current_rev != target_rev:
-            current_rev = current_rev.strip().split()[2]
-            target_rev = target_rev.strip().split()[2]
-            for f in shell(gitdiff + [current_rev, target_rev], cwd=absolute_path).splitlines():
-                changed_files.append(pj(absolute_path, f))
 
+    # Resolve branches and tags to commits for the cache key
+    current_rev, target_rev = shell(['git', 'rev-parse', current + '^{commit}', target + '^{commit}'],
+                                    cwd=gitrepo_path).split()
+    cache_key = (os.path.realpath(gitrepo_path), current_rev, target_rev)
+    if cache_key not in _changed_files.cache:
+        cache_file = _git_cache_file(gitrepo_path, 'changed_files-%s-%s' % (current_rev, target_rev))
+        if cache_file and os.path.isfile(cache_file):
+            print "Using cached changed files from %s" % cache_file
+            with open(cache_file, 'r') as f:
+                _changed_files.cache[cache_key] = f.read().splitlines()
+        else:
+            _changed_files.cache[cache_key] = _git_diff_paths(gitrepo_path, current_rev, target_rev)
+            if cache_file:
+                _write_file_atomic(cache_file, '\n'.join(_changed_files.cache[cache_key]))
+
+    changed_files = [pj(gitrepo_path, f) for f in _changed_files.cache[cache_key]]
     print "Changed files found: %s\n" % changed_files
     return changed_files
+_changed_files.cache = dict()
+
+
+def _addon_manifest(addon_dir):
+    # Returns the relevant keys of the __openerp__.py manifest of an addon
+    # HINT: Manifests are python dicts so they can be parsed safely without importing the addon
+    try:
+        with open(pj(addon_dir, '__openerp__.py'), 'r') as f:
+            manifest = ast.literal_eval(f.read())
+    except Exception as e:
+        print "WARNING: Could not parse the manifest of addon %s!%s" % (addon_dir, pp(e))
+        manifest = {}
+    return {
+        'depends': list(manifest.get('depends', [])),
+        'data': [os.path.normpath(f) for key in ('data', 'update_xml', 'init_xml', 'demo', 'demo_xml')
+                 for f in manifest.get(key, [])],
+    }
+
+
+def _addons_index(repo_path, manifests=False):
+    # Returns a dict {addon_dir: addon_name} of all addons found in a (git) repository
+    # or a dict {addon_dir: manifest} if manifests is set
+    # HINT: Symlinks are followed so an addon is found under every path (e.g.: in addons-loaded and in the submodule
+    #       repo it links to). Both are needed: git reports the real paths and the addons path uses the symlinks.
+    # HINT: The index is cached in memory and on disk per commit of the repository
+    repo_path = os.path.abspath(repo_path)
+    commit = _git_get_hash(repo_path).strip()
+    cache_key = (os.path.realpath(repo_path), commit)
+    if cache_key not in _addons_index.cache:
+        cache_file = _git_cache_file(repo_path, 'addons_index-v2-%s.json' % commit)
+        index = None
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                print "Using cached addons index from %s" % cache_file
+                with open(cache_file, 'r') as f:
+                    index = json.load(f)
+                assert 'manifests' in index, "Manifests missing in addons index!"
+            except Exception as e:
+                print "WARNING: Could not read addons index from %s!%s" % (cache_file, pp(e))
+                index = None
+        if index is None:
+            print "Create addons index for %s at commit %s" % (repo_path, commit)
+            index = {'addons': {}, 'manifests': {}}
+
+            # HINT: Only folders with tracked files (of the repo or of its submodules) are walked. Untracked folders
+            #       like data_dir (filestore), backup, log or update may hold millions of files.
+            real_repo_path = os.path.realpath(repo_path)
+            tracked = set()
+            for tracked_file in shell(['git', 'ls-files', '-z', '--recurse-submodules'], cwd=repo_path).split('\0'):
+                while tracked_file:
+                    tracked.add(tracked_file)
+                    tracked_file = os.path.dirname(tracked_file)
+
+            def walk(path, ancestors):
+                for folder in sorted(os.listdir(path)):
+                    folder_path = pj(path, folder)
+                    if folder == '.git' or not os.path.isdir(folder_path):
+                        continue
+                    real_path = os.path.realpath(folder_path)
+                    if real_path.startswith(real_repo_path + os.sep) and \
+                            os.path.relpath(real_path, real_repo_path) not in tracked:
+                        continue
+                    if os.path.isfile(pj(folder_path, '__openerp__.py')):
+                        # Addons are never nested so there is no need to walk into the addon folder
+                        addon_dir = os.path.relpath(folder_path, repo_path)
+                        index['addons'][addon_dir] = folder
+                        index['manifests'][addon_dir] = _addon_manifest(folder_path)
+                        continue
+                    # HINT: Only a symlink to one of its own parent folders (loop) is skipped
+                    if real_path not in ancestors:
+                        walk(folder_path, ancestors | {real_path})
+            walk(repo_path, {os.path.realpath(repo_path)})
+            if cache_file:
+                _write_file_atomic(cache_file, json.dumps(index))
+        _addons_index.cache[cache_key] = dict(
+            (key, dict((pj(repo_path, addon_dir), value) for addon_dir, value in index[key].iteritems()))
+            for key in ('addons', 'manifests'))
+    return _addons_index.cache[cache_key]['manifests' if manifests else 'addons']
+_addons_index.cache = dict()
+
+
+def _file_needs_update(addon_dir, manifest, changed_file):
+    # Returns 'update' if the changed file requires a module update, 'lang' for translations or False
+    # HINT: Static assets (js, css, images, qweb client templates) are loaded from disk and python code only needs a
+    #       restart unless it defines models. Since we can not tell models from controllers every .py file counts.
+    relative_path = os.path.relpath(changed_file, addon_dir)
+    filetype = os.path.splitext(changed_file)[1]
+    if filetype in ('.po', '.pot'):
+        return 'lang'
+    if relative_path.split(os.sep)[0] in ('static', 'tests'):
+        return False
+    if filetype == '.py':
+        return 'update'
+    if relative_path in manifest.get('data', []):
+        return 'update'
+    return False
 
 
-def _find_addons_byfile(changed_files, stop=[]):
+def _find_addons_byfile(changed_files, stop=[], index=None, manifests=None):
     print "Find addons by file. Stop at dir / or %s" % stop
-    updates = langupdates = []
+    updates = []
+    langupdates = []
     for f in changed_files:
         filetype = os.path.splitext(f)[1]
-        if filetype in ('.py', '.xml', '.po', '.pot'):
+        if manifests is not None or filetype in ('.py', '.xml', '.po', '.pot'):
             path = os.path.dirname(f)
             # print "DEBUG: path %s filetype %s isfile %s %s" % (path, filetype, pj(path, '__openerp__.py'), os.path.isfile(pj(path, '__openerp__.py')))
             while path not in ['/', ] + stop:
-                if os.path.isfile(pj(path, '__openerp__.py')):
-                    if filetype in ('.py', '.xml', '.po'):
+                if path in index if index is not None else os.path.isfile(pj(path, '__openerp__.py')):
+                    if manifests is not None:
+                        needs_update = _file_needs_update(path, manifests.get(path, {}), f)
+                        if needs_update == 'update':
+                            updates.append(os.path.basename(path))
+                        elif needs_update == 'lang':
+                            langupdates.append(os.path.basename(path))
+                    elif filetype in ('.py', '.xml'):
                         updates.append(os.path.basename(path))
                     elif filetype in ('.po', '.pot'):
                         langupdates.append(os.path.basename(path))
@@ -1009,10 +2975,14 @@ def _find_addons_byfile(changed_files, stop=[]):
     return list(OrderedDict.fromkeys(updates)), list(OrderedDict.fromkeys(langupdates))
 
 
-def _find_addons_inpaths(addons_paths):
+def _find_addons_inpaths(addons_paths, index=None):
     addons = []
     for addons_path in addons_paths:
         assert os.path.exists(addons_path), "ERROR: Addons path is missing: %s" % addons_path
+        if index is not None:
+            addons_path = addons_path.rstrip('/') + '/'
+            addons += [index[addon_dir] for addon_dir in sorted(index) if addon_dir.startswith(addons_path)]
+            continue
         for dirname, folders, files in os.walk(addons_path, followlinks=True):
             for folder in folders:
                 if os.path.isfile(pj(pj(dirname, folder), '__openerp__.py')):
@@ -1020,21 +2990,174 @@ def _find_addons_inpaths(addons_paths):
     return list(OrderedDict.fromkeys(addons))
 
 
+def _addons_graph(manifests, addons_paths):
+    # Returns the dependency graph {addon_name: [depends]} of the addons in the addons paths
+    # HINT: The addons paths are used in their order so the first addon found wins (same as odoo)
+    graph = OrderedDict()
+    for addons_path in addons_paths:
+        addons_path = os.path.normpath(addons_path)
+        for addon_dir in sorted(a for a in manifests if os.path.dirname(a) == addons_path):
+            graph.setdefault(os.path.basename(addon_dir), manifests[addon_dir].get('depends', []))
+    return graph
+
+
+def _latest_addons_paths(conf):
+    # Returns the absolute addons paths of the latest core and instance in the order of the odoo addons path
+    loaded_addons = pj(conf['latest_core_dir'], 'addons-loaded')
+    if os.path.isdir(pj(loaded_addons, 'openerp')):
+        loaded_addons = pj(loaded_addons, 'openerp/addons')
+    return [pj(conf['latest_core_dir'], 'odoo/openerp/addons'),
+            pj(conf['latest_core_dir'], 'odoo/addons'),
+            loaded_addons,
+            pj(conf['latest_inst_dir'], 'addons')]
+
+
+def _minimal_update_set(addons, graph):
+    # Returns the minimal list of addons to pass to '-u' and the closed set of addons odoo will upgrade
+    # HINT: odoo upgrades all installed addons that depend on an upgraded addon so there is no need to list them
+    dependents = dict()
+    for addon, depends in graph.iteritems():
+        for depend in depends:
+            dependents.setdefault(depend, set()).add(addon)
+
+    def _closure(roots):
+        closed = set()
+        todo = list(roots)
+        while todo:
+            addon = todo.pop()
+            if addon not in closed:
+                closed.add(addon)
+                todo.extend(dependents.get(addon, []))
+        return closed
+
+    addons = list(OrderedDict.fromkeys(addons))
+    minimal = [a for a in addons if not any(a in _closure([b]) for b in addons if b != a)]
+    return minimal, sorted(_closure(minimal))
+
+
+def _addons_modules(addons_dirs):
+    # Returns the addons {name: addon_dir} in addons path order and the addons found more than once {name: [dirs]}
+    # HINT: Like in odoo the first addon found in the addons path is used
+    modules = OrderedDict()
+    conflicts = dict()
+    for addons_dir in addons_dirs:
+        for name in sorted(os.listdir(addons_dir)):
+            addon_dir = pj(addons_dir, name)
+            if not os.path.isfile(pj(addon_dir, '__openerp__.py')):
+                continue
+            if name in modules:
+                conflicts.setdefault(name, [modules[name]]).append(addon_dir)
+                continue
+            modules[name] = addon_dir
+    return modules, conflicts
+
+
+def _addons_probe(addons_dirs, names):
+    # Replay the lookups of odoo's get_module_path() for all addons: exists(addon) or exists(addon.zip) in every
+    # addons dir until the addon is found. Returns the number of stat calls and the milliseconds they took.
+    stats = 0
+    start = time.time()
+    for name in names:
+        for addons_dir in addons_dirs:
+            stats += 1
+            if os.path.exists(pj(addons_dir, name)):
+                break
+            stats += 1
+            if os.path.exists(pj(addons_dir, name + '.zip')):
+                break
+    return stats, round((time.time() - start) * 1000, 1)
+
+
+def _addons_flat(addons_dirs, flat_dir):
+    # Maintain flat_dir as a folder with one symlink per addon of the addons dirs and return its stamp or False
+    # HINT: Odoo probes the addons dirs one after the other for every addon at import and load time. With the flat
+    #       folder as the addons path every addon is found with the first probe. The folder is only rebuilt if an
+    #       addons dir changed (mtime) so a regular start only needs a few stat() calls.
+    # HINT: Set ONLINE_TOOLS_ADDONS_FLAT=0 to use the regular addons path
+    # HINT: flat_dir is in the git cache of the repo (see _git_cache_file()) so the repo stays clean and git clean
+    #       does not remove it
+    if os.environ.get('ONLINE_TOOLS_ADDONS_FLAT', '1') == '0' or not flat_dir:
+        return False
+    stamp_file = pj(flat_dir, '.addons_flat.json')
+    try:
+        sources = [[addons_dir, os.stat(addons_dir).st_mtime] for addons_dir in addons_dirs]
+    except OSError as e:
+        print "WARNING: Addons directory missing! Flat addons path not used!%s" % pp(e)
+        return False
+    try:
+        with open(stamp_file, 'r') as f:
+            stamp = _json_str(json.load(f))
+        if stamp['sources'] == sources:
+            return stamp
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    print "\nBuild the flat addons directory %s" % flat_dir
+    tmp_dir = flat_dir + '.tmp' + str(os.getpid())
+    old_dir = flat_dir + '.old' + str(os.getpid())
+    try:
+        modules, conflicts = _addons_modules(addons_dirs)
+        if conflicts:
+            print "WARNING: Addons found more than once! The first one in the addons path is used:"
+            for name in sorted(conflicts):
+                print "    %s: %s" % (name, ', '.join(conflicts[name]))
+
+        # HINT: Link to the real path so odoo does not have to follow the symlinks of addons-loaded a second time
+        os.makedirs(tmp_dir)
+        for name, addon_dir in modules.iteritems():
+            os.symlink(os.path.realpath(addon_dir), pj(tmp_dir, name))
+
+        # Measure the stat() calls of the addon lookups for the regular and the flat addons path
+        stats_before, ms_before = _addons_probe(addons_dirs, modules)
+        stats_after, ms_after = _addons_probe([tmp_dir], modules)
+        stamp = {'flat_dir': flat_dir,
+                 'sources': sources,
+                 'addons': len(modules),
+                 'conflicts': sorted(conflicts),
+                 'lookup_stats_before': stats_before,
+                 'lookup_stats_after': stats_after,
+                 'lookup_ms_before': ms_before,
+                 'lookup_ms_after': ms_after}
+        with open(pj(tmp_dir, '.addons_flat.json'), 'w') as f:
+            json.dump(stamp, f, indent=2)
+
+        # Replace the old flat addons directory
+        if os.path.isdir(flat_dir):
+            os.rename(flat_dir, old_dir)
+        os.rename(tmp_dir, flat_dir)
+        if os.path.isdir(old_dir):
+            shutil.rmtree(old_dir)
+    except Exception as e:
+        print "WARNING: Could not build the flat addons directory %s!%s" % (flat_dir, pp(e))
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        if os.path.isdir(old_dir) and not os.path.isdir(flat_dir):
+            os.rename(old_dir, flat_dir)
+        return False
+
+    print "Flat addons directory with %s addons: %s stat() calls for all addon lookups instead of %s (%sms instead " \
+          "of %sms)" % (stamp['addons'], stats_after, stats_before, ms_after, ms_before)
+    return stamp
+
+
+def _addons_flat_args(startup_args, stamp):
+    # Replace the --addons-path of the startup args with the flat addons directory
+    if not stamp:
+        return startup_args
+    return ['--addons-path=' + stamp['flat_dir'] if a.startswith('--addons-path=') else a for a in startup_args]
+
+
 def _addons_to_update(conf):
     # core
     langupdates = []
     core_updates = []
     if conf['core'] != conf['latest_core']:
-        odoo_base_addons = pj(conf['latest_core_dir'], 'odoo/openerp/addons')
-        odoo_addons = pj(conf['latest_core_dir'], 'odoo/addons')
-
-        loaded_addons = pj(conf['latest_core_dir'], 'addons-loaded')
-        if os.path.isdir(pj(loaded_addons, 'openerp')):
-            loaded_addons = pj(loaded_addons, 'openerp/addons')
-
+        core_index = _addons_index(conf['latest_core_dir'])
+        core_manifests = _addons_index(conf['latest_core_dir'], manifests=True)
         changed_files = _changed_files(conf['latest_core_dir'], conf['core'], conf['latest_core'])
-        updates, langupdates = _find_addons_byfile(changed_files, stop=[conf['latest_core_dir'], ])
-        for addon in _find_addons_inpaths([odoo_base_addons, odoo_addons, loaded_addons]):
+        updates, langupdates = _find_addons_byfile(changed_files, stop=[conf['latest_core_dir'], ], index=core_index,
+                                                   manifests=core_manifests)
+        for addon in _find_addons_inpaths(_latest_addons_paths(conf)[:3], index=core_index):
             if addon in updates:
                 core_updates.append(addon)
     if core_updates:
@@ -1043,8 +3166,11 @@ def _addons_to_update(conf):
         print 'No Updates for the odoo core found!'
 
     # instance-addons
+    instance_manifests = _addons_index(conf['latest_inst_dir'], manifests=True)
     changed_files = _changed_files(conf['latest_inst_dir'], conf['commit'], conf['latest_commit'])
-    instance_updates, instance_langupdates = _find_addons_byfile(changed_files, stop=[conf['latest_inst_dir'], ])
+    instance_updates, instance_langupdates = _find_addons_byfile(changed_files, stop=[conf['latest_inst_dir'], ],
+                                                                 index=_addons_index(conf['latest_inst_dir']),
+                                                                 manifests=instance_manifests)
     if instance_updates:
         print 'Updates for the instance addons found: %s' % instance_updates
     else:
@@ -1059,6 +3185,10 @@ def _addons_to_update(conf):
 def _finish_update(conf, success=str(), error=str(), restore_failed='False'):
     assert success != error, 'CRITICAL: error and success given for the update?!?'
 
+    # Write the report of the measured phases of this run
+    if _phase.report and conf.get('backup_dir'):
+        _phase_report(conf, success)
+
     # Write status.ini file
     try:
         status_ini = ConfigParser.SafeConfigParser()
@@ -1070,6 +3200,9 @@ def _finish_update(conf, success=str(), error=str(), restore_failed='False'):
             'restore_failed': restore_failed,
             'no_update': conf['no_update'],
         }
+        # Host facts for the recommended odoo options of the regular starts (see _odoo_tuning_args())
+        if conf['production_server']:
+            values.update(_odoo_tuning_host(conf))
         for key, value in values.iteritems():
             status_ini.set('options', str(key), str(value))
 
@@ -1090,6 +3223,10 @@ def _finish_update(conf, success=str(), error=str(), restore_failed='False'):
     except Exception as e:
         print 'ERROR: Could not update %s%s' % (conf['status_file'], pp(e))
 
+    # Remove the update journal (checkpoints are only needed to resume a failed update)
+    if success and conf.get('update_journal') and os.path.isfile(conf['update_journal']):
+        os.remove(conf['update_journal'])
+
     # Remove update.lock file
     try:
         if os.path.isfile(conf['update_lock_file']):
@@ -1155,25 +3292,363 @@ def _finish_update(conf, success=str(), error=str(), restore_failed='False'):
         exit(1)
 
 
-def _compare_urls(url1, url2, wanted_simmilarity=1.0):
+# Volatile parts of odoo pages that differ between two requests or between the production and the dry-run instance
+_page_volatile = [
+    (re.compile(r'csrf_token(["\']?\s*[:=]\s*|" value=)"[^"]*"'), 'csrf_token'),
+    (re.compile(r'/web/(css|js|content)/([\w.-]+)/[0-9a-f]{7,}'), r'/web/\1/\2'),
+    (re.compile(r'([?&](?:unique|session_id|v|t)=)[^"&\'\s]*'), r'\1'),
+    (re.compile(r'\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?'), 'DATE'),
+    (re.compile(r'\b\d{1,2}[./]\d{1,2}[./]\d{2,4}\b'), 'DATE'),
+    (re.compile(r'\b\d{1,2}:\d{2}(:\d{2})?\b'), 'TIME'),
+]
+
+
+def _page_shingles(html, replacements=(), size=5):
+    # Returns the set of hashed shingles (runs of size tokens) of a normalized page
+    # HINT: Tokens are tags and words so the structure and the text of the page are compared
+    for old, new in replacements:
+        html = html.replace(old, new)
+    for pattern, replacement in _page_volatile:
+        html = pattern.sub(replacement, html)
+    tokens = re.findall(r'<[^>]+>|[^<\s]+', html)
+    if len(tokens) < size:
+        return {hash(tuple(tokens))} if tokens else set()
+    return {hash(tuple(tokens[i:i + size])) for i in range(len(tokens) - size + 1)}
+
+
+def _page_similarity(html1, html2, replacements2=()):
+    # Jaccard similarity (0.0 - 1.0) of the shingles of two pages in linear time (difflib is quadratic)
+    shingles1 = _page_shingles(html1)
+    shingles2 = _page_shingles(html2, replacements=replacements2)
+    if not shingles1 and not shingles2:
+        return 1.0
+    return float(len(shingles1 & shingles2)) / len(shingles1 | shingles2)
+
+
+def _compare_urls(pairs, headers1=None, headers2=None, replacements2=(), workers=8, timeout=120):
+    # Fetch the url pairs [(url1, url2, threshold), ...] concurrently and compare their normalized pages
+    # HINT: replacements2 [(old, new), ...] are applied to the pages of url2 e.g. to replace the dry-run database name
+    # Returns True if all pairs have the same http status and a similarity >= threshold
+    urls = [(u, headers1 or {}) for u, _, _ in pairs] + [(u, headers2 or {}) for _, u, _ in pairs]
+    start = time.time()
+    pool = ThreadPool(workers)
     try:
-        url1 = urllib2.urlopen(url1)
-        url1_content = url1.read()
-        url2 = urllib2.urlopen(url2)
-        url2_content = url2.read()
-        simmilarity = difflib.SequenceMatcher(None, url1_content, url2_content).ratio()
-        print "Websites match to %s percent." % simmilarity * 100
-        if wanted_simmilarity >= simmilarity:
-            return True
+        pages = pool.map(lambda u: _fetch_url(u[0], u[1], timeout=timeout), urls)
+    finally:
+        pool.close()
+        pool.join()
+    pages1, pages2 = pages[:len(pairs)], pages[len(pairs):]
+
+    same = True
+    for (url1, url2, threshold), page1, page2 in zip(pairs, pages1, pages2):
+        if page1[1] != 200 or page1[1] != page2[1]:
+            similarity = 0.0
+        else:
+            similarity = _page_similarity(page1[4], page2[4], replacements2=replacements2)
+        ok = similarity >= threshold
+        same = same and ok
+        print "%s %5.1f%% (min %5.1f%%) http %s / %s %s <> %s" % ('OK  ' if ok else 'DIFF', similarity * 100,
+                                                                  threshold * 100, page1[1], page2[1], url1, url2)
+    print "Compared %s pages in %.1fs: %s" % (len(pairs), time.time() - start, 'same' if same else 'DIFFERENT')
+    return same
+
+
+def _compare_pages(conf):
+    # Returns [(path, threshold), ...] from compare_urls in instance.ini e.g.: "/:0.9,/web/login:0.98,/shop"
+    pages = []
+    for item in conf.get('compare_urls', '').split(','):
+        item = item.strip()
+        if not item or item == 'False':
+            continue
+        path, threshold = item.rsplit(':', 1) if ':' in item else (item, conf.get('compare_threshold', '0.9'))
+        try:
+            threshold = float(threshold)
+        except ValueError:
+            threshold = None
+        assert threshold is not None and 0 <= threshold <= 1 and path.strip().startswith('/'), \
+            "Invalid compare_urls entry '%s': use /path or /path:threshold with a threshold between 0 and 1" % item
+        pages.append((path.strip(), threshold))
+    return pages
+
+
+def _dry_run_compare(conf):
+    # Start the dry-run instance and compare its pages with the pages of the (still running) production instance
+    port = _instance_port(conf)
+    latest_port = _instance_port(conf, offset=10)
+    if not port:
+        print "WARNING: No xmlrpc port for the production instance! Compare webpages skipped!"
+        return True
+    if not _service_control(conf['latest_instance'], running=True, port=latest_port, conf=conf):
+        print "ERROR: Could not start the dry-run instance %s!" % conf['latest_instance']
+        return False
+    try:
+        pairs = [('http://127.0.0.1:%s%s' % (port, path), 'http://127.0.0.1:%s%s' % (latest_port, path), threshold)
+                 for path, threshold in _compare_pages(conf)]
+        return _compare_urls(pairs,
+                             headers1={'X-Odoo-dbfilter': '^%s$' % conf['db_name']},
+                             headers2={'X-Odoo-dbfilter': '^%s$' % conf['latest_db_name']},
+                             replacements2=[(conf['latest_db_name'], conf['db_name']),
+                                            (':%s' % latest_port, ':%s' % port)])
     except Exception as e:
-        print "ERROR: Could not compare websites:%s" % pp(e)
-    return False
+        print "ERROR: Could not compare the webpages!%s" % pp(e)
+        return False
+    finally:
+        _service_control(conf['latest_instance'], running=False)
+
+
+def _odoo_progress(conf, phase):
+    # Returns a line callback for shell_stream() that prints progress markers from the module loading log lines of
+    # odoo and stores the registry load time in conf[phase + '_registry_load']
+    # HINT: odoo >= 9 logs 'Registry loaded in', odoo 8 'N modules loaded in' for every graph (the last is the full)
+    state = {'total': 0, 'modules': set()}
+
+    def on_line(line):
+        loading = re.search(r'openerp\.modules\.loading: loading (\d+) modules', line)
+        if loading:
+            state['total'] = int(loading.group(1))
+            print "PROGRESS %s: loading %s modules" % (phase, state['total'])
+            return
+        module = re.search(r'openerp\.modules\.\w+: module ([\w.]+): ', line) or \
+            re.search(r'Loading module ([\w.]+) \(\d+/\d+\)', line)
+        if module and module.group(1) not in state['modules']:
+            state['modules'].add(module.group(1))
+            print "PROGRESS %s: module %s (%s modules done, %s in graph)" % (phase, module.group(1),
+                                                                           len(state['modules']), state['total'])
+            return
+        loaded = re.search(r'Registry loaded in ([0-9.]+)s', line) or re.search(r'modules loaded in ([0-9.]+)s', line)
+        if loaded:
+            conf[phase + '_registry_load'] = loaded.group(1)
+
+    return on_line
+
+
+def _odoo_logfile(odoo_cmd):
+    # The logfile of an odoo command from --logfile or from the logfile option of its config file (-c) or None
+    logfile = None
+    for i, arg in enumerate(odoo_cmd):
+        if arg in ('-c', '--config') and i + 1 < len(odoo_cmd):
+            try:
+                server_conf = ConfigParser.SafeConfigParser()
+                server_conf.read(odoo_cmd[i + 1])
+                if server_conf.has_option('options', 'logfile'):
+                    logfile = server_conf.get('options', 'logfile') or None
+            except Exception as e:
+                print "WARNING: Could not read the logfile from %s!%s" % (odoo_cmd[i + 1], pp(e))
+        elif arg.startswith('--config='):
+            logfile = _odoo_logfile(['-c', arg.split('=', 1)[1]]) or logfile
+    for i, arg in enumerate(odoo_cmd):
+        if arg == '--logfile' and i + 1 < len(odoo_cmd):
+            logfile = odoo_cmd[i + 1] or None
+        elif arg.startswith('--logfile='):
+            logfile = arg.split('=', 1)[1] or None
+    return logfile
+
+
+@contextmanager
+def _tail_file(path, on_line, interval=1):
+    # Call on_line(line) for every line appended to the file at path while in the context
+    # HINT: Used for the odoo progress if odoo logs to a logfile (then it writes nothing to stdout)
+    stop = threading.Event()
+
+    def tail():
+        while not os.path.isfile(path) and not stop.is_set():
+            stop.wait(interval)
+        if not os.path.isfile(path):
+            return
+        with open(path, 'r') as f:
+            f.seek(offset if offset <= os.path.getsize(path) else 0)
+            buf = ''
+            while True:
+                done = stop.is_set()
+                # HINT: seek() clears the EOF flag of the file so the lines appended since the last read are read
+                f.seek(0, os.SEEK_CUR)
+                data = f.read()
+                if data or (done and buf):
+                    buf += data
+                    lines = buf.split('\n')
+                    buf = '' if done and not data else lines.pop()
+                    for line in lines:
+                        try:
+                            on_line(line)
+                        except Exception as e:
+                            print "WARNING: Could not process log line!%s" % pp(e)
+                elif done:
+                    return
+                else:
+                    stop.wait(interval)
+
+    offset = os.path.getsize(path) if os.path.isfile(path) else 0
+    thread = threading.Thread(target=tail, name='tail_file')
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join(60)
+
+
+def _odoo_run_update(conf, odoo_cmd, odoo_cwd, timeout=10800, phase='update'):
+    # Update and install addons in ONE odoo process because every odoo start loads the full registry from scratch
+    # HINT: The progress and the registry load time are taken from the odoo log output: from stdout or, if odoo logs
+    #       to a logfile, from the lines odoo appends to the logfile during the run
+    args = []
+    if conf['addons_to_update_csv']:
+        print '%s%s' % ('Addons to update: ', conf['addons_to_update_csv'])
+        args += ['-u', conf['addons_to_update_csv']]
+    if conf['addons_to_install_csv']:
+        print '%s%s' % ('Addons to install: ', conf['addons_to_install_csv'])
+        args += ['-i', conf['addons_to_install_csv']]
+    if not args:
+        print "No addons to update or install for %s!" % phase
+        return True
+
+    on_line = _odoo_progress(conf, phase)
+    logfile = _odoo_logfile(odoo_cmd)
+    if logfile:
+        print "Odoo logs to %s: progress is read from the logfile" % logfile
+    with _host_slot('migration'), _host_slot('postgres'), _phase('migrate_' + phase):
+        start = time.time()
+        profile = None if phase == 'production' else 'migration'
+        if logfile:
+            with _tail_file(logfile, on_line):
+                shell_stream(odoo_cmd + args, cwd=odoo_cwd, timeout=timeout, user_name=conf['instance'],
+                             profile=profile)
+        else:
+            shell_stream(odoo_cmd + args, cwd=odoo_cwd, timeout=timeout, user_name=conf['instance'],
+                         on_line=on_line, profile=profile)
+    conf[phase + '_duration'] = '%.1f' % (time.time() - start)
+    print "Odoo %s run finished in %ss" % (phase, conf[phase + '_duration'])
+    _step_record(conf, phase, time.time() - start)
+
+    # Registry load time of the cold start (see _odoo_progress())
+    if conf.get(phase + '_registry_load'):
+        print "Odoo registry loaded in %ss" % conf[phase + '_registry_load']
+        # HINT: The separate -i run is never executed so its registry load is estimated by the one of this run
+        if conf['addons_to_update_csv'] and conf['addons_to_install_csv']:
+            conf[phase + '_registry_load_saved_estimate'] = conf[phase + '_registry_load']
+            print "Saved one cold registry load by running -u and -i together (estimated %ss)" \
+                  "" % conf[phase + '_registry_load']
+    return True
+
+
+class _DryRunDone(Exception):
+    pass
+
+
+class _UpdateTerminated(Exception):
+    pass
+
+
+def _update_terminate(signum, frame):
+    # SIGTERM of an update (e.g. the timeout of fleet-update.py) fails the running step so the update finishes with an
+    # error and removes its update.lock. Further signals are ignored until the update is finished.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise _UpdateTerminated('Update terminated by signal %s!' % signum)
+
+
+def _odoo_backup_verify(backup_dir):
+    # A backup is valid if the filestore exists and pg_restore can read the table of contents of the dump
+    try:
+        assert os.path.isdir(pj(backup_dir, 'filestore')), "Filestore missing in backup %s" % backup_dir
+        shell(['pg_restore', '--list', pj(backup_dir, 'db.dump')], timeout=600)
+        return True
+    except Exception as e:
+        print "WARNING: Backup %s is not valid!%s" % (backup_dir, pp(e))
+        return False
+
+
+def _update_journal_inputs(conf):
+    # Everything a checkpoint depends on: if one of these changes all checkpoints are invalid
+    try:
+        db_write_counter = _db_write_counter(conf, conf['db_name'])
+    except Exception as e:
+        print "WARNING: Could not get the database write counter!%s" % pp(e)
+        db_write_counter = 'unknown'
+    return OrderedDict([
+        ('commit', conf['commit']),
+        ('latest_commit', conf['latest_commit']),
+        ('core', conf['core']),
+        ('latest_core', conf['latest_core']),
+        ('addons_to_update', conf['addons_to_update_csv']),
+        ('addons_to_install', conf['addons_to_install_csv']),
+        ('db_write_counter', db_write_counter),
+    ])
+
+
+def _update_journal(conf):
+    # Load the checkpoints of the update journal if the inputs did not change, else start a new journal
+    conf['update_journal'] = pj(conf['backup_dir'], 'update_journal.ini')
+    inputs = _update_journal_inputs(conf)
+    checkpoints = dict()
+    if os.path.isfile(conf['update_journal']):
+        try:
+            journal = ConfigParser.SafeConfigParser()
+            journal.read(conf['update_journal'])
+            if dict(journal.items('inputs')) == dict(inputs):
+                checkpoints = dict(journal.items('checkpoints'))
+                print "Resume update from checkpoints: %s" % checkpoints.keys()
+            else:
+                print "Inputs changed since the last update. Checkpoints of %s are not valid!" % conf['update_journal']
+        except Exception as e:
+            print "WARNING: Could not read update journal %s!%s" % (conf['update_journal'], pp(e))
+
+    # Write the journal with the current inputs and the still valid checkpoints
+    journal = ConfigParser.SafeConfigParser()
+    for section, values in (('inputs', inputs), ('checkpoints', checkpoints)):
+        journal.add_section(section)
+        for key, value in values.iteritems():
+            journal.set(section, str(key), str(value))
+    with open(conf['update_journal'], 'w+') as writefile:
+        journal.write(writefile)
+    return checkpoints
+
+
+def _update_journal_interrupted(conf):
+    # The checkout checkpoint is only left in the update journal if the production phase was interrupted after the
+    # checkout of the instance repo and before the production database was migrated or promoted (it is removed right
+    # after the migration and after the restore of a failed update). Returns the checkpoints of the journal in this
+    # case else None.
+    # HINT: The instance repo is already at the latest commit so the update would look as if it was done
+    journal_file = pj(conf['backup_dir'], 'update_journal.ini')
+    if not os.path.isfile(journal_file):
+        return None
+    try:
+        journal = ConfigParser.SafeConfigParser()
+        journal.read(journal_file)
+        if journal.has_option('checkpoints', 'checkout'):
+            return dict(journal.items('checkpoints'))
+    except Exception as e:
+        print "WARNING: Could not read update journal %s!%s" % (journal_file, pp(e))
+    return None
+
+
+def _update_checkpoint(conf, name, value, section='checkpoints'):
+    # Add (or remove if value is None) a checkpoint in the update journal
+    try:
+        journal = ConfigParser.SafeConfigParser()
+        journal.read(conf['update_journal'])
+        if value is None:
+            journal.remove_option(section, name)
+        else:
+            journal.set(section, name, str(value))
+        with open(conf['update_journal'], 'w+') as writefile:
+            journal.write(writefile)
+        print "Update journal checkpoint %s: %s" % (name, value)
+    except Exception as e:
+        print "WARNING: Could not write checkpoint %s to %s!%s" % (name, conf.get('update_journal'), pp(e))
 
 
 def _odoo_update(conf):
     print '\n---------- UPDATE START %s ----------' % conf['start_time']
-    timeout_for_updates = 10800
-    print '\ntimeout_for_updates: %s sec' % timeout_for_updates
+
+    # 0.) An earlier update was interrupted after the checkout of the instance repo for the production update
+    interrupted = _update_journal_interrupted(conf)
+    if interrupted:
+        return _finish_update(conf, error='CRITICAL: An earlier update was interrupted after the checkout of %s! '
+                                          'The production database may be partially updated. Restore the backup '
+                                          '%s manually!\n' % (interrupted['checkout'], interrupted.get('backup')),
+                              restore_failed='True')
 
     # 1.) No Changes at all
     if conf['commit'] == conf['latest_commit']:
@@ -1184,11 +3659,30 @@ def _odoo_update(conf):
         print 'Search for addons to update.'
         addons_to_update = _addons_to_update(conf)[0]
         if addons_to_update:
-            if len(addons_to_update) <= 6:
-                conf['addons_to_update_csv'] = ",".join([str(item) for item in conf['addons_to_update'] + addons_to_update])
-            else:
-                print 'More than 6 addons to update found! Using "all" instead of the individual addons list!'
+            if 'all' in conf['addons_to_update']:
+                print 'Forced update of "all" addons found in instance.ini!'
                 conf['addons_to_update_csv'] = "all"
+                try:
+                    conf['update_addons_count'] = int(_psql(conf['db_url'], "SELECT count(*) FROM ir_module_module "
+                                                                            "WHERE state = 'installed';",
+                                                            timeout=60))
+                except Exception as e:
+                    print "WARNING: Could not count the installed addons!%s" % pp(e)
+            else:
+                # HINT: odoo will also upgrade all installed addons that depend on the addons in the update set
+                # HINT: The core index is only built here (and in _addons_to_update() for a core change)
+                manifests = dict(_addons_index(conf['latest_core_dir'], manifests=True))
+                manifests.update(_addons_index(conf['latest_inst_dir'], manifests=True))
+                addons_graph = _addons_graph(manifests, _latest_addons_paths(conf))
+                update_set, upgrade_closure = _minimal_update_set(conf['addons_to_update'] + addons_to_update,
+                                                                  addons_graph)
+                print 'Minimal update set: %s' % update_set
+                print 'Addons odoo will upgrade (if installed) %s: %s' % (len(upgrade_closure), upgrade_closure)
+                conf['addons_to_update_csv'] = ",".join([str(item) for item in update_set])
+                conf['update_addons_count'] = len(upgrade_closure)
+        # HINT: The number of addons to update and install scales the timeout of the dry-run and production update
+        conf['update_addons_count'] = conf.get('update_addons_count', 0) + \
+            len(filter(None, conf['addons_to_install_csv'].split(',')))
     except Exception as e:
         return _finish_update(conf, error='CRITICAL: Search for addons to update failed!' + pp(e))
 
@@ -1204,14 +3698,46 @@ def _odoo_update(conf):
     # 3.) Update is required
     print '\nUpdate is required!'
 
+    # Check compare_urls of instance.ini before the backup and the dry-run
+    try:
+        _compare_pages(conf)
+    except Exception as e:
+        return _finish_update(conf, error='CRITICAL: compare_urls in instance.ini not valid! Skipping update.' + pp(e))
+
+    # Timeouts and ETA from the step durations of earlier updates of this instance
+    conf.update(_instance_size(conf))
+    timeout_for_updates = _step_timeout(conf, 'dry_run', 10800)
+    print '\ntimeout_for_updates: %s sec' % timeout_for_updates
+    _update_eta(conf, ['backup', 'restore', 'dry_run', 'production'])
+
+    # Checkpoints of an earlier failed update with the same inputs
+    checkpoints = _update_journal(conf)
+
     # Backup
     try:
-        print 'Backup before update: %s' % conf['backup']
-        backup = _odoo_backup(conf, backup_target=conf['backup'])
+        if checkpoints.get('backup') and _odoo_backup_verify(checkpoints['backup']):
+            print 'Resume update: Using verified backup %s' % checkpoints['backup']
+            backup = checkpoints['backup']
+            conf['backup_write_counter'] = checkpoints.get('backup_write_counter', '')
+        else:
+            checkpoints = dict()
+            if conf['promote_dry_run']:
+                conf['backup_write_counter'] = _db_write_counter(conf, conf['db_name'])
+                print 'Database write counter before backup: %s' % conf['backup_write_counter']
+            print 'Backup before update: %s' % conf['backup']
+            with _phase('backup'):
+                backup = _odoo_backup(conf, backup_target=conf['backup'])
+                assert _odoo_backup_verify(backup), 'CRITICAL: Backup verification failed!'
+            _update_checkpoint(conf, 'backup', backup)
+            _update_checkpoint(conf, 'backup_write_counter', conf.get('backup_write_counter', ''))
     except Exception as e:
         _finish_update(conf, error='CRITICAL: Backup before update failed. Skipping update.' + pp(e))
         return False
 
+    # Server Script and command working directory
+    odoo_server = [pj(conf['latest_core_dir'], 'odoo/openerp-server'), ]
+    odoo_cwd = pj(conf['latest_core_dir'], 'odoo')
+
     # ----
     # TODO: Run language Updates?
     # ----
@@ -1219,6 +3745,12 @@ def _odoo_update(conf):
     # 3.1) Dry-Run the update
     print "-- Dry-Run the update."
     try:
+        # The dry-run database was already migrated and not changed since
+        if checkpoints.get('dry_run') and checkpoints['dry_run'] == _db_write_counter(conf, conf['latest_db_name']):
+            print 'Resume update: Dry-run database %s is already migrated!' % conf['latest_db_name']
+            conf['dry_run_write_counter'] = checkpoints['dry_run']
+            raise _DryRunDone()
+
         # Stop Service
         print "Stopping service %s." % conf['latest_instance']
         if conf['production_server']:
@@ -1227,45 +3759,46 @@ def _odoo_update(conf):
         else:
             print "WARNING: Development server found! Stopping the service skipped!"
 
-        # Restore backup
-        _odoo_restore(backup, conf, data_dir_target=conf['latest_data_dir'], database_target_url=conf['latest_db_url'])
-
-        # Server Script and command working directory
-        odoo_server = [pj(conf['latest_core_dir'], 'odoo/openerp-server'), ]
-        odoo_cwd = pj(conf['latest_core_dir'], 'odoo')
-
-        # Update addons in the dry-run instance
-        if conf['addons_to_update_csv']:
-            print '\n-- Updating the dry-run database. (Please be patient)'
-            print '%s%s' % ('Addons to update: ', conf['addons_to_update_csv'])
-            args = ['--stop-after-init', ]
-            args += ['-u', conf['addons_to_update_csv']]
-            shell(odoo_server + conf['latest_startup_args'] + args, cwd=odoo_cwd, timeout=timeout_for_updates,
-                  user_name=conf['instance'])
-
-        # Install addons in the dry-run instance
-        if conf['addons_to_install_csv']:
-            print '\n-- Install addons in the dry-run database. (Please be patient)'
-            print '%s%s' % ('Addons to install: ', conf['addons_to_install_csv'])
-            args = ['--stop-after-init', ]
-            args += ['-i', conf['addons_to_install_csv']]
-            shell(odoo_server + conf['latest_startup_args'] + args, cwd=odoo_cwd, timeout=timeout_for_updates,
-                  user_name=conf['instance'])
+        # Restore backup (or use the standby database kept in sync by logical replication)
+        with _phase('restore_dry_run'), _standby_filestore_lock(conf):
+            if not _standby_activate(conf):
+                _odoo_restore(backup, conf, data_dir_target=conf['latest_data_dir'],
+                              database_target_url=conf['latest_db_url'])
+
+        # Flat addons directory for the dry-run (the registry load time is stored as dry_run_registry_load)
+        addons_flat = _addons_flat([os.path.normpath(pj(odoo_cwd, d)) for d in conf['latest_addons_path']],
+                                   _git_cache_file(conf['latest_inst_dir'], 'addons-flat'))
+        if addons_flat:
+            conf['dry_run_addons_flat'] = '%s addons, %s instead of %s stat() calls for the addon lookups' \
+                                          '' % (addons_flat['addons'], addons_flat['lookup_stats_after'],
+                                                addons_flat['lookup_stats_before'])
+            if conf['production_server']:
+                shell(['chown', '-R', '-h', conf['instance'] + ':' + conf['instance'], addons_flat['flat_dir']])
+
+        # Update and install addons in the dry-run instance
+        print '\n-- Updating the dry-run database. (Please be patient)'
+        _odoo_run_update(conf, odoo_server + _addons_flat_args(conf['latest_startup_args'], addons_flat) +
+                         ['--stop-after-init', ], odoo_cwd, timeout=timeout_for_updates, phase='dry_run')
+        conf['dry_run_write_counter'] = _db_write_counter(conf, conf['latest_db_name'])
+        _update_checkpoint(conf, 'dry_run', conf['dry_run_write_counter'])
+    except _DryRunDone:
+        pass
     except Exception as e:
         return _finish_update(conf, error='CRITICAL: Update dry-run failed!' + pp(e))
 
-    # 3.1.1) Compare webpages (and permanently Start the Dry-Run Instance).
-    # print "\n-- Start the Dry-Run instance service permanently and check webpages for any changes."
-    # if conf['production_server']:
-    #     # Start latest instance
-    #     if _service_control(conf['latest_instance'], running=True):
-    #         url = 'http://'+conf['instance']+'.datadialgo.net'
-    #         latest_url = 'http://'+conf['latest_instance']+'.datadialgo.net'
-    #         if not _compare_urls(url, latest_url, wanted_simmilarity=0.8):
-    #             print "WARNING: Webpages seem to be different!"
-    #             # return _finish_update(conf, error='CRITICAL: Websites are different!\n')
-    # else:
-    #     print "WARNING: Development server found! Compare Webpages skipped!"
+    # 3.1.1) Compare the webpages of the production and the dry-run instance (compare_urls in instance.ini)
+    if _compare_pages(conf):
+        if conf['production_server'] and _service_exists(conf['latest_instance']):
+            print "\n-- Compare the webpages of the production and the dry-run instance."
+            with _phase('compare_urls'):
+                same = _dry_run_compare(conf)
+            conf['compare_urls_same'] = str(same)
+            if not same and conf['compare_gate'] != 'False':
+                return _finish_update(conf, error='CRITICAL: Webpages of the dry-run instance are different!\n')
+            if not same:
+                print "WARNING: Webpages of the dry-run instance are different!"
+        else:
+            print "WARNING: Development server or no dry-run service found! Compare webpages skipped!"
 
     # ---
     # TODO: Run language Updates?
@@ -1274,72 +3807,94 @@ def _odoo_update(conf):
     # 3.2) Update of production instance
     print "\n-- Run the final update on production instance. Service will be stopped!"
     if conf['production_server']:
+        # HINT: The slots are taken before the production service is stopped so production is never down while
+        #       waiting for a free slot (the production update takes them again, see _host_slot()). The production
+        #       marker tells fleet-update.py not to kill this update on its timeout.
         try:
-            # Stop sosync1 service if availabel
-            sosync_v1_service = conf['instance'] + '_sosync'
-            print "\nStop sosync v1 service %s if available." % sosync_v1_service
-            try:
-                _service_control(sosync_v1_service, running=False)
-            except Exception as e:
-                print "Sosync v1 service not available or it could not be stopped!\n%s" % repr(e)
-
-            # Stop service
-            print "\nStop service %s." % conf['instance']
-            if not _service_control(conf['instance'], running=False):
-                raise Exception('ERROR: Could not stop service %s' % conf['instance'])
-
-            # Get correct instance commit
-            print '\nCheckout the correct commit ID for instance repo %s' % conf['latest_commit']
-            _git_checkout(conf['instance_dir'], conf['latest_commit'], user_name=conf['instance'])
-
-            # Startup Args
-            args = ['-c', conf['config_file'], '--stop-after-init', ]
-            args += conf['startup_args']
-
-            # Update addons in productive instance
-            if conf['addons_to_update_csv']:
-                print '\n-- Updating the production database. (Please be patient)'
-                print '%s%s' % ('Addons to update: ', conf['addons_to_update_csv'])
-                shell(odoo_server + ['-u', conf['addons_to_update_csv']] + args, cwd=odoo_cwd,
-                      timeout=timeout_for_updates, user_name=conf['instance'])
-
-            # Install addons in productive instance
-            if conf['addons_to_install_csv']:
-                print '\n-- Install addons in the production database. (Please be patient)'
-                print '%s%s' % ('Addons to install: ', conf['addons_to_install_csv'])
-                shell(odoo_server + ['-i', conf['addons_to_install_csv']] + args, cwd=odoo_cwd,
-                      timeout=timeout_for_updates, user_name=conf['instance'])
-
-            # Update successful
-            print "\nUpdate successful!\nStart service %s" % conf['instance']
-            if _service_control(conf['instance'], running=True):
-                _finish_update(conf, success='Final update successful and instance UP!\n')
-            else:
-                _finish_update(conf, error='WARNING: Final update successful but instance DOWN!\n')
+            with _host_slot('migration'), _host_slot('postgres'), _production_marker(conf):
+                try:
+                    # Stop sosync1 service if availabel
+                    sosync_v1_service = conf['instance'] + '_sosync'
+                    print "\nStop sosync v1 service %s if available." % sosync_v1_service
+                    try:
+                        _service_control(sosync_v1_service, running=False)
+                    except Exception as e:
+                        print "Sosync v1 service not available or it could not be stopped!\n%s" % repr(e)
+
+                    # Stop service
+                    print "\nStop service %s." % conf['instance']
+                    if not _service_control(conf['instance'], running=False):
+                        raise Exception('ERROR: Could not stop service %s' % conf['instance'])
+
+                    # Get correct instance commit
+                    print '\nCheckout the correct commit ID for instance repo %s' % conf['latest_commit']
+                    with _phase('git_checkout_instance'):
+                        _git_checkout(conf['instance_dir'], conf['latest_commit'], user_name=conf['instance'])
+                    _update_checkpoint(conf, 'checkout', conf['latest_commit'])
+
+                    # Promote the already migrated dry-run database if production had no writes since the backup
+                    promoted = False
+                    if conf['promote_dry_run']:
+                        with _phase('promote'):
+                            promoted = _promote_dry_run(conf)
+                    if promoted:
+                        print '\n-- Dry-run database and filestore promoted to production. ' \
+                              'Production update skipped!'
+                    else:
+                        # Startup Args
+                        args = ['-c', conf['config_file'], '--stop-after-init', ]
+                        args += conf['startup_args']
+
+                        # Update and install addons in productive instance
+                        print '\n-- Updating the production database. (Please be patient)'
+                        _odoo_run_update(conf, odoo_server + args, odoo_cwd,
+                                         timeout=_step_timeout(conf, 'production', timeout_for_updates),
+                                         phase='production')
+
+                    # The migration window is closed: a failing service start must not look like an interrupted update
+                    _update_checkpoint(conf, 'checkout', None)
+
+                    # Update successful
+                    print "\nUpdate successful!\nStart service %s" % conf['instance']
+                    if _service_control(conf['instance'], running=True, port=_instance_port(conf), conf=conf):
+                        _finish_update(conf, success='Final update successful and instance UP!\n')
+                    else:
+                        _finish_update(conf, error='WARNING: Final update successful but instance DOWN!\n')
 
-        except Exception as e:
-            print "\nCRITICAL: Final update on production instance failed! %s" % pp(e)
-            # Update failed - try to restore backup
-            try:
-                # Restore correct commit
-                print "\n-- Restore pre-update instance commit."
-                _git_checkout(conf['instance_dir'], conf['commit'], user_name=conf['instance'])
+                except Exception as e:
+                    print "\nCRITICAL: Final update on production instance failed! %s" % pp(e)
+                    # Update failed - try to restore backup
+                    try:
+                        # Restore correct commit
+                        print "\n-- Restore pre-update instance commit."
+                        _git_checkout(conf['instance_dir'], conf['commit'], user_name=conf['instance'])
+                        _update_checkpoint(conf, 'checkout', None)
 
-                # Restore database and data_dir
-                print "\n -- Restore pre-update database and filestore."
-                _odoo_restore(backup, conf, data_dir_target=conf['data_dir'], database_target_url=conf['db_url'])
+                        # Restore database and data_dir
+                        print "\n -- Restore pre-update database and filestore."
+                        with _phase('restore_production'):
+                            _odoo_restore(backup, conf, data_dir_target=conf['data_dir'],
+                                          database_target_url=conf['db_url'], wait_for_slots=False)
 
-            except Exception as e:
-                # RESTORE FAILED!
-                return _finish_update(conf, error='CRITICAL: Update failed! DATABASE NOT RESTORED!' + pp(e),
-                                      restore_failed='True')
-
-            # Restore successful after failed update
-            print "\nStart service %s" % conf['instance']
-            if _service_control(conf['instance'], running=True):
-                _finish_update(conf, error='ERROR: UPDATE failed! Restore successful! Instance UP!\n')
-            else:
-                _finish_update(conf, error='CRITICAL: UPDATE failed! Restore successful! Instance DOWN!\n')
+                        # Production is at the state of the backup again: a retry can use the backup and the dry-run
+                        _update_checkpoint(conf, 'db_write_counter', _db_write_counter(conf, conf['db_name']),
+                                           section='inputs')
+
+                    except Exception as e:
+                        # RESTORE FAILED!
+                        return _finish_update(conf, error='CRITICAL: Update failed! DATABASE NOT RESTORED!' + pp(e),
+                                              restore_failed='True')
+
+                    # Restore successful after failed update
+                    print "\nStart service %s" % conf['instance']
+                    if _service_control(conf['instance'], running=True, port=_instance_port(conf), conf=conf):
+                        _finish_update(conf, error='ERROR: UPDATE failed! Restore successful! Instance UP!\n')
+                    else:
+                        _finish_update(conf, error='CRITICAL: UPDATE failed! Restore successful! Instance DOWN!\n')
+
+        except AssertionError as e:
+            return _finish_update(conf, error='CRITICAL: No free slot for the production update! Production service '
+                                              'not stopped.' + pp(e))
 
     else:
         print "WARNING: Development server found! Run the final update skipped!"
@@ -1355,14 +3910,44 @@ if __name__ == "__main__":
     #                                                     'Correct: --instance_dir /odoo/dadi'
     # TODO: Check if --addons sys.argv
 
+    # Preloader of a core: import odoo once and fork the instances of this core (no --instance-dir needed)
+    if '--preload' in sys.argv:
+        preload_core_dir = os.path.abspath(sys.argv[sys.argv.index('--preload') + 1])
+        _preload_serve(preload_core_dir)
+        exit(0)
+
+    # Prefetch repos and cores of all instances for the next update (no --instance-dir needed)
+    if '--prefetch' in sys.argv:
+        prefetch_index = sys.argv.index('--prefetch') + 1
+        prefetch_root_dir = sys.argv[prefetch_index] if len(sys.argv) > prefetch_index \
+            and not sys.argv[prefetch_index].startswith('-') else '/opt/online'
+        assert os.path.isdir(prefetch_root_dir), 'CRITICAL: --prefetch root directory not found: %s' \
+                                                 '' % prefetch_root_dir
+        exit(0 if _prefetch(prefetch_root_dir) else 1)
+
     # Get the instance_dir
     print "Check the instance dir"
     instance_dir = sys.argv[sys.argv.index('--instance-dir') + 1]
     assert os.path.exists(instance_dir), 'CRITICAL: --instance_dir directory not found or set: %s' % instance_dir
 
     # Get the odoo configuration and/or defaults
-    print "Get the odoo config"
-    odoo_config = _odoo_config(instance_dir)
+    # HINT: A regular start uses the cached config (launch plan) of the last regular start if the config files, the
+    #       instance commit and the command line are unchanged. This skips all git calls and filesystem checks.
+    regular_start = not any(a in sys.argv for a in ['--backup', '--restore', '--standby', '--update'])
+    launch_start = time.time()
+    launch_key = _launch_plan_key(instance_dir) if regular_start else False
+    launch_plan = _launch_plan(instance_dir, launch_key) if regular_start else False
+    if launch_plan:
+        odoo_config = _launch_plan_apply(launch_plan)
+        print "Odoo config loaded from launch plan in %.1fms" % ((time.time() - launch_start) * 1000)
+    else:
+        print "Get the odoo config"
+        argv_before = list(sys.argv)
+        odoo_config = _odoo_config(instance_dir)
+        if regular_start:
+            _launch_plan_write(instance_dir, launch_key, sys.argv[len(argv_before):], odoo_config)
+    if regular_start:
+        odoo_config['tuning_args'] = _odoo_tuning_args(odoo_config)
 
     # Create a backup
     if '--backup' in sys.argv:
@@ -1388,13 +3973,28 @@ if __name__ == "__main__":
         sys.argv.pop(sys.argv.index('--restore') + 1)
         sys.argv.remove('--restore')
 
+    # Create or sync the standby database for the dry-run update
+    if '--standby' in sys.argv:
+        print '\n---- Starting standby setup (--standby given)'
+        odoo_config.update(_odoo_latest_db_config(odoo_config))
+        try:
+            _standby_setup(odoo_config)
+        except Exception as e:
+            print 'ERROR: --standby given but could not setup the standby database!%s' % pp(e)
+            exit(1)
+        exit(0)
+
     # Update FS-Online
     if '--update' in sys.argv:
         print '\n---- Starting update check (--update given)'
         # Add additional update configuration
         odoo_config.update(_odoo_update_config(odoo_config))
         if odoo_config['run_update']:
-            _odoo_update(odoo_config)
+            signal.signal(signal.SIGTERM, _update_terminate)
+            try:
+                _odoo_update(odoo_config)
+            except _UpdateTerminated as e:
+                _finish_update(odoo_config, error='CRITICAL: Update terminated!' + pp(e))
         else:
             _finish_update(odoo_config, success='WARNING: run_update is set to False!\n')
 
@@ -1406,8 +4006,14 @@ if __name__ == "__main__":
         if '--update' in sys.argv:
             sys.argv.remove('--update')
 
-        # Set Startup Args (--addons-path for regular start or dev defaults)
-        sys.argv += odoo_config['startup_args']
+        # Flat addons directory (one symlink per addon) to cut the stat() calls of odoo's addon lookups
+        addons_flat = _addons_flat([os.path.normpath(pj(odoo_config['core_dir'], 'odoo', d))
+                                    for d in odoo_config['addons_path']],
+                                   _git_cache_file(odoo_config['instance_dir'], 'addons-flat'))
+        odoo_config['startup_args'] = _addons_flat_args(odoo_config['startup_args'], addons_flat)
+
+        # Set Startup Args (--addons-path for regular start or dev defaults and the recommended options)
+        sys.argv += odoo_config['startup_args'] + odoo_config.get('tuning_args', [])
 
         # Change path to correct core and folder odoo
         sys.path[0] = sys.argv[0] = pj(odoo_config['core_dir'], 'odoo')
@@ -1430,6 +4036,12 @@ if __name__ == "__main__":
         # This is no option because it would create a new process that can not be stopped by the init script
         # os.system(odoo_start)
 
+        # Fork odoo from the preloader of the core (see --preload) or import and start odoo in this process
+        _first_request_timer(odoo_config, launch_start)
+        preload_exit_code = _preload_start(odoo_config)
+        if preload_exit_code is not False:
+            exit(preload_exit_code)
+
         # ATTENTION: To make this work openerp-gevent must be in some path that python can load!
         import odoo
         odoo.main()
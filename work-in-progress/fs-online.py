@@ -28,9 +28,10 @@ HINT: This script has 4 main sections:
   - MAIN ROUTINE
   - START
 """
-from shell_tools import shell
+from shell_tools import shell, shell_stream, profile_totals
 import git_tools as git
 import odoo_tools as ot
+from pipeline_tools import Pipeline
 #
 import argparse
 import os
@@ -42,10 +43,13 @@ import shutil
 import time
 import datetime
 import zipfile
+import json
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from contextlib import closing
 from xmlrpclib import ServerProxy
+import xmlrpclib
+import urllib2
 
 import logging
 
@@ -100,28 +104,61 @@ def _service_exists(service_name):
     return False
 
 
-def _service_running(service):
+def _service_running(service, quiet=False):
     pidfile = pj('/var/run', service + '.pid')
-    logging.debug("Check if service %s ist running by pidfile at %s" % (service, pidfile))
+    if not quiet:
+        logging.debug("Check if service %s ist running by pidfile at %s" % (service, pidfile))
     if os.path.isfile(pidfile):
         with open(pidfile, 'r') as pidfile:
             pid = str(pidfile.readline()).rstrip('\n')
             proc_dir = pj('/proc', pid)
-            logging.debug("Process ID from pidfile %s" % pid)
-            logging.debug("Process directory to check for if service is running %s" % proc_dir)
-            if os.path.exists(proc_dir):
-                logging.debug("Service %s is running!" % service)
+            if not quiet:
+                logging.debug("Process ID from pidfile %s" % pid)
+                logging.debug("Process directory to check for if service is running %s" % proc_dir)
+            if pid and os.path.exists(proc_dir):
+                if not quiet:
+                    logging.debug("Service %s is running!" % service)
                 return True
-    logging.debug("Service %s is NOT running!" % service)
+    if not quiet:
+        logging.debug("Service %s is NOT running!" % service)
     return False
 
 
-def _service_control(service, state, wait=10):
+def _wait_for(check, timeout=120, delay=0.2, backoff=2, max_delay=5):
+    """
+    Call check() with an exponential backoff until it returns True
+
+    :param check: (function) returns True if the wanted state is reached
+    :param timeout: (int) max seconds to wait
+    :return: (float) seconds it took or (boolean) False if the timeout was reached
+    """
+    start_time = time.time()
+    while True:
+        if check():
+            return time.time() - start_time
+        remaining = timeout - (time.time() - start_time)
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, max_delay, remaining))
+        delay *= backoff
+
+
+def _instance_ready(port, host='127.0.0.1', timeout=5):
+    # Health probe: odoo answers the xmlrpc call common.version() as soon as the http server is up
+    try:
+        request = urllib2.Request('http://%s:%s/xmlrpc/common' % (host, port),
+                                  data=xmlrpclib.dumps((), 'version'), headers={'Content-Type': 'text/xml'})
+        return urllib2.urlopen(request, timeout=timeout).getcode() == 200
+    except Exception:
+        return False
+
+
+def _service_control(service, state, timeout=120, port=None):
     logging.info("Service %s will be %sed" % (service, state))
     # Basic Checks
-    assert state in ["start", "stop", "restart", "reload"], '_service_control(service, state, wait=10) ' \
+    assert state in ["start", "stop", "restart", "reload"], '_service_control(service, state, timeout=120) ' \
                                                             '"state" must be start, stop, restart or reload'
-    assert _service_exists(service), "Service %s not found at /etc/init.d/%s"
+    assert _service_exists(service), "Service %s not found at /etc/init.d/%s" % (service, service)
     # Service is already running and should be started
     if state == "start" and _service_running(service):
         logging.warn("Nothing to do! Service %s is already running." % service)
@@ -134,17 +171,20 @@ def _service_control(service, state, wait=10):
     # Set service state
     shell(['service', service, state])
 
-    # Wait for service to change state
-    logging.debug("Waiting %s seconds for service to change state")
-    time.sleep(wait)
+    # Wait for service to change state (pidfile and /proc for stop and also the http health probe for start)
+    if state == "stop":
+        check = lambda: not _service_running(service, quiet=True)
+    else:
+        check = lambda: _service_running(service, quiet=True) and (port is None or _instance_ready(port))
+    logging.debug("Waiting up to %s seconds for service %s to change state" % (timeout, service))
+    transition_time = _wait_for(check, timeout=timeout)
 
     # Return
-    if (service in ["start", "restart", "reload"] and _service_running(service)) or \
-       (service == "stop" and not _service_running(service)):
-        logging.info("Service %s successfully changed state to %sed" % (service, state))
+    if transition_time is not False:
+        logging.info("Service %s successfully changed state to %sed in %.1fs" % (service, state, transition_time))
         return True
     else:
-        logging.error('Service %s could not be %sed' % (service, state))
+        logging.error('Service %s could not be %sed within %ss' % (service, state, timeout))
         return False
 
 
@@ -157,13 +197,13 @@ def inifile_to_dict(inifile, section='options'):
     return dict(cparser.items(section))
 
 
-class Settings:
+class Settings(object):
     def __init__(self, instance_dir, startup_args=[], log_file=''):
         instance_dir = os.path.abspath(instance_dir)
         assert os.path.isdir(instance_dir), "Instance directory not found at %s!" % instance_dir
 
         # Make sure there is an instance.ini file
-        instance_ini_file = pj(known_args.instance_dir, 'instance.ini')
+        instance_ini_file = pj(instance_dir, 'instance.ini')
         assert os.path.isfile(instance_ini_file), "File 'instance.ini' not found at %s!" % instance_ini_file
 
         # Basics
@@ -323,6 +363,83 @@ class Settings:
                                                for key, value in postgres_db_con_string.iteritems())
 
 
+def _launch_plan_key(instance_dir, startup_args, log_file, core_dir):
+    # Everything the Settings depend on: config files, init script (production server), core commit and cmd args
+    # HINT: Only stat() calls and the git HEAD files are used - no subprocess
+    server_conf_file = (startup_args[startup_args.index('-c')+1] if '-c' in startup_args
+                        else pj(instance_dir, 'server.conf'))
+    files = []
+    for path in (server_conf_file, pj(instance_dir, 'instance.ini'), pj('/etc/init.d', os.path.basename(instance_dir))):
+        try:
+            files.append([path, os.stat(path).st_mtime])
+        except OSError:
+            files.append([path, None])
+    return {'files': files,
+            'core_head': git.get_head(core_dir),
+            'uid': os.getuid(),
+            'startup_args': list(startup_args),
+            'log_file': log_file}
+
+
+def _str(data):
+    # Convert the unicode strings from json.load() back to str
+    if isinstance(data, dict):
+        return dict((_str(k), _str(v)) for k, v in data.iteritems())
+    if isinstance(data, list):
+        return [_str(i) for i in data]
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
+
+
+def launch_settings(instance_dir, startup_args=[], log_file=''):
+    """
+    Settings for an instance start from the launch plan (cached Settings) of the last start if the config files, the
+    core commit and the startup args are unchanged. Otherwise the Settings are computed and the launch plan is updated.
+
+    :param instance_dir: (str) path to the instance directory
+    :param startup_args: (list) odoo startup args
+    :param log_file: (str) log file
+    :return: (Settings) instance settings
+    """
+    instance_dir = os.path.abspath(instance_dir)
+    startup_args = list(startup_args)
+    plan_file = pj(git.git_dir(instance_dir), 'online_tools', 'fs-online_launch_plan.json')
+    start_time = time.time()
+
+    # Try to use the launch plan
+    try:
+        with open(plan_file, 'r') as f:
+            plan = _str(json.load(f))
+        key = _launch_plan_key(instance_dir, startup_args, log_file, plan['settings']['instance_core_dir'])
+        # HINT: A plan readable by others (written by an older version) is computed and written again
+        if key['core_head'] and plan['key'] == key and not os.stat(plan_file).st_mode & 0o077:
+            s = Settings.__new__(Settings)
+            s.__dict__.update(plan['settings'])
+            log.info("Settings loaded from launch plan %s in %.1fms" % (plan_file, (time.time() - start_time) * 1000))
+            return s
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    # Compute the settings and store the launch plan
+    s = Settings(instance_dir, startup_args=list(startup_args), log_file=log_file)
+    key = _launch_plan_key(instance_dir, startup_args, log_file, s.instance_core_dir)
+    if key['core_head']:
+        try:
+            if not os.path.isdir(os.path.dirname(plan_file)):
+                os.makedirs(os.path.dirname(plan_file))
+            tmp_file = plan_file + '.tmp' + str(os.getpid())
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            # ATTENTION: The settings contain the database password: only the user of this start can read the plan
+            with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+                json.dump({'key': key, 'settings': s.__dict__}, f, indent=2)
+            os.rename(tmp_file, plan_file)
+        except Exception as e:
+            log.warning("Could not write the launch plan %s! %s" % (plan_file, repr(e)))
+    return s
+
+
 def _odoo_access_check(instance_dir, odoo_config=None):
     instance_dir = os.path.abspath(instance_dir)
     instance = os.path.basename(instance_dir)
@@ -375,7 +492,7 @@ def backup(instance_dir, backup_file='', odoo_cmd_startup_args=[], log_file=''):
         start_str = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H-%M-%S')
         assert core_id, "No commit tag or commit id found for odoo core at %s" % s.instance_core_dir
         backup_name = instance + '_' + start_str + '_' + core_id + '.zip'
-        backup_file = pj(known_args.instance_dir, 'update', backup_name)
+        backup_file = pj(instance_dir, 'update', backup_name)
 
     # Clean backup_file path
     backup_file = os.path.abspath(backup_file)
@@ -503,11 +620,126 @@ def restore(instance_dir, backup_zip_file, odoo_cmd_startup_args=[], log_file=''
     return True
 
 
-def update(settings=None):
+def update(instance_dir, odoo_cmd_startup_args=[], log_file='', max_workers=4):
+    """
+    Dry-Run the update of an FS-Online instance in the update instance [instance]_update
+
+    The update is a dependency graph of steps (see pipeline_tools.Pipeline) so independent steps like the
+    pre-update backup, the fetch of the instance repo and the core checkout run concurrently.
+
+    :param instance_dir: (str) Directory of the instance to update
+    :param odoo_cmd_startup_args: (list) with cmd options
+    :param log_file: (str) Full Path and file name
+    :param max_workers: (int) Max number of steps running at the same time
+    :return: (dict) step results
+    """
+    instance_dir = os.path.abspath(instance_dir)
+    instance = os.path.basename(instance_dir)
     logging.info('----------------------------------------')
-    logging.info('UPDATE instance')
+    logging.info('UPDATE instance %s' % instance)
     logging.info('----------------------------------------')
-    exit(0)
+
+    # Load configuration
+    log.info("Prepare settings")
+    s = Settings(instance_dir, startup_args=list(odoo_cmd_startup_args), log_file=log_file)
+    root_dir = os.path.dirname(instance_dir)
+    user = s.instance if s.production_server else None
+    instance_repo = 'git@github.com:OpenAT/' + s.instance + '.git'
+    core_repo_dir = s.instance_core_dir
+    instance_commit = git.get_sha1(instance_dir)
+
+    # Update instance
+    update_instance = s.instance + '_update'
+    update_dir = pj(instance_dir, 'update', update_instance)
+    update_data_dir = pj(update_dir, 'data_dir')
+    update_db_url = s.db_url.rsplit('/', 1)[0] + '/' + s.db_name + '_update'
+
+    # Steps
+    # HINT: Every step gets the results of all finished steps and returns its own result
+    def fetch_instance(results):
+        return git.latest(update_dir, instance_repo, user=user)
+
+    def latest_core(results):
+        return inifile_to_dict(pj(update_dir, 'instance.ini'))['core']
+
+    def get_core(results):
+        core_dir = pj(root_dir, 'online_' + results['latest_core'])
+        if not os.path.isdir(core_dir):
+            log.info("Copy current core %s to %s" % (core_repo_dir, core_dir))
+            os.makedirs(core_dir)
+            # ATTENTION: "/." is necessary to copy also all hidden files
+            shell(['cp', '-rpf', core_repo_dir + '/.', core_dir], profile='files')
+        git.checkout(core_dir, results['latest_core'])
+        return core_dir
+
+    def scan_instance(results):
+        files = git.changed_files(update_dir, instance_commit, results['fetch_instance'])
+        return ot.find_addons_by_files(files, stop=[update_dir])
+
+    def scan_core(results):
+        if results['latest_core'] == s.instance_core_tag:
+            return []
+        files = git.changed_files(results['get_core'], s.instance_core_tag, results['latest_core'])
+        return ot.find_addons_by_files(files, stop=[results['get_core']])
+
+    def backup_instance(results):
+        backup_file = backup(instance_dir, odoo_cmd_startup_args=list(odoo_cmd_startup_args), log_file=log_file)
+        assert backup_file, "Pre-update backup failed!"
+        return backup_file
+
+    def stop_update_service(results):
+        if s.production_server and _service_exists(update_instance):
+            assert _service_control(update_instance, 'stop'), "Could not stop service %s" % update_instance
+        return True
+
+    def restore_update_instance(results):
+        return ot.restore_manual(db_url=update_db_url, data_dir=update_data_dir,
+                                 backup_zip_file=results['backup_instance'])
+
+    def migrate(results):
+        addons = results['scan_core'] + results['scan_instance']
+        if not addons:
+            log.info("No addons to update found!")
+            return []
+        core_dir = results['get_core']
+        addons_path = ','.join([pj(core_dir, 'odoo/openerp/addons'), pj(core_dir, 'odoo/addons'),
+                                pj(core_dir, 'addons-loaded'), pj(update_dir, 'addons')])
+        shell_stream([pj(core_dir, 'odoo/openerp-server'),
+                      '-d', s.db_name + '_update', '-r', s.db_user, '-w', s.db_password,
+                      '--db_host=' + s.db_host, '--db_port=' + s.db_port, '-D', update_data_dir,
+                      '--addons-path=' + addons_path, '--stop-after-init', '-u', ','.join(addons)],
+                     user=user, cwd=pj(core_dir, 'odoo'), timeout=60*60*3, on_line=ot.odoo_progress(),
+                     profile='migration')
+        return addons
+
+    # Dependency graph
+    pipeline = Pipeline('update ' + s.instance, max_workers=max_workers)
+    pipeline.add('fetch_instance', fetch_instance)
+    pipeline.add('backup_instance', backup_instance)
+    pipeline.add('stop_update_service', stop_update_service)
+    pipeline.add('latest_core', latest_core, requires=['fetch_instance'])
+    pipeline.add('get_core', get_core, requires=['latest_core'])
+    pipeline.add('scan_instance', scan_instance, requires=['fetch_instance'])
+    pipeline.add('scan_core', scan_core, requires=['get_core'])
+    pipeline.add('restore_update_instance', restore_update_instance,
+                 requires=['backup_instance', 'stop_update_service'])
+    pipeline.add('migrate', migrate, requires=['restore_update_instance', 'scan_instance', 'scan_core'])
+
+    # Run the pipeline and write the report of this run (one file per run so runs can be diffed)
+    start_time = time.strftime('%Y-%m-%d_%H-%M-%S')
+    try:
+        return pipeline.run()
+    finally:
+        report_file = pj(instance_dir, 'update', 'update_report-%s.json' % start_time)
+        try:
+            report = pipeline.report(instance=s.instance, start_time=start_time, commit=instance_commit,
+                                     core=s.instance_core_tag, success=not pipeline.errors,
+                                     profiles=profile_totals())
+            with open(report_file, 'w') as f:
+                json.dump(report, f, indent=2)
+            log.info("Update report written to %s" % report_file)
+        except Exception as e:
+            log.warning("Could not write the update report to %s! %s" % (report_file, repr(e)))
 
 
 def start(instance_dir, cmd_args=[], log_file=''):
@@ -518,7 +750,7 @@ def start(instance_dir, cmd_args=[], log_file=''):
 
     # Load configuration
     log.info("Prepare settings")
-    s = Settings(instance_dir, startup_args=cmd_args, log_file=log_file)
+    s = launch_settings(instance_dir, startup_args=cmd_args, log_file=log_file)
 
     # Change current working directory to the folder odoo_dir inside the repo online
     working_dir = pj(s.instance_core_dir, 'odoo')
@@ -589,8 +821,8 @@ def fs_online():
         exit(0)
 
     # UPDATE
-    if known_args.update or known_args.update_to_rev:
-        # TODO
+    if known_args.update:
+        update(known_args.instance_dir, odoo_cmd_startup_args=unknown_args, log_file=known_args.log_file)
         exit(0)
 
     # START
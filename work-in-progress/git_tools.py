@@ -7,10 +7,58 @@ import logging
 log = logging.getLogger()
 
 
+def git_dir(path):
+    """
+    :param path: (str) path of the repository
+    :return: (str) path of the git directory (for submodules '.git' is a file like "gitdir: ../.git/modules/sub")
+    """
+    gitdir = os.path.join(path, '.git')
+    if os.path.isfile(gitdir):
+        with open(gitdir, 'r') as f:
+            gitdir = os.path.normpath(os.path.join(path, f.read().split('gitdir:', 1)[1].strip()))
+    return gitdir
+
+
+def get_head(path):
+    """
+    Read the commit of HEAD from the files in the git directory (HEAD, loose refs and packed-refs) without a git process
+
+    :param path: (str) path of the repository
+    :return: (str) SHA1 of HEAD or (boolean) False if it could not be read
+    """
+    try:
+        gitdir = git_dir(path)
+        with open(os.path.join(gitdir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+        if not head.startswith('ref:'):
+            return head
+        ref = head.split(':', 1)[1].strip()
+        commondir = gitdir
+        if os.path.isfile(os.path.join(gitdir, 'commondir')):
+            with open(os.path.join(gitdir, 'commondir'), 'r') as f:
+                commondir = os.path.normpath(os.path.join(gitdir, f.read().strip()))
+        for base in (gitdir, commondir):
+            if os.path.isfile(os.path.join(base, ref)):
+                with open(os.path.join(base, ref), 'r') as f:
+                    return f.read().strip()
+        with open(os.path.join(commondir, 'packed-refs'), 'r') as f:
+            for line in f:
+                if line.rstrip('\n').endswith(' ' + ref):
+                    return line.split()[0]
+    except (IOError, OSError, IndexError):
+        pass
+    return False
+
+
 def get_sha1(path):
     log.info("Get SHA1 of git repo at %s" % path)
     assert os.path.isdir(path), "Repository path not found at %s" % path
 
+    # Read HEAD directly from the git directory and only fall back to git if this is not possible
+    sha1 = get_head(path)
+    if sha1 and len(sha1) == 40:
+        return sha1
+
     # sha1 = shell(['git', 'rev-parse', 'HEAD'], cwd=path)
     sha1 = shell(['git', 'log', '-1', '--pretty="%H"'], cwd=path)
     sha1 = sha1.strip().replace('"', '').replace("'", "")
@@ -53,3 +101,73 @@ def get_tag(path, match='o8r*'):
 
     return tag
 
+
+
+def latest(path, repo, branch='o8', user=None):
+    """
+    Clone the repository or fetch and hard reset it to the latest commit of the branch (incl. submodules)
+
+    :param path: (str) full path of the local repository
+    :param repo: (str) git url of the remote repository
+    :param branch: (str) branch to check out
+    :param user: (str) linux user to run git with
+    :return: (str) SHA1 of the checked out commit
+    """
+    if not os.path.isdir(path):
+        log.info("Clone %s -b %s to %s" % (repo, branch, path))
+        shell(['git', 'clone', '-b', branch, repo, path], user=user, cwd=os.path.dirname(path), timeout=600)
+    else:
+        log.info("Fetch and reset git repo at %s to origin/%s" % (path, branch))
+        shell(['git', 'fetch', '--tags', 'origin'], user=user, cwd=path, timeout=120)
+        shell(['git', 'checkout', '-f', branch], user=user, cwd=path, timeout=60)
+        shell(['git', 'reset', '--hard', 'origin/' + branch], user=user, cwd=path, timeout=60)
+        shell(['git', 'clean', '-fd'], user=user, cwd=path, timeout=120)
+    shell(['git', 'submodule', 'sync', '--recursive'], user=user, cwd=path, timeout=120)
+    shell(['git', 'submodule', 'update', '--init', '--recursive', '-f'], user=user, cwd=path, timeout=1200)
+    return get_sha1(path)
+
+
+def checkout(path, commit, user=None):
+    """
+    Check out a commit, tag or branch (incl. submodules)
+
+    :param path: (str) full path of the local repository
+    :param commit: (str) SHA1, tag or branch
+    :param user: (str) linux user to run git with
+    :return: (str) SHA1 of the checked out commit
+    """
+    log.info("Checkout %s in git repo at %s" % (commit, path))
+    assert os.path.isdir(path), "Repository path not found at %s" % path
+    try:
+        shell(['git', 'rev-parse', '--verify', '--quiet', commit + '^{commit}'], user=user, cwd=path, log_info=False)
+    except Exception:
+        # Commit not found in the local repository
+        shell(['git', 'fetch', '--tags', 'origin'], user=user, cwd=path, timeout=120)
+    shell(['git', 'checkout', '-f', commit], user=user, cwd=path, timeout=60)
+    shell(['git', 'submodule', 'sync', '--recursive'], user=user, cwd=path, timeout=120)
+    shell(['git', 'submodule', 'update', '--init', '--recursive', '-f'], user=user, cwd=path, timeout=1200)
+    return get_sha1(path)
+
+
+def changed_files(path, current, target):
+    """
+    Files added, copied, modified or renamed between two commits incl. the files changed in (nested) submodules
+
+    :param path: (str) full path of the local repository
+    :param current: (str) SHA1, tag or branch
+    :param target: (str) SHA1, tag or branch
+    :return: (list) full paths of the changed files
+    """
+    log.info("Search for changed files between %s and %s in git repo at %s" % (current, target, path))
+    files = []
+    output = shell(['git', 'diff', '--raw', '-z', '--no-abbrev', '--no-renames', '--diff-filter=ACMR',
+                    current, target], cwd=path, log_info=False)
+    entries = output.split('\0')
+    for meta, file_path in zip(entries[0::2], entries[1::2]):
+        old_mode, new_mode, old_rev, new_rev, status = meta.lstrip(':').split()
+        # Submodules are gitlinks with mode 160000 (old_mode is 000000 if the submodule was added)
+        if new_mode != '160000':
+            files.append(os.path.join(path, file_path))
+        elif old_mode == '160000' and old_rev != new_rev:
+            files.extend(changed_files(os.path.join(path, file_path), old_rev, new_rev))
+    return files
@@ -0,0 +1,173 @@
+# -*- coding: utf-'8' "-*-"
+import threading
+import time
+import sys
+from collections import OrderedDict
+from shell_tools import usage, usage_delta
+
+import logging
+log = logging.getLogger()
+
+
+class Step(object):
+    def __init__(self, name, func, requires=()):
+        """
+        A single step of a pipeline
+
+        :param name: (str) unique name of the step
+        :param func: (function) called with the dict of all results so far: func(results)
+        :param requires: (list) names of the steps that must be done before this step can start
+        """
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+        self.start = None
+        self.end = None
+        self.state = 'pending'
+        self.usage = dict()
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+class Pipeline(object):
+    """
+    Dependency graph executor: every step starts as soon as all of its required steps are done so independent
+    steps run concurrently in threads.
+
+    Example:
+        p = Pipeline('update')
+        p.add('backup', backup_function)
+        p.add('fetch', fetch_function)
+        p.add('restore', restore_function, requires=['backup', 'fetch'])
+        results = p.run()
+    """
+    def __init__(self, name, max_workers=4):
+        self.name = name
+        self.max_workers = max_workers
+        self.steps = OrderedDict()
+        self.results = dict()
+        self.errors = OrderedDict()
+
+    def add(self, name, func, requires=()):
+        assert name not in self.steps, "Step %s exists already in pipeline %s!" % (name, self.name)
+        unknown = [r for r in requires if r not in self.steps]
+        # HINT: Steps must be added after the steps they require so the graph can never contain a cycle
+        assert not unknown, "Step %s requires unknown step(s) %s! Add them first." % (name, unknown)
+        self.steps[name] = Step(name, func, requires=requires)
+        return self.steps[name]
+
+    def _run_step(self, step, condition):
+        log.info("[%s] Step %s started" % (self.name, step.name))
+        before = usage()
+        try:
+            result = step.func(self.results)
+            error = None
+        except Exception as e:
+            result = None
+            error = e
+            log.error("[%s] Step %s failed! %s" % (self.name, step.name, repr(e)), exc_info=sys.exc_info())
+        with condition:
+            step.end = time.time()
+            # HINT: The counters are process wide: steps running at the same time share their cpu and io
+            step.usage = usage_delta(before, usage())
+            if error is None:
+                step.state = 'done'
+                self.results[step.name] = result
+                log.info("[%s] Step %s done in %.1fs" % (self.name, step.name, step.duration))
+            else:
+                step.state = 'failed'
+                self.errors[step.name] = error
+            condition.notify_all()
+
+    def run(self):
+        """
+        Run all steps. If a step fails no new steps are started and the exception of the first failed step is
+        raised after all running steps are done.
+
+        :return: (dict) results of all steps by step name
+        """
+        log.info("[%s] Run pipeline with %s steps (max %s concurrent steps)"
+                 "" % (self.name, len(self.steps), self.max_workers))
+        start = time.time()
+        condition = threading.Condition()
+        with condition:
+            while True:
+                running = [s for s in self.steps.itervalues() if s.state == 'running']
+                if not self.errors:
+                    for step in self.steps.itervalues():
+                        if len(running) >= self.max_workers:
+                            break
+                        if step.state == 'pending' and all(self.steps[r].state == 'done' for r in step.requires):
+                            step.state = 'running'
+                            step.start = time.time()
+                            running.append(step)
+                            thread = threading.Thread(target=self._run_step, args=(step, condition),
+                                                      name=self.name + '.' + step.name)
+                            thread.daemon = True
+                            thread.start()
+                if not running:
+                    break
+                # HINT: wait() with a timeout so KeyboardInterrupt is not blocked
+                condition.wait(1)
+
+        for step in self.steps.itervalues():
+            if step.state == 'pending':
+                step.state = 'skipped'
+        self.duration = time.time() - start
+        self.log_report()
+        if self.errors:
+            raise self.errors.values()[0]
+        return self.results
+
+    def critical_path(self):
+        """
+        :return: (list) names of the steps on the longest chain of dependent steps (by duration)
+        """
+        longest = dict()
+        for name, step in self.steps.iteritems():
+            # Steps are stored in dependency order (see add())
+            if step.start is None:
+                continue
+            before = max([longest[r] for r in step.requires if r in longest] or [(0.0, [])])
+            longest[name] = (before[0] + step.duration, before[1] + [name])
+        return max(longest.values() or [(0.0, [])])[1]
+
+    def timings(self):
+        """
+        :return: (OrderedDict) {step_name: {'state', 'start', 'end', 'duration', 'usage'}} start and end relative to
+                 the start of the first step, usage see shell_tools.usage_delta()
+        """
+        first = min([s.start for s in self.steps.itervalues() if s.start is not None] or [0.0])
+        return OrderedDict((name, {'state': s.state,
+                                   'start': round(s.start - first, 3) if s.start is not None else None,
+                                   'end': round(s.end - first, 3) if s.end is not None else None,
+                                   'duration': round(s.duration, 3),
+                                   'usage': s.usage})
+                           for name, s in self.steps.iteritems())
+
+    def report(self, **info):
+        """
+        :param info: additional information for the report e.g. instance='dadi'
+        :return: (OrderedDict) report of the pipeline run (that can be dumped to json)
+        """
+        report = OrderedDict(sorted(info.items()))
+        report['pipeline'] = self.name
+        report['duration'] = round(getattr(self, 'duration', 0.0), 3)
+        report['critical_path'] = self.critical_path()
+        report['steps'] = self.timings()
+        return report
+
+    def log_report(self):
+        critical_path = self.critical_path()
+        log.info("[%s] Pipeline finished in %.1fs" % (self.name, getattr(self, 'duration', 0.0)))
+        for name, timing in self.timings().iteritems():
+            log.info("[%s] %s %-24s %-8s start %8s end %8s duration %8.1fs"
+                     "" % (self.name, '*' if name in critical_path else ' ', name, timing['state'],
+                           timing['start'], timing['end'], timing['duration']))
+        log.info("[%s] Critical path (*): %s (%.1fs)"
+                 "" % (self.name, ' -> '.join(critical_path),
+                       sum(self.steps[name].duration for name in critical_path)))
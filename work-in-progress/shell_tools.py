@@ -4,6 +4,11 @@ import sys
 import pwd
 import subprocess32
 import zipfile
+import time
+import resource
+import threading
+from collections import deque, OrderedDict
+from distutils.spawn import find_executable
 
 import logging
 log = logging.getLogger()
@@ -19,14 +24,129 @@ def _switch_user_function(user_uid, user_gid):
     return inner
 
 
-# Linux-Shell wrapper
-def shell(cmd=list(), user=None, cwd=None, env=None, preexec_fn=None, log_info=True, **kwargs):
-    log.debug("Run shell command: %s" % cmd)
-    assert isinstance(cmd, (list, tuple)), 'shell(cmd): cmd must be of type list or tuple!'
+def usage():
+    # Resource usage of this process and all its finished child processes (e.g. git, pg_dump or openerp-server)
+    # HINT: The IO counters of /proc/self/io include the IO of all waited-for child processes
+    # HINT: Also used by start.py for the report of the update phases
+    times = os.times()
+    result = {'wall': time.time(),
+              'cpu_self': times[0] + times[1],
+              'cpu_children': times[2] + times[3],
+              'children_maxrss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+              'read_bytes': 0,
+              'write_bytes': 0}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            io = dict(line.split(':', 1) for line in f.read().splitlines() if ':' in line)
+        result['read_bytes'] = int(io.get('read_bytes', 0))
+        result['write_bytes'] = int(io.get('write_bytes', 0))
+    except (IOError, OSError, ValueError):
+        pass
+    return result
 
-    # Working directory
-    cwd = cwd or os.getcwd()
 
+def usage_delta(before, after):
+    # Resource usage between two usage() calls e.g. of a phase of the update
+    return OrderedDict([
+        ('wall', round(after['wall'] - before['wall'], 3)),
+        ('cpu_self', round(after['cpu_self'] - before['cpu_self'], 3)),
+        ('cpu_children', round(after['cpu_children'] - before['cpu_children'], 3)),
+        # HINT: ru_maxrss is the peak of the biggest child process so far: it is only the peak of this phase
+        #       if it grew during the phase
+        ('children_maxrss_kb', after['children_maxrss_kb']),
+        ('children_maxrss_grew', after['children_maxrss_kb'] > before['children_maxrss_kb']),
+        ('read_bytes', after['read_bytes'] - before['read_bytes']),
+        ('write_bytes', after['write_bytes'] - before['write_bytes']),
+    ])
+
+
+# Resource profiles for shell commands so maintenance steps do not slow down the other instances of the host
+# HINT: nice: cpu priority (19 = lowest), ionice: (io scheduling class, priority) class 2 = best-effort, 3 = idle
+# HINT: cpu_quota (e.g. '50%') and memory_max (e.g. '4G') run the command in a cgroup by 'systemd-run --scope' (root)
+# HINT: All values can be set by ONLINE_TOOLS_PROFILE_<PROFILE>_<KEY> e.g. ONLINE_TOOLS_PROFILE_MIGRATION_MEMORY_MAX=4G
+# ATTENTION: For pg_dump, pg_restore and psql only the client process is throttled. The work done by the postgres
+#            server backend is not.
+resource_profiles = {
+    'backup': {'nice': 10, 'ionice': (2, 7), 'cpu_quota': None, 'memory_max': None},
+    'files': {'nice': 15, 'ionice': (3, 0), 'cpu_quota': None, 'memory_max': None},
+    'migration': {'nice': 5, 'ionice': (2, 4), 'cpu_quota': None, 'memory_max': None},
+}
+_profile_totals = OrderedDict()
+_profile_lock = threading.Lock()
+
+
+def resource_profile(name):
+    """
+    :param name: (str) name of the resource profile
+    :return: (dict) resource profile with the values from the environment variables
+    """
+    profile = dict(resource_profiles[name])
+    for key in profile:
+        value = os.environ.get('ONLINE_TOOLS_PROFILE_%s_%s' % (name.upper(), key.upper()))
+        if value is None:
+            continue
+        if key == 'nice':
+            profile[key] = int(value)
+        elif key == 'ionice':
+            profile[key] = tuple(int(v) for v in value.split(','))
+        else:
+            profile[key] = value or None
+    return profile
+
+
+def resource_prefix(name, linux_user=None):
+    """
+    Command prefix to run a shell command with a resource profile (tools that are not installed are skipped)
+
+    :param name: (str) name of the resource profile
+    :param linux_user: (pwd.struct_passwd) user for 'systemd-run --scope' (a non root user can not create the scope)
+    :return: (list) command prefix
+    """
+    profile = resource_profile(name)
+    prefix = []
+    if (profile.get('cpu_quota') or profile.get('memory_max')) and find_executable('systemd-run') \
+            and os.getuid() == 0:
+        prefix += ['systemd-run', '--scope', '--quiet', '--collect']
+        if profile.get('cpu_quota'):
+            prefix += ['-p', 'CPUQuota=' + profile['cpu_quota']]
+        if profile.get('memory_max'):
+            prefix += ['-p', 'MemoryMax=' + profile['memory_max']]
+        if linux_user:
+            prefix += ['--uid=' + str(linux_user.pw_uid), '--gid=' + str(linux_user.pw_gid)]
+    if profile.get('nice') and find_executable('nice'):
+        prefix += ['nice', '-n', str(profile['nice'])]
+    if profile.get('ionice') and find_executable('ionice'):
+        prefix += ['ionice', '-c', str(profile['ionice'][0])]
+        if profile['ionice'][0] != 3:
+            prefix += ['-n', str(profile['ionice'][1])]
+    return prefix
+
+
+def _profile_accounting(name, before):
+    # HINT: The counters are process wide: commands running at the same time in threads share their cpu and io
+    delta = usage_delta(before, usage())
+    with _profile_lock:
+        total = _profile_totals.setdefault(name, OrderedDict([
+            ('commands', 0), ('wall', 0.0), ('cpu_children', 0.0), ('children_maxrss_kb', 0),
+            ('read_bytes', 0), ('write_bytes', 0)]))
+        total['commands'] += 1
+        total['wall'] = round(total['wall'] + time.time() - before['wall'], 3)
+        total['cpu_children'] = round(total['cpu_children'] + delta['cpu_children'], 3)
+        total['children_maxrss_kb'] = max(total['children_maxrss_kb'], delta['children_maxrss_kb'])
+        total['read_bytes'] += delta['read_bytes']
+        total['write_bytes'] += delta['write_bytes']
+
+
+def profile_totals():
+    """
+    :return: (OrderedDict) resources used by the shell commands of every resource profile
+    """
+    with _profile_lock:
+        return OrderedDict((name, dict(total)) for name, total in _profile_totals.iteritems())
+
+
+# Returns the linux user, the environment and the preexec_fn for the shell command
+def _shell_user(user=None, env=None, preexec_fn=None):
     # Linux User
     linux_user = pwd.getpwuid(os.getuid())
 
@@ -47,6 +167,35 @@ def shell(cmd=list(), user=None, cwd=None, env=None, preexec_fn=None, log_info=T
         # Create a new function that will be called by subprocess32 before the shell command is executed
         preexec_fn = _switch_user_function(linux_user.pw_uid, linux_user.pw_gid)
 
+    return linux_user, env, preexec_fn
+
+
+# Returns the command with the prefix of the resource profile and the (changed) preexec_fn
+def _shell_profile(cmd, profile, linux_user, user, preexec_fn):
+    if not profile:
+        return list(cmd), preexec_fn
+    prefix = resource_prefix(profile, linux_user=linux_user if user else None)
+    # HINT: systemd-run --scope switches the user itself
+    if user and prefix and prefix[0] == 'systemd-run':
+        preexec_fn = None
+    log.debug("Resource profile %s: %s" % (profile, ' '.join(prefix)))
+    return prefix + list(cmd), preexec_fn
+
+
+# Linux-Shell wrapper
+def shell(cmd=list(), user=None, cwd=None, env=None, preexec_fn=None, log_info=True, profile=None, **kwargs):
+    log.debug("Run shell command: %s" % cmd)
+    assert isinstance(cmd, (list, tuple)), 'shell(cmd): cmd must be of type list or tuple!'
+
+    # Working directory
+    cwd = cwd or os.getcwd()
+
+    # Linux User and environment
+    linux_user, env, preexec_fn = _shell_user(user=user, env=env, preexec_fn=preexec_fn)
+
+    # Resource profile
+    cmd, preexec_fn = _shell_profile(cmd, profile, linux_user, user, preexec_fn)
+
     # Log user Current-Working-Directory and shell command to be executed
     if log_info:
         log.info('[%s %s]$ %s' % (linux_user.pw_name, cwd, ' '.join(cmd)))
@@ -57,6 +206,7 @@ def shell(cmd=list(), user=None, cwd=None, env=None, preexec_fn=None, log_info=T
 
     # Log Error output also
     # https://stackoverflow.com/questions/16198546/get-exit-code-and-stderr-from-subprocess-call
+    before = usage()
     try:
         result = subprocess32.check_output(cmd, cwd=cwd, env=env, preexec_fn=preexec_fn,
                                            stderr=subprocess32.STDOUT, **kwargs)
@@ -66,6 +216,73 @@ def shell(cmd=list(), user=None, cwd=None, env=None, preexec_fn=None, log_info=T
         if std_err:
             log.warning(std_err.rstrip('\n'))
         raise e
+    finally:
+        if profile:
+            _profile_accounting(profile, before)
+
+
+def shell_stream(cmd=list(), user=None, cwd=None, env=None, preexec_fn=None, log_info=True, timeout=None, tail=200,
+                 on_line=None, profile=None, **kwargs):
+    """
+    Run a shell command and log its output (stdout and stderr) line by line while it runs
+
+    Unlike shell() only the last lines of the output are kept in memory. Use it for long running commands with a lot
+    of output like 'openerp-server -u', pg_dump or pg_restore.
+
+    :param cmd: (list) shell command
+    :param user: (str) linux user to run the command as
+    :param cwd: (str) working directory
+    :param timeout: (int) seconds until the command is killed
+    :param tail: (int) number of the last output lines to keep for the return value and for exceptions
+    :param on_line: (function) called for every output line: on_line(line) e.g. odoo_tools.odoo_progress()
+    :param profile: (str) resource profile of the command (see resource_profiles)
+    :return: (str) the last 'tail' lines of the output
+    """
+    log.debug("Run shell command: %s" % cmd)
+    assert isinstance(cmd, (list, tuple)), 'shell_stream(cmd): cmd must be of type list or tuple!'
+    cwd = cwd or os.getcwd()
+    linux_user, env, preexec_fn = _shell_user(user=user, env=env, preexec_fn=preexec_fn)
+    cmd, preexec_fn = _shell_profile(cmd, profile, linux_user, user, preexec_fn)
+    if log_info:
+        log.info('[%s %s]$ %s' % (linux_user.pw_name, cwd, ' '.join(cmd)))
+
+    before = usage()
+    lines = deque(maxlen=tail)
+    proc = subprocess32.Popen(cmd, cwd=cwd, env=env, preexec_fn=preexec_fn, stdout=subprocess32.PIPE,
+                              stderr=subprocess32.STDOUT, close_fds=True, **kwargs)
+
+    def reader():
+        for line in iter(proc.stdout.readline, ''):
+            line = line.rstrip('\n')
+            lines.append(line)
+            log.info(line)
+            if on_line:
+                try:
+                    on_line(line)
+                except Exception as e:
+                    log.warning("Could not process output line! %s" % repr(e))
+        proc.stdout.close()
+
+    thread = threading.Thread(target=reader, name='shell_stream')
+    thread.daemon = True
+    thread.start()
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except subprocess32.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        # HINT: Do not wait forever for the reader if a grandchild process keeps the pipe open
+        thread.join(10)
+        log.error("Shell command timed out after %ss: %s" % (timeout, cmd))
+        raise subprocess32.TimeoutExpired(cmd, timeout, output='\n'.join(lines))
+    finally:
+        if profile:
+            _profile_accounting(profile, before)
+    thread.join()
+    output = '\n'.join(lines)
+    if returncode:
+        raise subprocess32.CalledProcessError(returncode, cmd, output=output)
+    return output
 
 
 def disk_usage(folder):